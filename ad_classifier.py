@@ -0,0 +1,360 @@
+"""
+广告识别模块
+链接规则合并为一个预编译正则，关键词构建为 Aho-Corasick 自动机，
+对转为小写的文本各扫描一遍即可得到命中的链接、关键词和判定结果。
+链接优先使用 Telegram 解析好的消息实体（url / text_link / mention，包括文本中看不到的隐藏链接），
+规范化域名后查域名信誉表，只有消息没有实体时才用正则扫描文本。
+每个群组可以在默认规则之外添加屏蔽/放行的关键词和链接（见 auto_moderation.get_chat_classifier）
+"""
+import re
+import logging
+import itertools
+from typing import Dict, Iterable, List, Optional, Tuple
+from telegram import Message, MessageEntity
+from config import AD_SPAM_DOMAINS, AD_SPAM_USERNAMES
+
+logger = logging.getLogger(__name__)
+
+# 判定原因
+REASON_LINK = "检测到广告链接"
+REASON_MENTION = "检测到广告账号"
+REASON_KEYWORDS = "检测到广告关键词"
+
+# 域名信誉
+DOMAIN_BLOCKED = 'blocked'  # 整个域名（含子域名）的链接都算广告
+DOMAIN_INVITE = 'invite'  # 只有邀请链接和私有频道链接算广告
+
+# 域名信誉表（规范化后的域名 -> 信誉），查询时依次查完整域名和各级父域名
+DOMAIN_REPUTATION: Dict[str, str] = {
+    't.me': DOMAIN_INVITE,
+    'telegram.dog': DOMAIN_INVITE,
+    'telegram.me': DOMAIN_BLOCKED,
+    'telegram.org': DOMAIN_BLOCKED,
+    'tg.me': DOMAIN_BLOCKED,
+    'tg.org': DOMAIN_BLOCKED,
+}
+DOMAIN_REPUTATION.update((domain, DOMAIN_BLOCKED) for domain in AD_SPAM_DOMAINS)
+
+# Telegram 邀请链接 / 私有频道链接的路径
+INVITE_PATH = re.compile(r'/(?:joinchat/|\+|c/\d+)')
+
+# 需要提取的实体类型
+_ENTITY_TYPES = (MessageEntity.URL, MessageEntity.TEXT_LINK, MessageEntity.MENTION)
+
+
+def normalize_url(url: str) -> Optional[Tuple[str, str, str]]:
+    """
+    规范化链接（手工拆分，比 urlsplit 快）
+    
+    Returns:
+        (域名, 路径, 完整链接)，均为小写：域名去掉 www. 前缀、用户信息、端口和末尾的点，
+        国际化域名转为 punycode；没有域名时返回 None
+    """
+    lowered = url.strip().lower()
+    scheme_end = lowered.find('://')
+    if scheme_end >= 0:
+        scheme, rest = lowered[:scheme_end], lowered[scheme_end + 3:]
+    elif lowered.startswith('tg:'):
+        scheme, rest = 'tg', lowered[3:]
+    else:
+        scheme, rest = 'http', lowered
+    
+    # 域名部分到第一个 / ? # 为止
+    host_end = len(rest)
+    for separator in '/?#':
+        index = rest.find(separator, 0, host_end)
+        if index >= 0:
+            host_end = index
+    netloc, tail = rest[:host_end], rest[host_end:]
+    
+    if scheme == 'tg':
+        # tg://join?invite=... 等价于 t.me/+...
+        host, tail = 't.me', ('/+' if netloc == 'join' else '/' + netloc) + tail
+    else:
+        host = netloc.rpartition('@')[2]
+        host = host[1:host.find(']')] if host.startswith('[') else host.partition(':')[0]
+        host = host.rstrip('.')
+        if host.startswith('www.'):
+            host = host[4:]
+        if not host.isascii():
+            try:
+                host = host.encode('idna').decode('ascii')
+            except UnicodeError:
+                pass
+    if not host:
+        return None
+    
+    path = tail.partition('?')[0].partition('#')[0]
+    return host, path, f"https://{host}{tail}"
+
+
+def domain_reputation(host: str, table: Dict[str, str] = DOMAIN_REPUTATION) -> Optional[str]:
+    """查询域名信誉（完整域名优先，其次各级父域名），不在表中返回 None"""
+    while True:
+        reputation = table.get(host)
+        if reputation is not None:
+            return reputation
+        dot = host.find('.')
+        if dot < 0:
+            return None
+        host = host[dot + 1:]
+
+
+def extract_entities(message: Message) -> Tuple[Optional[List[str]], List[str]]:
+    """
+    从消息实体中提取链接和提及的用户名
+    
+    Returns:
+        (链接列表, 用户名列表)：消息没有任何实体时链接列表为 None（需要回退到文本扫描）；
+        用户名为小写、不含 @
+    """
+    if message.text is not None:
+        if not message.entities:
+            return None, []
+        parsed = message.parse_entities(_ENTITY_TYPES)
+    else:
+        if not message.caption_entities:
+            return None, []
+        parsed = message.parse_caption_entities(_ENTITY_TYPES)
+    
+    urls, mentions = [], []
+    for entity, value in parsed.items():
+        if entity.type == MessageEntity.TEXT_LINK:
+            urls.append(entity.url)
+        elif entity.type == MessageEntity.URL:
+            urls.append(value)
+        else:
+            mentions.append(value[1:].lower())
+    return urls, mentions
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick 多模式匹配自动机
+    构建后只读，可在多个协程/线程间共享
+    """
+    
+    __slots__ = ('_goto', '_fail', '_output', 'patterns')
+    
+    def __init__(self, patterns: Iterable[str]):
+        """
+        构建自动机
+        
+        Args:
+            patterns: 模式串（调用方负责统一大小写）
+        """
+        self.patterns: Tuple[str, ...] = tuple(dict.fromkeys(p for p in patterns if p))
+        # 状态 0 为根；_goto[状态] = {字符: 下一状态}
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # 到达该状态时命中的模式（已合并失败链上的结果）
+        self._output: List[Tuple[str, ...]] = [()]
+        
+        for pattern in self.patterns:
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                state = next_state
+            self._output[state] = self._output[state] + (pattern,)
+        
+        # 按层次遍历计算失败指针
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail
+                if self._output[fail]:
+                    self._output[next_state] = self._output[next_state] + self._output[fail]
+    
+    def __len__(self) -> int:
+        return len(self.patterns)
+    
+    def find_all(self, text: str, start: int = 0) -> List[str]:
+        """
+        返回文本中出现的所有模式（去重，按首次出现的位置排序）
+        
+        Args:
+            text: 文本
+            start: 从该位置开始扫描（调用方保证之前没有模式出现）
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        found: Dict[str, None] = {}
+        state = 0
+        for char in itertools.islice(text, start, None):
+            next_state = goto[state].get(char)
+            while next_state is None and state:
+                state = fail[state]
+                next_state = goto[state].get(char)
+            state = next_state or 0
+            if output[state]:
+                for pattern in output[state]:
+                    found[pattern] = None
+        return list(found)
+
+
+class AdVerdict:
+    """广告识别结果"""
+    __slots__ = ('is_ad', 'reason', 'links', 'mentions', 'keywords')
+    
+    def __init__(self, links: List[str], keywords: List[str], min_keywords: int, mentions: List[str] = ()):
+        self.links = links
+        self.mentions = list(mentions)
+        self.keywords = keywords
+        # 包含广告链接或广告账号，或命中多个不同的关键词
+        if links:
+            self.is_ad, self.reason = True, REASON_LINK
+        elif self.mentions:
+            self.is_ad, self.reason = True, REASON_MENTION
+        elif len(keywords) >= min_keywords:
+            self.is_ad, self.reason = True, REASON_KEYWORDS
+        else:
+            self.is_ad, self.reason = False, ""
+    
+    def __bool__(self) -> bool:
+        return self.is_ad
+    
+    def __repr__(self) -> str:
+        return (f"AdVerdict(is_ad={self.is_ad}, reason={self.reason!r}, links={self.links}, "
+                f"mentions={self.mentions}, keywords={self.keywords})")
+
+
+def _alternation(patterns: Iterable[str]) -> Optional["re.Pattern"]:
+    """把多个正则合并为一个（各自作为非捕获分组），没有规则时返回 None"""
+    patterns = [pattern for pattern in patterns if pattern]
+    if not patterns:
+        return None
+    return re.compile('|'.join(f'(?:{pattern})' for pattern in patterns))
+
+
+class AdClassifier:
+    """预编译的广告识别器"""
+    
+    # 关键词不超过此数量时用关键词正则预筛；更多时正则需逐个尝试分支，比自动机还慢，改为按首字符预筛
+    PREFILTER_MAX_KEYWORDS = 100
+    
+    def __init__(self, link_patterns: Iterable[str], keywords: Iterable[str], min_keywords: int = 2,
+                 block_links: Iterable[str] = (), allow_links: Iterable[str] = (), allow_keywords: Iterable[str] = (),
+                 domains: Dict[str, str] = DOMAIN_REPUTATION, spam_usernames: Iterable[str] = AD_SPAM_USERNAMES):
+        """
+        初始化识别器
+        
+        Args:
+            link_patterns: 默认广告链接正则（按小写文本编写，只用于扫描没有实体的文本；实体中的链接查域名信誉表）
+            keywords: 广告关键词（不区分大小写）
+            min_keywords: 没有链接时，至少命中多少个不同关键词才判定为广告
+            block_links: 额外的屏蔽链接正则，同时用于文本扫描和实体中规范化后的链接
+            allow_links: 放行的链接正则，匹配的链接不算广告
+            allow_keywords: 放行的关键词，从 keywords 中排除
+            domains: 域名信誉表
+            spam_usernames: 广告账号用户名（提及即判定为广告）
+        """
+        self.domains = domains
+        self.spam_usernames = frozenset(name.lower().lstrip('@') for name in spam_usernames)
+        self.link_patterns = tuple(link_patterns)
+        self.block_links = tuple(block_links)
+        self.keywords = tuple(keywords)
+        self.min_keywords = min_keywords
+        self.allow_links = tuple(allow_links)
+        self.allow_keywords = tuple(allow_keywords)
+        
+        # 各规则合并为一个正则，一次扫描找出所有链接（匹配到空白为止，便于按放行规则判断整个链接）
+        link_regex = _alternation(self.link_patterns + self.block_links)
+        self._link_regex = re.compile(f'(?:{link_regex.pattern})\\S*') if link_regex else None
+        self._block_regex = _alternation(self.block_links)
+        self._allow_regex = _alternation(self.allow_links)
+        
+        allowed = {keyword.lower() for keyword in self.allow_keywords}
+        self._automaton = AhoCorasick(
+            keyword for keyword in (keyword.lower() for keyword in self.keywords) if keyword not in allowed
+        )
+        # 预筛正则：在 C 层找到第一个可能的关键词位置，没有关键词的消息（绝大多数）不进入自动机，
+        # 有关键词时自动机从该位置开始扫描，仍能找出所有（包括相互重叠的）关键词
+        patterns = self._automaton.patterns
+        if not patterns:
+            self._keyword_regex = None
+        elif len(patterns) <= self.PREFILTER_MAX_KEYWORDS:
+            self._keyword_regex = re.compile('|'.join(map(re.escape, patterns)))
+        else:
+            first_chars = sorted({pattern[0] for pattern in patterns})
+            self._keyword_regex = re.compile('[' + ''.join(map(re.escape, first_chars)) + ']')
+    
+    @property
+    def size(self) -> int:
+        """规则总数（用于缓存按权重淘汰）"""
+        return len(self._automaton) + len(self.link_patterns) + len(self.block_links) + len(self.allow_links)
+    
+    def _find_links(self, lowered: str) -> List[str]:
+        if self._link_regex is None:
+            return []
+        links = [match.group(0) for match in self._link_regex.finditer(lowered)]
+        if links and self._allow_regex is not None:
+            links = [link for link in links if not self._allow_regex.search(link)]
+        return links
+    
+    def _check_urls(self, urls: Iterable[str]) -> List[str]:
+        """检查实体中的链接：先查域名信誉表，再匹配额外的屏蔽规则，最后排除放行的链接"""
+        links = []
+        for url in urls:
+            parsed = normalize_url(url)
+            if parsed is None:
+                continue
+            host, path, normalized = parsed
+            reputation = domain_reputation(host, self.domains)
+            if reputation == DOMAIN_BLOCKED or (reputation == DOMAIN_INVITE and INVITE_PATH.match(path)):
+                links.append(normalized)
+            elif self._block_regex is not None and self._block_regex.search(normalized):
+                links.append(normalized)
+        if links and self._allow_regex is not None:
+            links = [link for link in links if not self._allow_regex.search(link)]
+        return links
+    
+    def _find_keywords(self, lowered: str) -> List[str]:
+        if self._keyword_regex is None:
+            return []
+        match = self._keyword_regex.search(lowered)
+        if match is None:
+            return []
+        return self._automaton.find_all(lowered, match.start())
+    
+    def find_links(self, text: str) -> List[str]:
+        """返回文本中的广告链接"""
+        if not text:
+            return []
+        return self._find_links(text.lower())
+    
+    def find_keywords(self, text: str) -> List[str]:
+        """返回文本中命中的广告关键词（小写，去重）"""
+        if not text:
+            return []
+        return self._find_keywords(text.lower())
+    
+    def classify(self, text: Optional[str], urls: Optional[Iterable[str]] = None,
+                 mentions: Iterable[str] = ()) -> AdVerdict:
+        """
+        识别文本，返回命中的链接、账号、关键词和判定结果
+        
+        Args:
+            text: 消息文本
+            urls: 消息实体中的链接（见 extract_entities），为 None 时用正则扫描文本
+            mentions: 消息实体中提及的用户名（小写、不含 @）
+        """
+        lowered = text.lower() if text else ''
+        links = self._find_links(lowered) if urls is None else self._check_urls(urls)
+        spam_mentions = [name for name in mentions if name in self.spam_usernames] if self.spam_usernames else []
+        keywords = self._find_keywords(lowered) if lowered else []
+        return AdVerdict(links, keywords, self.min_keywords, spam_mentions)
+    
+    def classify_message(self, message: Message) -> AdVerdict:
+        """识别消息（文本或说明文字），优先使用消息实体中的链接"""
+        urls, mentions = extract_entities(message)
+        return self.classify(message.text or message.caption, urls, mentions)
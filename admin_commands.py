@@ -4,14 +4,22 @@
 """
 from telegram import Update, ChatPermissions
 from telegram.ext import ContextTypes
+import time
 import logging
-from database import db
-from config import MAX_WARN_LIMIT, DEFAULT_BAN_TIME, MAX_MUTE_TIME
+from database import adb
+from config import MAX_WARN_LIMIT, DEFAULT_BAN_TIME, MAX_MUTE_TIME, PURGE_MAX_MESSAGES, WARNING_DELETE_DELAY
 from utils_common import check_admin_permission, require_admin, require_group, require_reply, require_channel_or_group, format_time
 from error_handler import safe_execute
+from profiles import profiles
+from recent_messages import recent_messages
+from deletion_scheduler import deletion_scheduler, bulk_delete
+from metrics import messages_purged_total
 
 logger = logging.getLogger(__name__)
 
+# /purge 进度消息最短更新间隔（秒）
+PURGE_PROGRESS_INTERVAL = 2
+
 
 @safe_execute
 @require_admin
@@ -164,7 +172,7 @@ async def warn_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         # 添加警告记录到数据库
-        warning_count = db.add_warning(chat.id, target_user.id, update.effective_user.id, reason)
+        warning_count = await adb.add_warning(chat.id, target_user.id, update.effective_user.id, reason)
         
         warn_text = f"""
 ⚠️ 警告用户: {target_user.mention_html()}
@@ -205,7 +213,7 @@ async def unwarn_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_user = message.reply_to_message.from_user
     
     try:
-        deleted_count = db.clear_warnings(chat.id, target_user.id)
+        deleted_count = await adb.clear_warnings(chat.id, target_user.id)
         
         if deleted_count > 0:
             await message.reply_text(
@@ -236,7 +244,7 @@ async def get_warnings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_user = message.reply_to_message.from_user
     
     try:
-        warning_count = db.get_warning_count(chat.id, target_user.id)
+        warning_count = await adb.get_warning_count(chat.id, target_user.id)
         
         warn_text = f"""
 📊 用户警告信息
@@ -282,6 +290,75 @@ async def delete_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"删除消息时出错: {e}")
 
 
+@safe_execute
+@require_admin
+@require_group
+@require_reply
+async def purge_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    批量清理消息
+    /purge（回复消息）: 删除从被回复的消息到本条命令之间的所有消息
+    /purge N（回复消息）: 删除被回复用户最近的 N 条消息
+    """
+    chat = update.effective_chat
+    message = update.message
+    target = message.reply_to_message
+    
+    if context.args:
+        try:
+            count = int(context.args[0])
+        except ValueError:
+            count = 0
+        if count <= 0:
+            await message.reply_text("⚠️ 用法: /purge (回复消息) 或 /purge <数量> (回复用户消息)")
+            return
+        mode = 'user'
+        target_user = target.from_user
+        message_ids = recent_messages.recent(chat.id, target_user.id, min(count, PURGE_MAX_MESSAGES))
+        if target.message_id not in message_ids:
+            message_ids.append(target.message_id)
+    else:
+        mode = 'range'
+        if message.message_id - target.message_id > PURGE_MAX_MESSAGES:
+            await message.reply_text(
+                f"⚠️ 一次最多清理 {PURGE_MAX_MESSAGES} 条消息，请回复更近的消息，或使用 /purge <数量> 清理指定用户的消息"
+            )
+            return
+        message_ids = list(range(target.message_id, message.message_id))
+    message_ids.append(message.message_id)
+    message_ids = sorted(set(message_ids))
+    total = len(message_ids)
+    
+    status = await context.bot.send_message(chat.id, f"🧹 正在清理 {total} 条消息...")
+    last_update = time.monotonic()
+    
+    async def report(processed: int, total: int):
+        nonlocal last_update
+        now = time.monotonic()
+        if processed >= total or now - last_update < PURGE_PROGRESS_INTERVAL:
+            return
+        last_update = now
+        try:
+            await status.edit_text(f"🧹 正在清理... {processed}/{total}")
+        except Exception as e:
+            logger.debug(f"更新清理进度失败: {e}")
+    
+    processed, failed = await bulk_delete(context.bot, chat.id, message_ids, progress=report)
+    if mode == 'user':
+        recent_messages.discard(chat.id, target_user.id, message_ids)
+    messages_purged_total.labels(mode).inc(processed - failed)
+    
+    result = f"✅ 已清理 {processed - failed} 条消息"
+    if failed:
+        result += f"，{failed} 条删除失败（超过48小时的消息无法删除）"
+    try:
+        await status.edit_text(result)
+    except Exception as e:
+        logger.debug(f"更新清理结果失败: {e}")
+    deletion_scheduler.schedule(chat.id, status.message_id, WARNING_DELETE_DELAY)
+    logger.info(f"用户 {update.effective_user.id} 在群组 {chat.id} 清理了 {processed - failed} 条消息（{mode}）")
+
+
 @safe_execute
 @require_admin
 @require_channel_or_group
@@ -294,8 +371,9 @@ async def get_user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     
     try:
-        # 获取用户在群组中的信息
+        # 获取用户在群组中的信息（状态需要实时查询，资料顺便更新缓存）
         member = await context.bot.get_chat_member(chat.id, target_user.id)
+        profiles.observe(member.user)
         
         info_text = f"""
 👤 用户信息
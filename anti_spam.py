@@ -1,135 +1,152 @@
 """
 反垃圾功能模块
-包含防刷屏、检测重复消息等功能
+包含防刷屏、检测重复消息、多账号刷群等功能
 """
 import time
+import asyncio
 import logging
-from collections import defaultdict, deque
 from telegram import Update, ChatPermissions
 from telegram.ext import ContextTypes
-from telegram.constants import ChatMemberStatus
-from database import db
-from config import FLOOD_LIMIT, FLOOD_WINDOW, FLOOD_POINTS_PENALTY, DUPLICATE_POINTS_PENALTY
+from database import adb
+from config import FLOOD_POINTS_PENALTY, DUPLICATE_POINTS_PENALTY, RAID_MUTE_DURATION, WARNING_DELETE_DELAY
 from utils_common import check_admin_permission
 from error_handler import safe_execute
+from fingerprint import duplicate_tracker, DuplicateVerdict
+from flood_tracker import flood_tracker
+from deletion_scheduler import deletion_scheduler
+from metrics import messages_deleted_total, raids_total
 
 logger = logging.getLogger(__name__)
 
-# 存储用户消息历史（用于检测刷屏和重复消息）
-# 格式: {(chat_id, user_id): deque([timestamp1, timestamp2, ...])}
-user_message_times = defaultdict(lambda: deque(maxlen=10))
-user_message_texts = defaultdict(lambda: deque(maxlen=5))  # 存储最近5条消息文本
+# 刷群账号的禁言权限
+RAID_PERMISSIONS = ChatPermissions(
+    can_send_messages=False,
+    can_send_audios=False,
+    can_send_documents=False,
+    can_send_photos=False,
+    can_send_videos=False,
+    can_send_video_notes=False,
+    can_send_voice_notes=False,
+    can_send_polls=False,
+    can_send_other_messages=False,
+    can_add_web_page_previews=False
+)
 
 
-async def anti_flood(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """防刷屏功能 - 限制消息频率"""
-    if not update.message or not update.effective_chat:
-        return
-    
-    chat = update.effective_chat
-    message = update.message
-    user = update.effective_user
-    
-    # 只处理群组消息（不包括频道和私聊）
-    if chat.type == 'private' or chat.type == 'channel':
-        return
-    
-    # 忽略管理员和机器人
-    if user.is_bot:
-        return
-    
-    try:
-        member = await context.bot.get_chat_member(chat.id, user.id)
-        if member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
-            return  # 管理员不受限制
-    except:
-        pass
-    
-    current_time = time.time()
-    key = (chat.id, user.id)
+async def flood_stage(ctx):
+    """防刷屏阶段 - 限制消息频率"""
+    if await ctx.is_admin():
+        return  # 管理员不受限制
     
-    # 获取用户最近的消息时间
-    message_times = user_message_times[key]
+    chat = ctx.chat
+    user = ctx.user
+    context = ctx.context
     
-    # 添加当前消息时间
-    message_times.append(current_time)
-    
-    # 检查是否在短时间内发送了太多消息
-    if len(message_times) >= FLOOD_LIMIT:
-        time_span = message_times[-1] - message_times[0]
-        if time_span < FLOOD_WINDOW:
-            try:
-                # 删除消息
-                await message.delete()
-                
-                # 警告用户
-                warning_msg = await context.bot.send_message(
-                    chat.id,
-                    f"⚠️ {user.mention_html()} 请勿刷屏！消息已删除。",
-                    parse_mode='HTML'
-                )
-                
-                # 扣除积分
-                db.subtract_points(chat.id, user.id, FLOOD_POINTS_PENALTY, "刷屏行为")
-                
-                # 5秒后删除警告消息
-                import asyncio
-                await asyncio.sleep(5)
-                try:
-                    await warning_msg.delete()
-                except:
-                    pass
-                
-                logger.info(f"检测到用户 {user.id} 在群组 {chat.id} 刷屏，已删除消息")
-            except Exception as e:
-                logger.error(f"防刷屏处理失败: {e}")
+    # 检查是否在短时间内发送了太多消息（刷屏状态由 flood_tracker 记录，过期自动清理）
+    if flood_tracker.record(chat.id, user.id):
+        try:
+            # 删除消息
+            if not await ctx.delete("刷屏"):
+                return
+            
+            # 警告用户
+            warning_msg = await context.bot.send_message(
+                chat.id,
+                f"⚠️ {user.mention_html()} 请勿刷屏！消息已删除。",
+                parse_mode='HTML'
+            )
+            
+            # 扣除积分（负载过高时跳过数据库写入）
+            if not ctx.shedding:
+                await adb.subtract_points(chat.id, user.id, FLOOD_POINTS_PENALTY, "刷屏行为")
+            
+            # 稍后删除警告消息（由调度器执行，不阻塞当前群组的后续消息）
+            deletion_scheduler.schedule(chat.id, warning_msg.message_id, WARNING_DELETE_DELAY)
+            
+            logger.info(f"检测到用户 {user.id} 在群组 {chat.id} 刷屏，已删除消息")
+        except Exception as e:
+            logger.error(f"防刷屏处理失败: {e}")
 
 
-async def detect_duplicate_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """检测并删除重复消息"""
-    if not update.message or not update.effective_chat:
-        return
+async def duplicate_stage(ctx):
+    """重复消息阶段 - 检测并删除重复消息"""
+    if await ctx.is_admin():
+        return  # 管理员不受限制
     
-    chat = update.effective_chat
-    message = update.message
-    user = update.effective_user
+    chat = ctx.chat
+    user = ctx.user
+    text = ctx.text.strip()
     
-    # 只处理群组消息（不包括频道和私聊）
-    if chat.type == 'private' or chat.type == 'channel':
+    if not text or len(text) < 10:  # 太短的消息不检测
         return
     
-    # 忽略管理员和机器人
-    if user.is_bot:
+    # 与本人最近的消息近似重复，或多个账号在群内发送相同内容（指纹比较，改几个字也能识别）
+    verdict = duplicate_tracker.check(chat.id, user.id, text, ctx.message.message_id)
+    if verdict is None:
         return
-    
     try:
-        member = await context.bot.get_chat_member(chat.id, user.id)
-        if member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
-            return  # 管理员不受限制
-    except:
-        pass
-    
-    text = (message.text or message.caption or "").strip()
-    
-    if not text or len(text) < 10:  # 太短的消息不检测
-        return
-    
-    key = (chat.id, user.id)
-    message_texts = user_message_texts[key]
-    
-    # 检查是否与最近的消息重复
-    if text in message_texts:
-        try:
-            # 删除重复消息
-            await message.delete()
-            
-            # 扣除积分
-            db.subtract_points(chat.id, user.id, DUPLICATE_POINTS_PENALTY, "发送重复消息")
+        # 删除重复消息（删除失败时不扣积分）
+        if await ctx.delete(verdict.reason):
+            # 扣除积分（负载过高时跳过数据库写入）
+            if not ctx.shedding:
+                await adb.subtract_points(chat.id, user.id, DUPLICATE_POINTS_PENALTY, "发送重复消息")
             
-            logger.info(f"检测到用户 {user.id} 在群组 {chat.id} 发送重复消息，已删除")
-        except Exception as e:
-            logger.error(f"删除重复消息失败: {e}")
-    else:
-        # 添加当前消息到历史记录
-        message_texts.append(text)
+            logger.info(f"检测到用户 {user.id} 在群组 {chat.id} 发送{verdict.reason}，已删除")
+    except Exception as e:
+        logger.error(f"删除重复消息失败: {e}")
+    
+    # 其他刷群账号的消息与当前消息是否删除成功无关，总是处理
+    if verdict.raid:
+        await punish_raid(ctx.context, chat.id, verdict)
+
+
+async def punish_raid(context: ContextTypes.DEFAULT_TYPE, chat_id: int, verdict: DuplicateVerdict):
+    """
+    处理刷群：删除各账号此前发送的相同内容，并禁言其中的新账号（RAID_MUTE_DURATION 为 0 时只删除）
+    
+    Args:
+        context: 上下文
+        chat_id: 群组ID
+        verdict: 刷群判定结果（restrict 为可以禁言的用户，messages 为需要删除的消息）
+    """
+    bot = context.bot
+    # 此前的消息交给调度器，在下一个间隔合并为批量删除
+    message_ids = [message_id for ids in verdict.messages.values() for message_id in ids]
+    if message_ids:
+        deletion_scheduler.schedule(chat_id, message_ids)
+        messages_deleted_total.labels(verdict.reason).inc(len(message_ids))
+    
+    restricted = verdict.restrict if RAID_MUTE_DURATION > 0 else []
+    if restricted:
+        until_date = time.time() + RAID_MUTE_DURATION
+        results = await asyncio.gather(
+            *(bot.restrict_chat_member(chat_id, user_id, permissions=RAID_PERMISSIONS, until_date=until_date)
+              for user_id in restricted),
+            return_exceptions=True
+        )
+        for user_id, result in zip(restricted, results):
+            if isinstance(result, Exception):
+                logger.error(f"禁言刷群用户 {user_id} 失败: {result}")
+    
+    if verdict.messages:
+        raids_total.inc()
+        logger.warning(
+            f"⚠️ 检测到群组 {chat_id} 被刷群: {len(verdict.senders)} 个账号发送相同内容，"
+            f"删除 {len(message_ids)} 条此前的消息，禁言 {len(restricted)} 个新账号"
+        )
+
 
+async def anti_flood(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """防刷屏功能 - 限制消息频率（单独注册时使用，默认由审核流水线调用 flood_stage）"""
+    from moderation_pipeline import MessageContext
+    ctx = MessageContext.from_update(update, context)
+    if ctx:
+        await flood_stage(ctx)
+
+
+async def detect_duplicate_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """检测并删除重复消息（单独注册时使用，默认由审核流水线调用 duplicate_stage）"""
+    from moderation_pipeline import MessageContext
+    ctx = MessageContext.from_update(update, context)
+    if ctx:
+        await duplicate_stage(ctx)
@@ -0,0 +1,280 @@
+"""
+Telegram API 请求调度模块
+所有发往 Telegram 的请求（通过 Application 的 rate_limiter 接入）在这里排队：
+- 全局预算（每秒请求数）和每个群组的发送预算（每分钟消息数），超出时排队等待，不再撞上 429
+- 按优先级放行：删除消息、封禁、禁言优先，欢迎消息等低优先级请求最后，排队过久直接放弃
+- 遇到 RetryAfter 时暂停该群组（或全局）的请求，等待后自动重试
+- 排队中或执行中的相同操作（重复删除同一条消息、重复封禁同一个用户）合并为一次请求
+"""
+import time
+import heapq
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+from telegram.error import RetryAfter, TimedOut
+from telegram.ext import BaseRateLimiter
+from rate_limiter import GCRALimiter
+from config import (
+    API_RATE_GLOBAL, API_RATE_PER_CHAT, API_MAX_RETRIES, API_LOW_PRIORITY_MAX_WAIT, SHARD_WORKERS
+)
+from metrics import metrics, api_queue_wait, api_retries_total, api_coalesced_total
+
+logger = logging.getLogger(__name__)
+
+# 优先级（数值越小越先执行）
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITY_NAMES = {PRIORITY_HIGH: 'high', PRIORITY_NORMAL: 'normal', PRIORITY_LOW: 'low'}
+
+# 审核操作默认高优先级，其余请求默认普通优先级（可用 rate_limit_args={'priority': ...} 指定）
+ENDPOINT_PRIORITY = {
+    'deleteMessage': PRIORITY_HIGH,
+    'deleteMessages': PRIORITY_HIGH,
+    'banChatMember': PRIORITY_HIGH,
+    'unbanChatMember': PRIORITY_HIGH,
+    'restrictChatMember': PRIORITY_HIGH,
+}
+
+# 计入群组发送预算的接口前缀（Telegram 限制每个群组每分钟发送的消息数）
+CHAT_LIMITED_PREFIXES = ('send', 'copy', 'forward')
+
+
+def coalesce_key(endpoint: str, data: Dict[str, Any]) -> Optional[tuple]:
+    """可合并的操作返回合并键（重复执行结果相同的操作），否则返回 None"""
+    chat_id = data.get('chat_id')
+    if endpoint == 'deleteMessage':
+        return endpoint, chat_id, data.get('message_id')
+    if endpoint in ('banChatMember', 'unbanChatMember'):
+        return endpoint, chat_id, data.get('user_id')
+    if endpoint == 'restrictChatMember':
+        permissions = data.get('permissions')
+        permissions = permissions.to_json() if hasattr(permissions, 'to_json') else repr(permissions)
+        return endpoint, chat_id, data.get('user_id'), permissions
+    return None
+
+
+class _QueuedRequest:
+    """排队中的请求（按优先级、先后顺序出队）"""
+    __slots__ = ('priority', 'sequence', 'chat_id', 'chat_limited', 'granted')
+    
+    def __init__(self, priority: int, sequence: int, chat_id: Optional[int], chat_limited: bool,
+                 granted: asyncio.Future):
+        self.priority = priority
+        self.sequence = sequence
+        self.chat_id = chat_id
+        self.chat_limited = chat_limited
+        self.granted = granted
+    
+    def __lt__(self, other: "_QueuedRequest") -> bool:
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class ApiScheduler(BaseRateLimiter):
+    """Telegram API 请求调度器"""
+    
+    def __init__(self, global_rate: float = API_RATE_GLOBAL, chat_rate: int = API_RATE_PER_CHAT,
+                 max_retries: int = API_MAX_RETRIES, low_priority_max_wait: float = API_LOW_PRIORITY_MAX_WAIT):
+        """
+        初始化调度器
+        
+        Args:
+            global_rate: 每秒最多发送的请求数，0 表示不限制（分片模式下由各工作进程平分）
+            chat_rate: 每个群组每分钟最多发送的消息数，0 表示不限制
+            max_retries: 遇到 RetryAfter 时最多重试次数
+            low_priority_max_wait: 低优先级请求最长排队时间（秒），0 表示不放弃
+        """
+        workers = max(1, SHARD_WORKERS)
+        self.global_rate = global_rate / workers if global_rate else 0
+        self._global = GCRALimiter(max(1, round(self.global_rate)) if self.global_rate else 0, 1)
+        self._chat = GCRALimiter(chat_rate, 60)
+        self.max_retries = max(0, max_retries)
+        self.low_priority_max_wait = low_priority_max_wait
+        
+        # 可以放行的请求（按优先级），以及因群组预算或暂停而延后的请求: (可放行时间, 请求)
+        self._queue: List[_QueuedRequest] = []
+        self._deferred: List[Tuple[float, _QueuedRequest]] = []
+        self._sequence = 0
+        # RetryAfter 暂停: 全局截止时间和各群组截止时间
+        self._paused_until = 0.0
+        self._chat_paused: Dict[int, float] = {}
+        # 排队中或执行中的可合并操作: {合并键: 结果}
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    async def initialize(self) -> None:
+        """启动放行循环（Bot 初始化时调用）"""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            logger.info(f"API 请求调度器已启动: 全局 {self.global_rate or '不限'}/秒, "
+                        f"每个群组 {self._chat.limit or '不限'}/分钟")
+    
+    async def shutdown(self) -> None:
+        """停止放行循环，剩余请求直接放行"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for item in self._queue + [item for _, item in self._deferred]:
+            if not item.granted.done():
+                item.granted.set_result(None)
+        self._queue.clear()
+        self._deferred.clear()
+    
+    def depth(self) -> Dict[int, int]:
+        """各优先级排队中的请求数"""
+        counts = {priority: 0 for priority in PRIORITY_NAMES}
+        for item in self._queue + [item for _, item in self._deferred]:
+            # 已放弃的请求在出队时才移除
+            if not item.granted.done():
+                counts[item.priority] += 1
+        return counts
+    
+    # ========== 放行 ==========
+    
+    def _chat_wait(self, item: _QueuedRequest, now: float) -> float:
+        """请求因所在群组的暂停或发送预算还需等待的秒数"""
+        if item.chat_id is None:
+            return 0.0
+        wait = self._chat_paused.get(item.chat_id, 0.0) - now
+        if item.chat_limited:
+            wait = max(wait, self._chat.retry_after(item.chat_id, now))
+        return wait
+    
+    async def _run(self):
+        """按优先级放行请求，受全局预算、群组预算和 RetryAfter 暂停限制"""
+        queue, deferred = self._queue, self._deferred
+        while True:
+            now = time.monotonic()
+            while deferred and deferred[0][0] <= now:
+                heapq.heappush(queue, heapq.heappop(deferred)[1])
+            
+            if not queue:
+                self._wakeup.clear()
+                timeout = deferred[0][0] - now if deferred else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            wait = max(self._paused_until - now, self._global.retry_after(None, now))
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            
+            item = heapq.heappop(queue)
+            if item.granted.done():
+                # 调用方已放弃（排队超时）
+                continue
+            wait = self._chat_wait(item, now)
+            if wait > 0:
+                heapq.heappush(deferred, (now + wait, item))
+                continue
+            
+            if item.chat_limited:
+                self._chat.consume(item.chat_id, now)
+            self._global.consume(None, now)
+            item.granted.set_result(None)
+    
+    async def _acquire(self, priority: int, chat_id: Optional[int], chat_limited: bool):
+        """排队等待放行"""
+        if self._task is None:
+            return
+        loop = asyncio.get_running_loop()
+        self._sequence += 1
+        item = _QueuedRequest(priority, self._sequence, chat_id, chat_limited, loop.create_future())
+        heapq.heappush(self._queue, item)
+        self._wakeup.set()
+        
+        start_time = time.perf_counter()
+        try:
+            if priority == PRIORITY_LOW and self.low_priority_max_wait > 0:
+                try:
+                    await asyncio.wait_for(item.granted, self.low_priority_max_wait)
+                except asyncio.TimeoutError:
+                    raise TimedOut(f"请求排队超过 {self.low_priority_max_wait} 秒，已放弃") from None
+            else:
+                await item.granted
+        finally:
+            api_queue_wait.labels(PRIORITY_NAMES[priority]).observe(time.perf_counter() - start_time)
+    
+    def _pause(self, chat_id: Optional[int], seconds: float):
+        """收到 RetryAfter 后暂停该群组（无群组时暂停全部）的请求"""
+        until = time.monotonic() + seconds
+        if chat_id is None:
+            self._paused_until = max(self._paused_until, until)
+        else:
+            self._chat_paused[chat_id] = max(self._chat_paused.get(chat_id, 0.0), until)
+            # 清理已过期的暂停记录
+            now = time.monotonic()
+            for key in [key for key, value in self._chat_paused.items() if value <= now]:
+                del self._chat_paused[key]
+    
+    # ========== 请求入口 ==========
+    
+    async def process_request(self, callback, args, kwargs, endpoint: str, data: Dict[str, Any],
+                              rate_limit_args: Optional[Dict[str, Any]]):
+        """排队、执行请求，遇到 RetryAfter 时暂停并重试；相同的操作合并执行"""
+        key = coalesce_key(endpoint, data)
+        if key is not None:
+            existing = self._inflight.get(key)
+            if existing is not None:
+                api_coalesced_total.labels(endpoint).inc()
+                return await asyncio.shield(existing)
+            future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        
+        try:
+            result = await self._execute(callback, args, kwargs, endpoint, data, rate_limit_args)
+        except BaseException as e:
+            if key is not None:
+                future.set_exception(e)
+                # 没有其他调用方等待时不记录“未获取的异常”
+                future.exception()
+            raise
+        else:
+            if key is not None:
+                future.set_result(result)
+            return result
+        finally:
+            if key is not None:
+                self._inflight.pop(key, None)
+    
+    async def _execute(self, callback, args, kwargs, endpoint: str, data: Dict[str, Any],
+                       rate_limit_args: Optional[Dict[str, Any]]):
+        priority = ENDPOINT_PRIORITY.get(endpoint, PRIORITY_NORMAL)
+        if isinstance(rate_limit_args, dict):
+            priority = rate_limit_args.get('priority', priority)
+        chat_id = data.get('chat_id')
+        if not isinstance(chat_id, int):
+            chat_id = None
+        # 只有群组消息受每分钟发送数限制（私聊的限制不同）
+        chat_limited = chat_id is not None and chat_id < 0 and endpoint.startswith(CHAT_LIMITED_PREFIXES)
+        
+        attempt = 0
+        while True:
+            await self._acquire(priority, chat_id, chat_limited)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                retry_after = float(getattr(e.retry_after, 'total_seconds', lambda: e.retry_after)())
+                api_retries_total.labels(endpoint).inc()
+                logger.warning(f"{endpoint} 触发速率限制，{retry_after:.0f} 秒后第 {attempt} 次重试")
+                self._pause(chat_id, retry_after)
+
+
+# 全局 API 请求调度器（在 Application 构建时通过 rate_limiter 接入）
+api_scheduler = ApiScheduler()
+
+metrics.gauge('api_queue_depth', '排队中的 Telegram API 请求数', lambda: {
+    (PRIORITY_NAMES[priority],): count for priority, count in api_scheduler.depth().items()
+}, ('priority',))
@@ -4,16 +4,20 @@
 """
 import re
 import logging
+from typing import List, Optional, Tuple
 from telegram import Update, ChatPermissions
 from telegram.ext import ContextTypes
-from telegram.constants import ChatMemberStatus
-from database import db
+from database import db, adb
+from points_buffer import points_buffer
 from config import (
     AUTO_DELETE_ADS, AUTO_WELCOME, NEW_MEMBER_BONUS,
-    AD_POINTS_PENALTY
+    AD_POINTS_PENALTY, AD_FILTER_CACHE_SIZE, AD_FILTER_CACHE_WEIGHT
 )
 from utils_common import check_admin_permission
 from error_handler import safe_execute
+from ad_classifier import AdClassifier
+from performance import get_cache
+from api_scheduler import PRIORITY_LOW
 
 logger = logging.getLogger(__name__)
 
@@ -37,115 +41,161 @@ AD_KEYWORDS = [
 ]
 
 
-def contains_ad_link(text: str) -> bool:
-    """检测消息是否包含广告链接"""
-    if not text:
-        return False
-    
-    text_lower = text.lower()
-    
-    # 检查链接模式
-    for pattern in AD_PATTERNS:
-        if re.search(pattern, text_lower):
-            return True
-    
-    return False
+# 预编译的广告识别器（链接正则 + 关键词自动机）
+ad_classifier = AdClassifier(AD_PATTERNS, AD_KEYWORDS)
+
+# 群组广告识别器缓存：没有自定义规则的群组共用 ad_classifier；按规则数计权重、LRU 淘汰，
+# 规则修改后由 invalidate_chat_classifier 删除，下次使用时重新构建
+classifier_cache = get_cache(
+    'ad_classifiers', default_timeout=None, max_size=AD_FILTER_CACHE_SIZE,
+    weigher=lambda chat_id, classifier: 1 if classifier is ad_classifier else classifier.size,
+    max_weight=AD_FILTER_CACHE_WEIGHT
+)
 
 
-def contains_ad_keywords(text: str) -> bool:
-    """检测消息是否包含广告关键词"""
-    if not text:
-        return False
+# 链接规则中的 * 最多匹配的字符数（不跨越空白和 /，保证匹配时间与消息长度成线性）
+LINK_FILTER_WILDCARD_MAX = 64
+
+
+def link_filter_error(value: str) -> Optional[str]:
+    """检查管理员添加的链接规则，有效时返回 None，否则返回原因"""
+    if value.startswith('re:'):
+        return "不再支持正则规则，请改用文本，可用一个 * 作为通配符"
+    if value.count('*') > 1:
+        return "每条规则最多一个 * 通配符"
+    if not value.replace('*', ''):
+        return "规则不能只有通配符"
+    return None
+
+
+def link_filter_pattern(value: str) -> Optional[str]:
+    """
+    把管理员添加的链接规则转为正则：按文本匹配（不区分大小写），* 匹配链接中不含 / 的一段文字
     
-    text_lower = text.lower()
+    Returns:
+        Optional[str]: 正则，无效规则（如旧版的 re: 正则规则）返回 None
+    """
+    if link_filter_error(value) is not None:
+        return None
+    prefix, wildcard, suffix = value.lower().partition('*')
+    if not wildcard:
+        return re.escape(prefix)
+    return f'{re.escape(prefix)}[^\\s/]{{0,{LINK_FILTER_WILDCARD_MAX}}}{re.escape(suffix)}'
+
+
+def _link_filter_patterns(values: List[str]) -> List[str]:
+    """转换链接规则，跳过无效规则"""
+    patterns = []
+    for value in values:
+        pattern = link_filter_pattern(value)
+        if pattern is None:
+            logger.warning(f"忽略无效的链接规则: {value}")
+            continue
+        patterns.append(pattern)
+    return patterns
+
+
+def build_chat_classifier(filters: List[Tuple[str, str, str]]) -> AdClassifier:
+    """
+    根据群组自定义规则构建识别器（默认规则 + 屏蔽名单，再排除放行名单）
     
-    # 检查关键词（至少匹配2个关键词才认为是广告）
-    matched_keywords = [keyword for keyword in AD_KEYWORDS if keyword in text_lower]
+    Args:
+        filters: [(list_type, kind, value), ...]，见 Database.get_ad_filters
+    """
+    if not filters:
+        return ad_classifier
     
-    # 如果包含链接且有关键词，认为是广告
-    if contains_ad_link(text) and len(matched_keywords) > 0:
-        return True
+    lists = {(list_type, kind): [] for list_type in ('block', 'allow') for kind in ('keyword', 'link')}
+    for list_type, kind, value in filters:
+        lists.setdefault((list_type, kind), []).append(value)
     
-    # 如果匹配多个关键词，认为是广告
-    if len(matched_keywords) >= 2:
+    return AdClassifier(
+        AD_PATTERNS, AD_KEYWORDS + lists[('block', 'keyword')],
+        block_links=_link_filter_patterns(lists[('block', 'link')]),
+        allow_links=_link_filter_patterns(lists[('allow', 'link')]),
+        allow_keywords=lists[('allow', 'keyword')]
+    )
+
+
+async def get_chat_classifier(chat_id: int) -> AdClassifier:
+    """获取群组的广告识别器（带缓存，规则修改后需调用 invalidate_chat_classifier）"""
+    classifier = classifier_cache.get(chat_id)
+    if classifier is None:
+        classifier = build_chat_classifier(await adb.get_ad_filters(chat_id))
+        classifier_cache.set(chat_id, classifier)
+    return classifier
+
+
+def invalidate_chat_classifier(chat_id: int):
+    """群组广告规则修改后清除缓存的识别器"""
+    classifier_cache.delete(chat_id)
+
+
+def contains_ad_link(text: str) -> bool:
+    """检测消息是否包含广告链接"""
+    return bool(ad_classifier.find_links(text))
+
+
+def contains_ad_keywords(text: str) -> bool:
+    """检测消息是否包含广告关键词（有链接且有关键词，或匹配至少2个关键词）"""
+    verdict = ad_classifier.classify(text)
+    if verdict.links and verdict.keywords:
         return True
-    
-    return False
+    return len(verdict.keywords) >= 2
 
 
-async def auto_delete_ads(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """自动删除广告消息"""
-    if not update.message or not update.effective_chat:
-        return
-    
-    chat = update.effective_chat
-    message = update.message
-    user = update.effective_user
-    
-    # 只处理群组消息（不包括频道和私聊）
-    if chat.type == 'private' or chat.type == 'channel':
-        return
+async def ad_stage(ctx):
+    """广告检测阶段 - 自动删除广告消息"""
+    chat = ctx.chat
+    user = ctx.user
     
     # 检查是否启用自动删除广告（全局配置和群组配置）
-    if not AUTO_DELETE_ADS or not db.is_auto_delete_ads_enabled(chat.id):
-        return
-    
-    # 忽略管理员和机器人
-    if user.is_bot:
+    if not AUTO_DELETE_ADS or not (await ctx.settings())['auto_delete_ads']:
         return
     
-    try:
-        member = await context.bot.get_chat_member(chat.id, user.id)
-        if member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
-            return  # 管理员消息不删除
-    except:
-        pass
+    if await ctx.is_admin():
+        return  # 管理员消息不删除
     
-    # 检查消息文本
-    text = message.text or message.caption or ""
-    
-    # 检测广告
-    is_ad = False
-    reason = ""
-    
-    if contains_ad_link(text):
-        is_ad = True
-        reason = "检测到广告链接"
-    elif contains_ad_keywords(text):
-        is_ad = True
-        reason = "检测到广告关键词"
+    # 检测广告（使用本群规则；链接取自消息实体，一次识别得到链接、账号、关键词和判定结果）
+    classifier = await get_chat_classifier(chat.id)
+    verdict = classifier.classify_message(ctx.message)
+    reason = verdict.reason
     
     # 如果检测到广告，删除消息并警告
-    if is_ad:
+    if verdict.is_ad:
         try:
             # 删除消息
-            await message.delete()
+            if not await ctx.delete(reason):
+                return
             
-            # 扣除积分（如果用户有积分）
-            current_points = db.get_user_points(chat.id, user.id)
+            # 扣除积分（如果用户有积分；负载过高时跳过数据库访问）
+            current_points = 0 if ctx.shedding else await points_buffer.get_user_points(chat.id, user.id)
             if current_points > 0:
                 points_deducted = min(AD_POINTS_PENALTY, current_points)
-                db.subtract_points(chat.id, user.id, points_deducted, "发送广告")
+                await adb.subtract_points(chat.id, user.id, points_deducted, "发送广告")
             
             # 发送警告消息（可选，可以注释掉避免刷屏）
-            # warning_msg = await context.bot.send_message(
+            # warning_msg = await ctx.context.bot.send_message(
             #     chat.id,
             #     f"⚠️ 已删除 {user.mention_html()} 的广告消息\n原因: {reason}",
             #     parse_mode='HTML'
             # )
-            # # 5秒后删除警告消息
-            # import asyncio
-            # await asyncio.sleep(5)
-            # try:
-            #     await warning_msg.delete()
-            # except:
-            #     pass
+            # # 稍后删除警告消息
+            # deletion_scheduler.schedule(chat.id, warning_msg.message_id, WARNING_DELETE_DELAY)
             
             logger.info(f"自动删除用户 {user.id} 在群组 {chat.id} 的广告消息: {reason}")
         except Exception as e:
             logger.error(f"删除广告消息失败: {e}")
 
 
+async def auto_delete_ads(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """自动删除广告消息（单独注册时使用，默认由审核流水线调用 ad_stage）"""
+    from moderation_pipeline import MessageContext
+    ctx = MessageContext.from_update(update, context)
+    if ctx:
+        await ad_stage(ctx)
+
+
 async def welcome_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """欢迎新成员"""
     if not update.message or not update.effective_chat:
@@ -166,11 +216,11 @@ async def welcome_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE)
             
             try:
                 # 检查是否启用欢迎消息
-                if not db.is_welcome_enabled(chat.id):
+                if not await adb.is_welcome_enabled(chat.id):
                     return
                 
                 # 获取欢迎消息（从数据库或使用默认）
-                welcome_text = db.get_welcome_message(chat.id)
+                welcome_text = await adb.get_welcome_message(chat.id)
                 
                 if not welcome_text:
                     # 默认欢迎消息
@@ -189,16 +239,17 @@ async def welcome_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 welcome_text = welcome_text.replace('{first_name}', new_member.first_name or '新成员')
                 welcome_text = welcome_text.replace('{chat_title}', chat.title or '本群')
                 
-                # 发送欢迎消息
+                # 给新成员初始积分
+                await adb.add_points(chat.id, new_member.id, NEW_MEMBER_BONUS, "新成员加入奖励")
+                
+                # 发送欢迎消息（低优先级，负载高时排在审核操作之后，排队过久则放弃）
                 await context.bot.send_message(
                     chat.id,
                     welcome_text,
-                    parse_mode='HTML'
+                    parse_mode='HTML',
+                    rate_limit_args={'priority': PRIORITY_LOW}
                 )
                 
-                # 给新成员初始积分
-                db.add_points(chat.id, new_member.id, NEW_MEMBER_BONUS, "新成员加入奖励")
-                
                 logger.info(f"欢迎新成员 {new_member.id} 加入群组 {chat.id}")
             except Exception as e:
                 logger.error(f"欢迎新成员失败: {e}")
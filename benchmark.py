@@ -0,0 +1,441 @@
+"""
+基准测试
+构造模拟更新（多个群组和用户，混合普通消息、广告、刷屏、重复消息、新成员和命令），
+交给 create_application 注册的真实处理器处理。Bot 请求由记录调用的模拟请求返回（延迟可配置），
+数据库使用临时 SQLite 文件。
+
+输出吞吐量、CPU 时间、各处理器 p50/p99 延迟、SQL 语句数和 API 调用数，
+并与 benchmarks/ 下的基线文件比较，database.py / anti_spam.py / auto_moderation.py 等的性能变化会直接体现为数字。
+
+用法:
+    python benchmark.py                          # 运行并与 benchmarks/baseline.json 比较
+    python benchmark.py --save                   # 运行并保存为基线
+    python benchmark.py --updates 5000 --check   # 超出容差时返回非零退出码（可用于 CI）
+"""
+import os
+import sys
+import re
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import functools
+import itertools
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+
+BOT_ID = 999000001
+ADMIN_ID = 1000
+
+# 调用次数少于此值的处理器，p99 只作参考不判定退化（样本太少，抖动很大）
+MIN_P99_SAMPLES = 100
+
+# 模拟消息文本
+NORMAL_TEXTS = [
+    '大家早上好', '今天的更新看了吗？', '哈哈哈哈', '这个问题我也遇到过，重启一下就好了',
+    '有人知道怎么配置吗', '感谢分享！', '晚上一起开黑吗', '这个版本的改动挺大的，大家注意一下兼容性',
+    'ok', '收到', '周末有活动吗？', '刚看到群公告，已经按要求修改了昵称',
+]
+AD_TEXTS = [
+    '加微信领取优惠，代购正品 https://t.me/joinchat/abcdef',
+    '兼职刷单日结，私聊我',
+    '低息贷款 信用卡套现 联系我',
+    '进群领福利 https://t.me/+XyZ123abc',
+    '博彩彩票 投注稳赚 加QQ',
+]
+DUPLICATE_TEXT = '这条消息我再发一遍看看有没有人回复'
+URL_REGEX = re.compile(r'https?://\S+')
+COMMANDS = ['/points', '/top', '/rules', '/getwelcome', '/settings', '/stats', '/id']
+
+
+class StatementCounter:
+    """SQLite 语句计数（通过 set_trace_callback 统计每个连接执行的语句）"""
+    
+    def __init__(self):
+        self.counts: Counter = Counter()
+        self.enabled = False
+        self._lock = threading.Lock()
+    
+    def __call__(self, statement: str):
+        if not self.enabled:
+            return
+        words = statement.split(None, 1)
+        kind = words[0].upper() if words else '?'
+        with self._lock:
+            self.counts[kind] += 1
+    
+    def install(self):
+        """替换 sqlite3.connect，使之后创建的连接都带上计数回调（需在导入 database 之前调用）"""
+        original_connect = sqlite3.connect
+        
+        @functools.wraps(original_connect)
+        def connect(*args, **kwargs):
+            conn = original_connect(*args, **kwargs)
+            conn.set_trace_callback(self)
+            return conn
+        
+        sqlite3.connect = connect
+    
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+
+
+def _user(user_id: int, is_bot: bool = False) -> dict:
+    return {'id': user_id, 'is_bot': is_bot, 'first_name': f'用户{user_id}', 'username': f'user{user_id}'}
+
+
+def make_stub_request(latency: float):
+    """创建模拟请求：记录每个 API 方法的调用次数，按方法返回最小可用的结果"""
+    from telegram.request import BaseRequest
+    
+    class StubRequest(BaseRequest):
+        
+        def __init__(self):
+            self.latency = latency
+            self.calls: Counter = Counter()
+            self._message_ids = itertools.count(10_000_000)
+        
+        @property
+        def read_timeout(self) -> Optional[float]:
+            return None
+        
+        async def initialize(self):
+            pass
+        
+        async def shutdown(self):
+            pass
+        
+        async def do_request(self, url, method, request_data=None, read_timeout=None,
+                             write_timeout=None, connect_timeout=None, pool_timeout=None):
+            api_method = url.rsplit('/', 1)[-1]
+            params = request_data.parameters if request_data else {}
+            self.calls[api_method] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            payload = {'ok': True, 'result': self._result(api_method, params)}
+            return 200, json.dumps(payload).encode('utf-8')
+        
+        def _result(self, api_method: str, params: dict):
+            chat_id = params.get('chat_id', 0)
+            if api_method == 'getMe':
+                return {**_user(BOT_ID, is_bot=True), 'can_join_groups': True}
+            if api_method in ('sendMessage', 'editMessageText'):
+                return {
+                    'message_id': next(self._message_ids), 'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'群组{chat_id}'},
+                    'from': _user(BOT_ID, is_bot=True), 'text': params.get('text', ''),
+                }
+            if api_method == 'getChatAdministrators':
+                return [{'status': 'creator', 'user': _user(ADMIN_ID), 'is_anonymous': False}]
+            if api_method == 'getChatMember':
+                user_id = params.get('user_id', 0)
+                if user_id == ADMIN_ID:
+                    return {'status': 'creator', 'user': _user(ADMIN_ID), 'is_anonymous': False}
+                return {'status': 'member', 'user': _user(user_id, is_bot=user_id == BOT_ID)}
+            if api_method == 'getChat':
+                return {'id': chat_id, 'type': 'supergroup', 'title': f'群组{chat_id}'}
+            if api_method == 'getChatMemberCount':
+                return 100
+            return True
+    
+    return StubRequest()
+
+
+class UpdateFactory:
+    """生成模拟更新的 JSON 数据（同一种子生成的序列完全相同）"""
+    
+    def __init__(self, seed: int, chats: int, users_per_chat: int):
+        self.random = random.Random(seed)
+        self.chat_ids = [-1001000000000 - index for index in range(chats)]
+        self.users_per_chat = users_per_chat
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._joined = itertools.count(5_000_000)
+    
+    def _member(self, chat_id: int) -> int:
+        return 100_000 + (-chat_id % 1000) * 1000 + self.random.randrange(self.users_per_chat)
+    
+    def _message(self, chat_id: int, user_id: int, **fields) -> dict:
+        message = {
+            'message_id': next(self._message_ids), 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'群组{chat_id}'},
+            'from': _user(user_id),
+        }
+        message.update(fields)
+        return {'update_id': next(self._update_ids), 'message': message}
+    
+    def _text(self, chat_id: int, user_id: int, text: str) -> dict:
+        # 与 Telegram 一样为文本中的链接附带 url 实体（模拟文本都在 BMP 内，偏移量与 UTF-16 一致）
+        entities = [{'type': 'url', 'offset': match.start(), 'length': len(match.group(0))}
+                    for match in URL_REGEX.finditer(text)]
+        if entities:
+            return self._message(chat_id, user_id, text=text, entities=entities)
+        return self._message(chat_id, user_id, text=text)
+    
+    def _command(self, chat_id: int, user_id: int, command: str) -> dict:
+        return self._message(chat_id, user_id, text=command,
+                             entities=[{'type': 'bot_command', 'offset': 0, 'length': len(command.split()[0])}])
+    
+    def generate(self, count: int) -> List[dict]:
+        """按比例生成事件（刷屏和重复消息一次生成多条），返回恰好 count 条更新"""
+        updates = []
+        while len(updates) < count:
+            chat_id = self.random.choice(self.chat_ids)
+            user_id = self._member(chat_id)
+            roll = self.random.random()
+            if roll < 0.68:
+                updates.append(self._text(chat_id, user_id, self.random.choice(NORMAL_TEXTS)))
+            elif roll < 0.76:
+                updates.append(self._text(chat_id, user_id, self.random.choice(AD_TEXTS)))
+            elif roll < 0.80:
+                # 刷屏：同一用户连续发送多条消息
+                for _ in range(self.random.randint(6, 10)):
+                    updates.append(self._text(chat_id, user_id, self.random.choice(NORMAL_TEXTS)))
+            elif roll < 0.84:
+                for _ in range(2):
+                    updates.append(self._text(chat_id, user_id, DUPLICATE_TEXT))
+            elif roll < 0.89:
+                members = [_user(next(self._joined)) for _ in range(self.random.randint(1, 3))]
+                updates.append(self._message(chat_id, user_id, new_chat_members=members))
+            elif roll < 0.97:
+                updates.append(self._command(chat_id, user_id, self.random.choice(COMMANDS)))
+            else:
+                # 管理员发言（走管理员豁免路径）
+                updates.append(self._text(chat_id, ADMIN_ID, self.random.choice(NORMAL_TEXTS + AD_TEXTS)))
+        return updates[:count]
+
+
+def _percentile(samples: List[float], percent: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def _timed(name: str, callback, samples: Dict[str, List[float]]):
+    """包装处理器回调，记录每次执行时间"""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start_time = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            samples[name].append(time.perf_counter() - start_time)
+    return wrapper
+
+
+async def run_benchmark(args, statements: StatementCounter) -> dict:
+    """运行一次基准测试，返回结果"""
+    from telegram import Update
+    import bot as bot_module
+    
+    stub = make_stub_request(args.api_latency)
+    # create_application 使用模块中的 InstrumentedRequest 创建请求对象，这里替换为模拟请求
+    bot_module.InstrumentedRequest = lambda **kwargs: stub
+    application = bot_module.create_application(with_updater=False)
+    
+    samples: Dict[str, List[float]] = defaultdict(list)
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            name = getattr(handler.callback, '__name__', type(handler).__name__)
+            handler.callback = _timed(name, handler.callback, samples)
+    
+    raw_updates = UpdateFactory(args.seed, args.chats, args.users).generate(args.updates)
+    
+    async with application:
+        updates = [Update.de_json(data, application.bot) for data in raw_updates]
+        await bot_module.post_init(application)
+        await application.start()
+        
+        stub.calls.clear()
+        statements.reset()
+        statements.enabled = True
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        
+        for update in updates:
+            await application.update_queue.put(update)
+        # 先等待队列取空（非阻塞处理器的任务需在运行期间创建才会被跟踪），
+        # 再由 stop 等待所有处理任务完成
+        await application.update_queue.join()
+        await application.stop()
+        elapsed = time.perf_counter() - wall_start
+        
+        # 关闭时写入缓冲中的积分，这部分数据库写入也计入统计
+        await bot_module.post_shutdown(application)
+        cpu_time = time.process_time() - cpu_start
+        statements.enabled = False
+    
+    handlers = {}
+    for name, values in sorted(samples.items()):
+        handlers[name] = {
+            'calls': len(values),
+            'p50_ms': round(_percentile(values, 50) * 1000, 3),
+            'p99_ms': round(_percentile(values, 99) * 1000, 3),
+        }
+    
+    return {
+        'params': {
+            'updates': args.updates, 'seed': args.seed, 'chats': args.chats,
+            'users': args.users, 'api_latency': args.api_latency, 'lanes': args.lanes,
+        },
+        'throughput': round(args.updates / elapsed, 1),
+        'elapsed_s': round(elapsed, 3),
+        'cpu_ms_per_update': round(cpu_time * 1000 / args.updates, 4),
+        'handlers': handlers,
+        'db_statements': dict(sorted(statements.counts.items())),
+        'db_statements_total': sum(statements.counts.values()),
+        'api_calls': dict(sorted(stub.calls.items())),
+        'api_calls_total': sum(stub.calls.values()),
+    }
+
+
+def print_report(result: dict):
+    """打印结果"""
+    print(f"\n更新数: {result['params']['updates']}  耗时: {result['elapsed_s']}s  "
+          f"吞吐量: {result['throughput']} 条/秒  CPU: {result['cpu_ms_per_update']} ms/条")
+    
+    print(f"\n{'处理器':<28}{'调用':>8}{'p50(ms)':>12}{'p99(ms)':>12}")
+    for name, stats in result['handlers'].items():
+        print(f"{name:<28}{stats['calls']:>8}{stats['p50_ms']:>12}{stats['p99_ms']:>12}")
+    
+    print(f"\nSQL 语句: {result['db_statements_total']}  " +
+          ' '.join(f"{kind}={count}" for kind, count in result['db_statements'].items()))
+    print(f"API 调用: {result['api_calls_total']}  " +
+          ' '.join(f"{method}={count}" for method, count in result['api_calls'].items()))
+
+
+def _flatten(result: dict) -> Dict[str, float]:
+    """展开为 {指标名: 数值}，用于与基线比较"""
+    flat = {
+        'throughput': result['throughput'],
+        'cpu_ms_per_update': result['cpu_ms_per_update'],
+        'db_statements_total': result['db_statements_total'],
+        'api_calls_total': result['api_calls_total'],
+    }
+    for name, stats in result['handlers'].items():
+        flat[f'handler.{name}.calls'] = stats['calls']
+        flat[f'handler.{name}.p50_ms'] = stats['p50_ms']
+        flat[f'handler.{name}.p99_ms'] = stats['p99_ms']
+    for kind, count in result['db_statements'].items():
+        flat[f'db.{kind}'] = count
+    for method, count in result['api_calls'].items():
+        flat[f'api.{method}'] = count
+    return flat
+
+
+def compare(result: dict, baseline: dict, tolerance: float, count_tolerance: float) -> List[str]:
+    """
+    与基线比较并打印差异
+    
+    Args:
+        tolerance: 时间类指标允许的相对变化（如 0.25 表示 25%）
+        count_tolerance: SQL 语句数和 API 调用数允许的相对变化
+    
+    Returns:
+        超出容差的指标列表
+    """
+    if baseline.get('params') != result['params']:
+        print(f"\n⚠️ 基线参数不同，比较结果仅供参考: {baseline.get('params')}")
+    
+    current, previous = _flatten(result), _flatten(baseline)
+    regressions = []
+    print(f"\n{'指标':<40}{'基线':>12}{'当前':>12}{'变化':>10}")
+    for key in sorted(set(current) | set(previous)):
+        old, new = previous.get(key, 0), current.get(key, 0)
+        change = (new - old) / old if old else (1.0 if new else 0.0)
+        # 吞吐量越高越好，其余指标越低越好
+        worse = -change if key == 'throughput' else change
+        is_count = key.startswith(('db', 'api')) or key.endswith('.calls')
+        limit = count_tolerance if is_count else tolerance
+        # 很小的时间值抖动较大，低于 0.05ms 的延迟不判定为退化
+        if key.endswith('_ms') and max(old, new) < 0.05:
+            worse = 0
+        if key.endswith('.p99_ms'):
+            calls_key = key[:-len('p99_ms')] + 'calls'
+            if min(current.get(calls_key, 0), previous.get(calls_key, 0)) < MIN_P99_SAMPLES:
+                worse = 0
+        flag = ''
+        if worse > limit:
+            flag = ' ❌'
+            regressions.append(key)
+        elif worse < -limit:
+            flag = ' ✅'
+        print(f"{key:<40}{old:>12}{new:>12}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='处理器基准测试')
+    parser.add_argument('--updates', type=int, default=3000, help='更新数量')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子')
+    parser.add_argument('--chats', type=int, default=20, help='群组数量')
+    parser.add_argument('--users', type=int, default=50, help='每个群组的用户数')
+    parser.add_argument('--api-latency', type=float, default=0.005, help='模拟 API 延迟（秒）')
+    parser.add_argument('--lanes', type=int, default=0, help='分发通道数（DISPATCHER_LANES，0 为 PTB 默认处理方式）')
+    parser.add_argument('--baseline', default='baseline', help='基线名称（benchmarks/<名称>.json）')
+    parser.add_argument('--save', action='store_true', help='把本次结果保存为基线')
+    parser.add_argument('--check', action='store_true', help='有指标超出容差时返回非零退出码')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='时间类指标的容差')
+    parser.add_argument('--count-tolerance', type=float, default=0.05, help='SQL/API 调用数的容差')
+    args = parser.parse_args()
+    
+    tmpdir = tempfile.TemporaryDirectory(prefix='bot-bench-')
+    # 配置在导入时读取，必须在导入机器人模块之前设置
+    os.environ.setdefault('BOT_TOKEN', f'{BOT_ID}:benchmark')
+    os.environ['DB_PATH'] = os.path.join(tmpdir.name, 'bench.db')
+    os.environ['DISPATCHER_LANES'] = str(args.lanes)
+    os.environ['SHARD_WORKERS'] = '0'
+    os.environ['METRICS_PORT'] = '0'
+    # 普通消息取自很小的固定文本池，群内所有用户都会发同样的话；刷群阈值设为超过群组人数，
+    # 只测量指纹索引的开销，不把正常聊天当成刷群
+    os.environ.setdefault('RAID_SENDER_THRESHOLD', str(args.users + 1))
+    # 桩请求没有 Telegram 的速率限制，只测量 API 调度队列本身的开销
+    os.environ.setdefault('API_RATE_GLOBAL', '0')
+    os.environ.setdefault('API_RATE_PER_CHAT', '0')
+    os.environ['LOG_FILE'] = ''
+    os.environ.setdefault('LOG_LEVEL', 'CRITICAL')
+    
+    statements = StatementCounter()
+    statements.install()
+    
+    try:
+        result = asyncio.run(run_benchmark(args, statements))
+    finally:
+        tmpdir.cleanup()
+    
+    print_report(result)
+    
+    baseline_path = os.path.join(BASELINE_DIR, f'{args.baseline}.json')
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f"\n✅ 已保存基线: {baseline_path}")
+        return
+    
+    if not os.path.exists(baseline_path):
+        print(f"\n未找到基线 {baseline_path}，使用 --save 保存")
+        return
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare(result, baseline, args.tolerance, args.count_tolerance)
+    if regressions:
+        print(f"\n❌ {len(regressions)} 项指标超出容差: {', '.join(regressions)}")
+        if args.check:
+            sys.exit(1)
+    else:
+        print("\n✅ 没有指标超出容差")
+
+
+if __name__ == '__main__':
+    main()
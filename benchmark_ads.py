@@ -0,0 +1,113 @@
+"""
+广告识别微基准
+比较 ad_classifier 与原先的逐条正则 + 关键词循环实现（下面保留了原实现的副本），
+并检查两者判定结果是否一致
+
+用法:
+    python benchmark_ads.py [--messages 20000] [--seed 42]
+"""
+import re
+import time
+import random
+import argparse
+from typing import Callable, List, Tuple
+from ad_classifier import AdClassifier
+from auto_moderation import AD_PATTERNS, AD_KEYWORDS
+
+URL_REGEX = re.compile(r'https?://\S+')
+
+SAMPLE_TEXTS = [
+    '大家早上好', 'ok', '收到', '这个问题我也遇到过，重启一下就好了',
+    '今天的版本更新说明在这里 https://github.com/python-telegram-bot/python-telegram-bot',
+    '有没有人知道周末的活动几点开始？我想带朋友一起来参加，顺便问一下要不要提前报名',
+    '加微信领取优惠，代购正品 https://t.me/joinchat/abcdef',
+    '兼职刷单日结，私聊我', '低息贷款 信用卡套现 联系我', '进群领福利 https://t.me/+XyZ123abc',
+    '博彩彩票 投注稳赚 加QQ', '看看这个频道 https://t.me/c/123456/789',
+    '这是一段很长的普通聊天内容，' * 20,
+]
+
+
+def legacy_contains_ad_link(text: str) -> bool:
+    """原实现：每次调用逐条 re.search 未编译的正则"""
+    if not text:
+        return False
+    text_lower = text.lower()
+    for pattern in AD_PATTERNS:
+        if re.search(pattern, text_lower):
+            return True
+    return False
+
+
+def legacy_contains_ad_keywords(text: str) -> bool:
+    """原实现：逐个关键词做子串查找，再调用一次链接检测"""
+    if not text:
+        return False
+    text_lower = text.lower()
+    matched_keywords = [keyword for keyword in AD_KEYWORDS if keyword in text_lower]
+    if legacy_contains_ad_link(text) and len(matched_keywords) > 0:
+        return True
+    if len(matched_keywords) >= 2:
+        return True
+    return False
+
+
+def legacy_classify(text: str) -> Tuple[bool, str]:
+    """原 auto_delete_ads 的判定流程"""
+    if legacy_contains_ad_link(text):
+        return True, "检测到广告链接"
+    if legacy_contains_ad_keywords(text):
+        return True, "检测到广告关键词"
+    return False, ""
+
+
+def make_messages(count: int, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    return [rng.choice(SAMPLE_TEXTS) + str(rng.randrange(1000)) for _ in range(count)]
+
+
+def measure(func: Callable[[str], object], messages: List[str], rounds: int = 5) -> float:
+    """返回每条消息的最短平均耗时（微秒）"""
+    best = float('inf')
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        for text in messages:
+            func(text)
+        best = min(best, time.perf_counter() - start_time)
+    return best / len(messages) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='广告识别微基准')
+    parser.add_argument('--messages', type=int, default=20000, help='消息数量')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子')
+    args = parser.parse_args()
+    
+    messages = make_messages(args.messages, args.seed)
+    
+    start_time = time.perf_counter()
+    classifier = AdClassifier(AD_PATTERNS, AD_KEYWORDS)
+    build_time = (time.perf_counter() - start_time) * 1000
+    
+    # 判定结果对比（原实现把关键词与小写文本比较，含大写字母的关键词如“加QQ”永远不会命中）
+    differences = [
+        text for text in set(messages)
+        if legacy_classify(text) != (classifier.classify(text).is_ad, classifier.classify(text).reason)
+    ]
+    
+    legacy = measure(legacy_classify, messages)
+    compiled = measure(classifier.classify, messages)
+    # 模拟 Telegram 附带的 url 实体：链接直接取自实体，不再用正则扫描文本
+    entity_urls = {text: URL_REGEX.findall(text) for text in set(messages)}
+    with_entities = measure(lambda text: classifier.classify(text, entity_urls[text]), messages)
+    
+    print(f"消息数: {len(messages)}  识别器构建: {build_time:.2f} ms")
+    print(f"原实现:   {legacy:8.2f} µs/条")
+    print(f"预编译:   {compiled:8.2f} µs/条  ({legacy / compiled:.1f}x)")
+    print(f"使用实体: {with_entities:8.2f} µs/条  ({legacy / with_entities:.1f}x)")
+    print(f"判定不同的文本: {len(differences)}")
+    for text in sorted(differences)[:5]:
+        print(f"  {text[:40]!r}: 原实现={legacy_classify(text)} 现实现={classifier.classify(text)!r}")
+
+
+if __name__ == '__main__':
+    main()
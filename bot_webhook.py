@@ -4,29 +4,40 @@ Telegram 群管机器人 - Webhook 版本
 """
 import logging
 import os
+import signal
+import asyncio
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from config import BOT_TOKEN, MAX_WARN_LIMIT, LOG_LEVEL, LOG_FILE
+from telegram.ext import Application, CommandHandler, MessageHandler, TypeHandler, ChatMemberHandler, filters, ContextTypes
+from config import BOT_TOKEN, MAX_WARN_LIMIT, LOG_LEVEL, LOG_FILE, SHARD_WORKERS, METRICS_HOST, METRICS_PORT
 from admin_commands import (
     ban_user, unban_user, mute_user, unmute_user,
-    warn_user, delete_message, get_user_info, unwarn_user, get_warnings
+    warn_user, delete_message, purge_messages, get_user_info, unwarn_user, get_warnings
 )
 from points_system import (
     my_points, points_leaderboard, add_points_command,
-    remove_points_command, set_points_command,
-    handle_message_points
-)
-from auto_moderation import (
-    auto_delete_ads, welcome_new_member
+    remove_points_command, set_points_command
 )
+from auto_moderation import welcome_new_member
 from chat_settings import (
     set_welcome, get_welcome, set_rules, get_rules,
-    toggle_auto_delete_ads, toggle_welcome, chat_settings
-)
-from anti_spam import (
-    anti_flood, detect_duplicate_messages
+    toggle_auto_delete_ads, toggle_welcome, chat_settings,
+    pipeline_stages, toggle_stage,
+    block_keywords, allow_keywords, block_links, allow_links,
+    remove_ad_filters, list_ad_filters
 )
 from statistics import group_stats
+from moderation_pipeline import pipeline
+from dispatcher import dispatcher
+from metrics import track_updates, InstrumentedRequest
+from performance import instrument_handlers
+from web_server import WebServer, add_webhook_route
+from database import adb
+from points_buffer import points_buffer
+from profiles import profiles, track_profiles
+from recent_messages import track_recent_messages
+from deletion_scheduler import deletion_scheduler
+from api_scheduler import api_scheduler
+from utils_common import track_admin_changes
 from utils import get_id, group_info, admins_list
 from channel_management import (
     pin_message, unpin_message
@@ -51,6 +62,15 @@ logger = logging.getLogger(__name__)
 WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
 PORT = int(os.getenv('PORT', 8000))
 WEBHOOK_PATH = '/webhook'  # Webhook 路径
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # Webhook 校验令牌（可选）
+
+# HTTP 服务：Webhook 模式下接收更新并提供 /metrics，Polling 模式下只提供 /metrics
+if WEBHOOK_URL:
+    web_server = WebServer("0.0.0.0", PORT)
+elif METRICS_PORT > 0:
+    web_server = WebServer(METRICS_HOST, METRICS_PORT)
+else:
+    web_server = None
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -91,6 +111,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /unwarn - 清除警告
 /warns - 查看警告次数
 /del - 删除消息
+/purge - 批量清理消息
 /info - 查看用户信息
 
 💰 积分命令：
@@ -111,6 +132,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /setrules <规则> - 设置群规
 /rules - 查看群规
 /settings - 查看群组设置
+/stages - 查看消息审核阶段
+/adfilters - 查看本群广告规则
 
 /help - 显示详细帮助
         """
@@ -161,6 +184,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • /unwarn - 清除用户所有警告（回复用户消息）
 • /warns - 查看用户警告次数（回复用户消息）
 • /del - 删除消息（回复消息）
+• /purge [数量] - 批量清理消息（回复消息：清理到当前的所有消息；带数量：清理该用户最近的消息）
 • /info - 查看用户信息（回复用户消息）
 
 💰 积分命令：
@@ -178,6 +202,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • /setrules <规则> - 设置群规
 • /rules - 查看群规
 • /settings - 查看所有群组设置
+• /stages - 查看消息审核阶段
+• /togglestage <名称> - 开关本群某个审核阶段
+• /adfilters - 查看本群自定义广告规则
+• /blockword <词...> - 添加本群屏蔽关键词
+• /allowword <词...> - 本群放行某些关键词
+• /blocklink <链接...> - 添加本群屏蔽链接（* 为通配符）
+• /allowlink <链接...> - 本群放行某些链接
+• /delfilter <内容...> - 删除本群广告规则
 
 📊 实用工具：
 • /id - 获取用户ID和群组ID
@@ -195,10 +227,60 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(help_text)
 
 
-def main():
-    """主函数"""
-    # 创建应用
-    application = Application.builder().token(BOT_TOKEN).build()
+async def post_init(application: Application):
+    """机器人启动后初始化后台任务"""
+    points_buffer.start()
+    profiles.start()
+    deletion_scheduler.start(application.bot)
+    if web_server:
+        try:
+            await web_server.start()
+        except OSError as e:
+            logger.error(f"HTTP 服务启动失败（端口 {web_server.port}）: {e}")
+
+
+async def post_shutdown(application: Application):
+    """机器人停止后释放资源"""
+    if web_server:
+        await web_server.close()
+    # 先写入缓冲中的积分和未执行的定时删除，再关闭数据库
+    await points_buffer.close()
+    await deletion_scheduler.close()
+    await profiles.close()
+    adb.close()
+
+
+def create_application(with_updater: bool = True) -> Application:
+    """
+    创建应用并注册所有处理器
+    
+    Args:
+        with_updater: 是否创建 Updater（分片模式的工作进程由前端进程接收更新，不需要）
+    """
+    builder = (
+        Application.builder().token(BOT_TOKEN)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .rate_limiter(api_scheduler)
+        .post_init(post_init).post_shutdown(post_shutdown)
+    )
+    if not with_updater:
+        builder = builder.updater(None)
+    if dispatcher:
+        # 同一群组的更新依次处理，不同群组并行处理
+        builder = builder.concurrent_updates(dispatcher)
+    application = builder.build()
+    
+    # 按类型统计更新数
+    application.add_handler(TypeHandler(Update, track_updates), group=-3)
+    
+    # 记录每个更新中的用户资料（最先执行，不影响后续处理器）
+    application.add_handler(TypeHandler(Update, track_profiles), group=-1)
+    
+    # 记录群组中每个用户最近的消息ID（/purge 按用户清理时使用）
+    application.add_handler(TypeHandler(Update, track_recent_messages), group=-4)
+    
+    # 成员状态变化时更新管理员名单缓存
+    application.add_handler(ChatMemberHandler(track_admin_changes, ChatMemberHandler.ANY_CHAT_MEMBER), group=-2)
     
     # 注册命令处理器
     application.add_handler(CommandHandler("start", start))
@@ -215,6 +297,7 @@ def main():
     
     # 通用管理命令（群组/频道都支持）
     application.add_handler(CommandHandler("del", delete_message))
+    application.add_handler(CommandHandler("purge", purge_messages))
     application.add_handler(CommandHandler("info", get_user_info))
     
     # 积分命令
@@ -232,6 +315,14 @@ def main():
     application.add_handler(CommandHandler("settings", chat_settings))
     application.add_handler(CommandHandler("toggleads", toggle_auto_delete_ads))
     application.add_handler(CommandHandler("togglewelcome", toggle_welcome))
+    application.add_handler(CommandHandler("stages", pipeline_stages))
+    application.add_handler(CommandHandler("togglestage", toggle_stage))
+    application.add_handler(CommandHandler("adfilters", list_ad_filters))
+    application.add_handler(CommandHandler("blockword", block_keywords))
+    application.add_handler(CommandHandler("allowword", allow_keywords))
+    application.add_handler(CommandHandler("blocklink", block_links))
+    application.add_handler(CommandHandler("allowlink", allow_links))
+    application.add_handler(CommandHandler("delfilter", remove_ad_filters))
     
     # 实用工具命令
     application.add_handler(CommandHandler("id", get_id))
@@ -244,25 +335,14 @@ def main():
     application.add_handler(CommandHandler("pin", pin_message))
     application.add_handler(CommandHandler("unpin", unpin_message))
     
-    # 消息处理器（仅群组，频道中不执行）
-    application.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND,
-        anti_flood,
-        block=False
-    ))
-    application.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND,
-        detect_duplicate_messages,
-        block=False
-    ))
-    application.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND,
-        auto_delete_ads,
-        block=False
-    ))
+    # 消息审核流水线（仅群组，频道中不执行）
+    # 同一组内只会执行第一个匹配的处理器，因此所有文本消息功能合并为一个处理器，
+    # 按顺序执行：防刷屏 -> 重复消息 -> 广告检测 -> 积分奖励，消息被删除后停止
+    # 启用分发器时必须阻塞执行，才能保证同一群组内按顺序处理
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND,
-        handle_message_points
+        pipeline.handle_message,
+        block=dispatcher is not None
     ))
     
     # 新成员加入处理器（仅群组）
@@ -274,6 +354,61 @@ def main():
     # 注册错误处理器
     application.add_error_handler(error_handler)
     
+    # 记录所有处理器的执行时间
+    instrument_handlers(application)
+    
+    return application
+
+
+async def run_webhook(application: Application, webhook_url: str):
+    """Webhook 模式运行（更新和 /metrics 共用 PORT）"""
+    add_webhook_route(web_server, application.bot, application.update_queue, WEBHOOK_PATH, WEBHOOK_SECRET or None)
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Windows 不支持，使用默认的 KeyboardInterrupt
+            pass
+    
+    # 启动失败时也要执行 post_shutdown，写入缓冲中的积分和定时删除记录
+    try:
+        async with application:
+            # 端口被占用时直接失败
+            await web_server.start()
+            await application.post_init(application)
+            await application.start()
+            try:
+                await application.bot.set_webhook(
+                    webhook_url,
+                    allowed_updates=Update.ALL_TYPES,
+                    secret_token=WEBHOOK_SECRET or None
+                )
+                logger.info("✅ Webhook 已设置，等待更新...")
+                
+                await stop_event.wait()
+            finally:
+                # 先停止接收，再处理完已收到的更新
+                await web_server.close()
+                await application.stop()
+    finally:
+        await application.post_shutdown(application)
+
+
+def main():
+    """主函数"""
+    if SHARD_WORKERS > 0:
+        # 多进程分片模式：本进程接收更新，按群组转发给工作进程
+        from sharding import run_sharded
+        webhook_url = f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}" if WEBHOOK_URL else None
+        run_sharded('bot_webhook:create_application', webhook_url, PORT, WEBHOOK_PATH, WEBHOOK_SECRET or None,
+                    METRICS_PORT)
+        return
+    
+    application = create_application()
+    
     # 根据环境变量选择运行模式
     if WEBHOOK_URL:
         # Webhook 模式（Telegram 主动推送更新）
@@ -281,12 +416,10 @@ def main():
         logger.info(f"使用 Webhook 模式: {webhook_url}")
         logger.info(f"监听端口: {PORT}")
         
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            webhook_url=webhook_url,
-            allowed_updates=Update.ALL_TYPES
-        )
+        try:
+            asyncio.run(run_webhook(application, webhook_url))
+        except KeyboardInterrupt:
+            pass
     else:
         # Polling 模式（机器人主动请求更新）
         logger.info("使用 Polling 模式（未设置 WEBHOOK_URL）")
@@ -10,8 +10,9 @@ from telegram import Update
 from telegram.ext import ContextTypes
 import logging
 from database import db
-from utils_common import check_admin_permission, require_admin, require_channel_or_group
+from utils_common import check_admin_permission, require_admin, require_channel_or_group, admin_roster, get_chat_info
 from error_handler import safe_execute
+from profiles import profiles
 
 logger = logging.getLogger(__name__)
 
@@ -48,7 +49,7 @@ async def channel_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     
     try:
-        chat_info = await context.bot.get_chat(chat.id)
+        chat_info = await get_chat_info(context.bot, chat.id)
         
         info_text = f"""
 📺 频道信息
@@ -80,7 +81,9 @@ async def channel_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     
     try:
-        administrators = await context.bot.get_chat_administrators(chat.id)
+        administrators = await admin_roster.get_administrators(context.bot, chat.id)
+        for admin in administrators:
+            profiles.observe(admin.user)
         
         if not administrators:
             await update.message.reply_text("ℹ️ 此频道没有管理员")
@@ -112,7 +115,7 @@ async def channel_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     
     try:
-        chat_info = await context.bot.get_chat(chat.id)
+        chat_info = await get_chat_info(context.bot, chat.id)
         member_count = chat_info.members_count or 0
         
         stats_text = f"""
@@ -4,29 +4,16 @@
 """
 from telegram import Update
 from telegram.ext import ContextTypes
-from telegram.constants import ChatMemberStatus
 import logging
-from database import db
+from database import adb
+from config import AD_FILTER_MAX_ENTRIES
+from auto_moderation import link_filter_error, invalidate_chat_classifier
+from utils_common import check_admin_permission
+from moderation_pipeline import pipeline, invalidate_chat_settings, parse_stage_list
 
 logger = logging.getLogger(__name__)
 
 
-async def check_admin_permission(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """检查用户是否有管理员权限"""
-    user = update.effective_user
-    chat = update.effective_chat
-    
-    if not chat or chat.type == 'private':
-        return False
-    
-    try:
-        member = await context.bot.get_chat_member(chat.id, user.id)
-        return member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]
-    except Exception as e:
-        logger.error(f"检查管理员权限时出错: {e}")
-        return False
-
-
 async def set_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """设置欢迎消息"""
     if not await check_admin_permission(update, context):
@@ -60,7 +47,8 @@ async def set_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
     welcome_text = " ".join(context.args)
     
     try:
-        db.set_welcome_message(chat.id, welcome_text)
+        await adb.set_welcome_message(chat.id, welcome_text)
+        invalidate_chat_settings(chat.id)
         await message.reply_text(
             f"✅ 欢迎消息已设置！\n\n预览:\n{welcome_text.replace('{username}', '新成员').replace('{first_name}', '新成员').replace('{chat_title}', chat.title or '本群')}"
         )
@@ -82,7 +70,7 @@ async def get_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ 频道不支持欢迎消息功能！\n此功能仅在群组中可用。")
         return
     
-    welcome_text = db.get_welcome_message(chat.id)
+    welcome_text = await adb.get_welcome_message(chat.id)
     
     if welcome_text:
         await update.message.reply_text(
@@ -122,7 +110,8 @@ async def set_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
     rules_text = " ".join(context.args)
     
     try:
-        db.set_rules(chat.id, rules_text)
+        await adb.set_rules(chat.id, rules_text)
+        invalidate_chat_settings(chat.id)
         await message.reply_text(f"✅ 群规已设置！\n\n{rules_text}")
         logger.info(f"管理员 {update.effective_user.id} 设置了群组 {chat.id} 的群规")
     except Exception as e:
@@ -140,14 +129,14 @@ async def get_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # 频道可以查看规则（如果有的话），但不能设置
     if chat.type == 'channel':
-        rules_text = db.get_rules(chat.id)
+        rules_text = await adb.get_rules(chat.id)
         if rules_text:
             await update.message.reply_text(f"📋 频道规则:\n\n{rules_text}")
         else:
             await update.message.reply_text("ℹ️ 当前没有设置规则\n注意：频道不支持设置规则功能")
         return
     
-    rules_text = db.get_rules(chat.id)
+    rules_text = await adb.get_rules(chat.id)
     
     if rules_text:
         await update.message.reply_text(f"📋 群规:\n\n{rules_text}")
@@ -171,11 +160,12 @@ async def toggle_auto_delete_ads(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("❌ 频道不支持自动删除广告功能！\n此功能仅在群组中可用。")
         return
     
-    current_status = db.is_auto_delete_ads_enabled(chat.id)
+    current_status = await adb.is_auto_delete_ads_enabled(chat.id)
     new_status = not current_status
     
     try:
-        db.set_auto_delete_ads(chat.id, new_status)
+        await adb.set_auto_delete_ads(chat.id, new_status)
+        invalidate_chat_settings(chat.id)
         status_text = "已启用" if new_status else "已禁用"
         await update.message.reply_text(f"✅ 自动删除广告功能 {status_text}")
         logger.info(f"管理员 {update.effective_user.id} {'启用' if new_status else '禁用'}了群组 {chat.id} 的自动删除广告功能")
@@ -200,11 +190,12 @@ async def toggle_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ 频道不支持欢迎消息功能！\n此功能仅在群组中可用。")
         return
     
-    current_status = db.is_welcome_enabled(chat.id)
+    current_status = await adb.is_welcome_enabled(chat.id)
     new_status = not current_status
     
     try:
-        db.set_welcome_enabled(chat.id, new_status)
+        await adb.set_welcome_enabled(chat.id, new_status)
+        invalidate_chat_settings(chat.id)
         status_text = "已启用" if new_status else "已禁用"
         await update.message.reply_text(f"✅ 欢迎消息功能 {status_text}")
         logger.info(f"管理员 {update.effective_user.id} {'启用' if new_status else '禁用'}了群组 {chat.id} 的欢迎消息功能")
@@ -229,10 +220,10 @@ async def chat_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ 频道不支持群组设置功能！\n频道仅支持删除消息、置顶等基础功能。")
         return
     
-    auto_delete = "✅ 启用" if db.is_auto_delete_ads_enabled(chat.id) else "❌ 禁用"
-    welcome = "✅ 启用" if db.is_welcome_enabled(chat.id) else "❌ 禁用"
-    welcome_msg = db.get_welcome_message(chat.id) or "默认消息"
-    rules = db.get_rules(chat.id) or "未设置"
+    auto_delete = "✅ 启用" if await adb.is_auto_delete_ads_enabled(chat.id) else "❌ 禁用"
+    welcome = "✅ 启用" if await adb.is_welcome_enabled(chat.id) else "❌ 禁用"
+    welcome_msg = await adb.get_welcome_message(chat.id) or "默认消息"
+    rules = await adb.get_rules(chat.id) or "未设置"
     
     settings_text = f"""
 ⚙️ 群组设置
@@ -247,3 +238,242 @@ async def chat_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(settings_text)
 
+
+async def pipeline_stages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看消息审核阶段的启用状态"""
+    if not await check_admin_permission(update, context):
+        await update.message.reply_text("❌ 您没有权限使用此命令！")
+        return
+    
+    chat = update.effective_chat
+    
+    if chat.type == 'private':
+        await update.message.reply_text("❌ 此命令只能在群组中使用！")
+        return
+    
+    if chat.type == 'channel':
+        await update.message.reply_text("❌ 频道不支持消息审核功能！\n此功能仅在群组中可用。")
+        return
+    
+    disabled = parse_stage_list(await adb.get_disabled_stages(chat.id))
+    
+    text = "🛡️ 消息审核阶段（按执行顺序）\n\n"
+    for stage in pipeline.stages.values():
+        if not stage.enabled:
+            status = "⛔ 全局关闭"
+        elif stage.name in disabled:
+            status = "❌ 禁用"
+        else:
+            status = "✅ 启用"
+        text += f"• {stage.title} ({stage.name}): {status}\n"
+    text += "\n💡 使用 /togglestage <名称> 切换"
+    
+    await update.message.reply_text(text)
+
+
+async def toggle_stage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """切换本群某个消息审核阶段"""
+    if not await check_admin_permission(update, context):
+        await update.message.reply_text("❌ 您没有权限使用此命令！")
+        return
+    
+    chat = update.effective_chat
+    
+    if chat.type == 'private':
+        await update.message.reply_text("❌ 此命令只能在群组中使用！")
+        return
+    
+    if chat.type == 'channel':
+        await update.message.reply_text("❌ 频道不支持消息审核功能！\n此功能仅在群组中可用。")
+        return
+    
+    if not context.args or context.args[0] not in pipeline.stages:
+        await update.message.reply_text(
+            "⚠️ 用法错误！\n"
+            "用法: /togglestage <名称>\n"
+            f"可用名称: {', '.join(pipeline.stages.keys())}"
+        )
+        return
+    
+    name = context.args[0]
+    
+    try:
+        disabled = set(parse_stage_list(await adb.get_disabled_stages(chat.id)))
+        if name in disabled:
+            disabled.discard(name)
+            new_status = True
+        else:
+            disabled.add(name)
+            new_status = False
+        
+        await adb.set_disabled_stages(chat.id, ",".join(sorted(disabled)))
+        invalidate_chat_settings(chat.id)
+        
+        status_text = "已启用" if new_status else "已禁用"
+        await update.message.reply_text(f"✅ {pipeline.stages[name].title} {status_text}")
+        logger.info(f"管理员 {update.effective_user.id} {'启用' if new_status else '禁用'}了群组 {chat.id} 的审核阶段 {name}")
+    except Exception as e:
+        await update.message.reply_text(f"❌ 操作失败: {str(e)}")
+        logger.error(f"切换审核阶段时出错: {e}")
+
+
+# ========== 自定义广告规则 ==========
+
+# 规则名称（用于回复消息）
+AD_FILTER_TITLES = {
+    ('block', 'keyword'): "屏蔽关键词",
+    ('block', 'link'): "屏蔽链接",
+    ('allow', 'keyword'): "放行关键词",
+    ('allow', 'link'): "放行链接",
+}
+
+# 单条规则的最大长度
+AD_FILTER_MAX_LENGTH = 100
+
+# 列表中每类最多显示的条数
+AD_FILTER_LIST_LIMIT = 30
+
+
+async def _check_ad_filter_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """广告规则命令的权限和聊天类型检查，不通过时回复原因"""
+    if not await check_admin_permission(update, context):
+        await update.message.reply_text("❌ 您没有权限使用此命令！")
+        return False
+    
+    chat = update.effective_chat
+    
+    if chat.type == 'private':
+        await update.message.reply_text("❌ 此命令只能在群组中使用！")
+        return False
+    
+    if chat.type == 'channel':
+        await update.message.reply_text("❌ 频道不支持广告检测功能！\n此功能仅在群组中可用。")
+        return False
+    
+    return True
+
+
+async def _add_ad_filters(update: Update, context: ContextTypes.DEFAULT_TYPE, list_type: str, kind: str):
+    """添加自定义广告规则（多个规则用空格分隔）"""
+    if not await _check_ad_filter_chat(update, context):
+        return
+    
+    chat = update.effective_chat
+    title = AD_FILTER_TITLES[(list_type, kind)]
+    command = update.message.text.split()[0].split('@')[0]
+    
+    if not context.args:
+        example = "加V 福利群" if kind == 'keyword' else "example.com t.me/*bot"
+        await update.message.reply_text(
+            "⚠️ 用法错误！\n"
+            f"用法: {command} <内容1> [内容2] ...\n"
+            f"示例: {command} {example}\n\n"
+            + ("💡 链接规则按文本匹配（不区分大小写），可用一个 * 匹配链接中不含 / 的任意文字\n" if kind == 'link' else "")
+            + "💡 使用 /adfilters 查看本群规则，/delfilter 删除规则"
+        )
+        return
+    
+    values = list(dict.fromkeys(context.args))
+    for value in values:
+        if len(value) > AD_FILTER_MAX_LENGTH:
+            await update.message.reply_text(f"❌ 规则过长（最多 {AD_FILTER_MAX_LENGTH} 个字符）: {value[:20]}...")
+            return
+        error = link_filter_error(value) if kind == 'link' else None
+        if error is not None:
+            await update.message.reply_text(f"❌ 规则无效: {value}\n{error}")
+            return
+    
+    try:
+        if await adb.count_ad_filters(chat.id) + len(values) > AD_FILTER_MAX_ENTRIES:
+            await update.message.reply_text(f"❌ 每个群组最多 {AD_FILTER_MAX_ENTRIES} 条自定义规则！")
+            return
+        
+        added = await adb.add_ad_filters(chat.id, list_type, kind, values)
+        invalidate_chat_classifier(chat.id)
+        
+        reply = f"✅ 已添加 {added} 条{title}"
+        if added < len(values):
+            reply += f"（{len(values) - added} 条已存在）"
+        await update.message.reply_text(reply)
+        logger.info(f"管理员 {update.effective_user.id} 为群组 {chat.id} 添加了 {added} 条{title}")
+    except Exception as e:
+        await update.message.reply_text(f"❌ 添加失败: {str(e)}")
+        logger.error(f"添加广告规则时出错: {e}")
+
+
+async def block_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """添加本群屏蔽关键词"""
+    await _add_ad_filters(update, context, 'block', 'keyword')
+
+
+async def allow_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """添加本群放行关键词（默认关键词在本群不再计入）"""
+    await _add_ad_filters(update, context, 'allow', 'keyword')
+
+
+async def block_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """添加本群屏蔽链接"""
+    await _add_ad_filters(update, context, 'block', 'link')
+
+
+async def allow_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """添加本群放行链接（如本群自己的邀请链接）"""
+    await _add_ad_filters(update, context, 'allow', 'link')
+
+
+async def remove_ad_filters(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """删除本群自定义广告规则"""
+    if not await _check_ad_filter_chat(update, context):
+        return
+    
+    chat = update.effective_chat
+    
+    if not context.args:
+        await update.message.reply_text(
+            "⚠️ 用法错误！\n"
+            "用法: /delfilter <内容1> [内容2] ...\n"
+            "💡 使用 /adfilters 查看本群规则"
+        )
+        return
+    
+    try:
+        removed = await adb.remove_ad_filters(chat.id, list(dict.fromkeys(context.args)))
+        invalidate_chat_classifier(chat.id)
+        
+        await update.message.reply_text(f"✅ 已删除 {removed} 条规则" if removed else "⚠️ 没有找到这些规则")
+        logger.info(f"管理员 {update.effective_user.id} 删除了群组 {chat.id} 的 {removed} 条广告规则")
+    except Exception as e:
+        await update.message.reply_text(f"❌ 删除失败: {str(e)}")
+        logger.error(f"删除广告规则时出错: {e}")
+
+
+async def list_ad_filters(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看本群自定义广告规则"""
+    if not await _check_ad_filter_chat(update, context):
+        return
+    
+    chat = update.effective_chat
+    filters = await adb.get_ad_filters(chat.id)
+    
+    if not filters:
+        await update.message.reply_text(
+            "📋 本群没有自定义广告规则，使用默认规则\n\n"
+            "💡 /blockword、/allowword、/blocklink、/allowlink 添加规则"
+        )
+        return
+    
+    groups = {key: [] for key in AD_FILTER_TITLES}
+    for list_type, kind, value in filters:
+        groups.setdefault((list_type, kind), []).append(value)
+    
+    text = f"📋 本群自定义广告规则（共 {len(filters)} 条）\n"
+    for key, title in AD_FILTER_TITLES.items():
+        values = groups[key]
+        if not values:
+            continue
+        shown = ', '.join(values[:AD_FILTER_LIST_LIMIT])
+        more = f" 等 {len(values)} 条" if len(values) > AD_FILTER_LIST_LIMIT else ""
+        text += f"\n{title}: {shown}{more}\n"
+    text += "\n💡 使用 /delfilter <内容> 删除规则"
+    
+    await update.message.reply_text(text)
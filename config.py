@@ -46,25 +46,55 @@ MAX_MUTE_TIME = get_env_int('MAX_MUTE_TIME', 2592000)  # 最大禁言时间（
 # ========== 积分系统配置 ==========
 POINTS_PER_MESSAGE = get_env_int('POINTS_PER_MESSAGE', 1)  # 每条消息获得的积分
 POINTS_COOLDOWN = get_env_int('POINTS_COOLDOWN', 60)  # 积分冷却时间（秒）
+COOLDOWN_MAX_ENTRIES = get_env_int('COOLDOWN_MAX_ENTRIES', 100000)  # 内存中最多保存的积分冷却记录数
+LEADERBOARD_MAX_CHATS = get_env_int('LEADERBOARD_MAX_CHATS', 500)  # 内存中最多保留的群组排行榜数量
 NEW_MEMBER_BONUS = get_env_int('NEW_MEMBER_BONUS', 10)  # 新成员奖励积分
 AD_POINTS_PENALTY = get_env_int('AD_POINTS_PENALTY', 10)  # 发送广告扣除的积分
 FLOOD_POINTS_PENALTY = get_env_int('FLOOD_POINTS_PENALTY', 5)  # 刷屏扣除的积分
 DUPLICATE_POINTS_PENALTY = get_env_int('DUPLICATE_POINTS_PENALTY', 2)  # 重复消息扣除的积分
+POINTS_FLUSH_INTERVAL_MS = get_env_int('POINTS_FLUSH_INTERVAL_MS', 1000)  # 积分写缓冲刷新间隔（毫秒）
+POINTS_FLUSH_MAX_EVENTS = get_env_int('POINTS_FLUSH_MAX_EVENTS', 200)  # 积分写缓冲累计多少条后立即刷新
 
 # ========== 防刷屏配置 ==========
 FLOOD_LIMIT = get_env_int('FLOOD_LIMIT', 5)  # 刷屏限制（条数）
 FLOOD_WINDOW = get_env_int('FLOOD_WINDOW', 10)  # 刷屏时间窗口（秒）
 DUPLICATE_CHECK_COUNT = get_env_int('DUPLICATE_CHECK_COUNT', 5)  # 检测重复消息的历史记录数
+NEAR_DUPLICATE_USER_DISTANCE = get_env_int('NEAR_DUPLICATE_USER_DISTANCE', 3)  # 与本人最近消息的指纹距离（64位汉明距离）不超过此值视为重复，0为完全相同
+NEAR_DUPLICATE_MIN_SHINGLES = get_env_int('NEAR_DUPLICATE_MIN_SHINGLES', 16)  # 不同的词（相邻两个字符）少于此数的消息只按完全相同判断重复
+NEAR_DUPLICATE_CHAT_DISTANCE = get_env_int('NEAR_DUPLICATE_CHAT_DISTANCE', 8)  # 群组内指纹距离不超过此值视为相同内容（刷群账号常改几个字）
+NEAR_DUPLICATE_MAX_USERS = get_env_int('NEAR_DUPLICATE_MAX_USERS', 100000)  # 最多跟踪的用户窗口数（按最近使用淘汰）
+NEAR_DUPLICATE_MAX_CHATS = get_env_int('NEAR_DUPLICATE_MAX_CHATS', 10000)  # 最多跟踪的群组窗口数（按最近使用淘汰）
+RAID_SENDER_THRESHOLD = get_env_int('RAID_SENDER_THRESHOLD', 5)  # 时间窗口内多少个不同用户发送相同内容视为刷群，0表示不检测
+RAID_WINDOW = get_env_int('RAID_WINDOW', 300)  # 刷群检测时间窗口（秒）
+RAID_BUCKETS = get_env_int('RAID_BUCKETS', 10)  # 时间窗口划分的时间片数（按时间片整体过期）
+RAID_MAX_CLUSTERS = get_env_int('RAID_MAX_CLUSTERS', 200)  # 每个群组最多跟踪的不同内容数
+RAID_MAX_MESSAGES = get_env_int('RAID_MAX_MESSAGES', 5)  # 每个用户每种内容最多记录的消息数（刷群时一并删除）
+RAID_MIN_SHINGLES = get_env_int('RAID_MIN_SHINGLES', 16)  # 不同的词（相邻两个字符）少于此数的内容不参与刷群检测，避免把常见的短回复当成刷群
+RAID_MUTE_DURATION = get_env_int('RAID_MUTE_DURATION', 0)  # 刷群账号禁言时间（秒），0表示只删除不禁言
+RAID_MUTE_MAX_HISTORY = get_env_int('RAID_MUTE_MAX_HISTORY', 5)  # 启用禁言时，只禁言在本群发言不超过此条数（含刷群消息）的新账号
 
 # ========== 自动管理配置 ==========
 AUTO_DELETE_ADS = get_env_bool('AUTO_DELETE_ADS', True)  # 默认启用自动删除广告
 AUTO_WELCOME = get_env_bool('AUTO_WELCOME', True)  # 默认启用欢迎消息
 AUTO_KICK_BOTS = get_env_bool('AUTO_KICK_BOTS', False)  # 默认不自动踢出机器人
+AD_SPAM_DOMAINS = [d.strip().lower() for d in os.getenv('AD_SPAM_DOMAINS', '').split(',') if d.strip()]  # 已知广告域名（逗号分隔，含子域名）
+AD_SPAM_USERNAMES = [u.strip().lower().lstrip('@') for u in os.getenv('AD_SPAM_USERNAMES', '').split(',') if u.strip()]  # 已知广告账号用户名（逗号分隔）
+AD_FILTER_MAX_ENTRIES = get_env_int('AD_FILTER_MAX_ENTRIES', 5000)  # 每个群组最多的自定义广告关键词/链接规则数
+AD_FILTER_CACHE_SIZE = get_env_int('AD_FILTER_CACHE_SIZE', 1000)  # 内存中最多缓存的群组广告识别器数
+AD_FILTER_CACHE_WEIGHT = get_env_int('AD_FILTER_CACHE_WEIGHT', 500000)  # 缓存的群组广告识别器规则总数上限
+WARNING_DELETE_DELAY = get_env_int('WARNING_DELETE_DELAY', 5)  # 自动发送的警告消息多少秒后删除
+DELETE_SCHEDULER_INTERVAL_MS = get_env_int('DELETE_SCHEDULER_INTERVAL_MS', 1000)  # 定时删除检查间隔（毫秒），同一群组在一个间隔内到期的消息合并为一次批量删除
+PURGE_MAX_MESSAGES = get_env_int('PURGE_MAX_MESSAGES', 1000)  # /purge 单次最多清理的消息数
+PURGE_CONCURRENCY = get_env_int('PURGE_CONCURRENCY', 3)  # /purge 同时进行的批量删除请求数
+RECENT_MESSAGES_PER_USER = get_env_int('RECENT_MESSAGES_PER_USER', 200)  # 每个用户在每个群组中记录的最近消息数（/purge 按用户清理时使用）
+RECENT_MESSAGES_MAX_USERS = get_env_int('RECENT_MESSAGES_MAX_USERS', 50000)  # 最近消息索引最多记录的用户数
 
 # ========== 数据库配置 ==========
 DB_PATH = os.getenv('DB_PATH', 'bot_data.db')  # 数据库文件路径
 DB_BACKUP_ENABLED = get_env_bool('DB_BACKUP_ENABLED', True)  # 是否启用数据库备份
 DB_BACKUP_INTERVAL = get_env_int('DB_BACKUP_INTERVAL', 86400)  # 备份间隔（秒），默认24小时
+DB_POOL_SIZE = get_env_int('DB_POOL_SIZE', 5)  # 数据库连接池大小
+DB_POOL_TIMEOUT = get_env_int('DB_POOL_TIMEOUT', 10)  # 等待空闲连接的超时时间（秒）
 
 # ========== 日志配置 ==========
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')  # 日志级别: DEBUG, INFO, WARNING, ERROR
@@ -73,6 +103,22 @@ LOG_FILE = os.getenv('LOG_FILE', 'bot.log')  # 日志文件路径，空字符串
 # ========== 性能配置 ==========
 ADMIN_CACHE_TIMEOUT = get_env_int('ADMIN_CACHE_TIMEOUT', 300)  # 管理员权限缓存时间（秒）
 MESSAGE_HANDLER_TIMEOUT = get_env_int('MESSAGE_HANDLER_TIMEOUT', 5)  # 消息处理器超时时间（秒）
+CACHE_MAX_SIZE = get_env_int('CACHE_MAX_SIZE', 10000)  # 每个内存缓存最多保存的条目数
+CHAT_INFO_CACHE_TIMEOUT = get_env_int('CHAT_INFO_CACHE_TIMEOUT', 300)  # 群组/频道信息（get_chat）缓存时间（秒）
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')  # Polling 模式下指标服务的监听地址（分片模式下工作进程的指标服务也只监听此地址）
+METRICS_PORT = get_env_int('METRICS_PORT', 9100)  # Polling 模式下指标服务的端口，0表示不启用（Webhook 模式使用 PORT）
+PROFILE_TTL = get_env_int('PROFILE_TTL', 86400)  # 用户资料有效期（秒），过期后显示时通过API刷新
+PROFILE_CACHE_SIZE = get_env_int('PROFILE_CACHE_SIZE', 100000)  # 内存中最多保存的用户资料数
+PROFILE_FLUSH_INTERVAL = get_env_int('PROFILE_FLUSH_INTERVAL', 30)  # 用户资料写入数据库的间隔（秒）
+DISPATCHER_LANES = get_env_int('DISPATCHER_LANES', 0)  # 按群组保序的处理通道数，0表示不启用
+DISPATCHER_QUEUE_SIZE = get_env_int('DISPATCHER_QUEUE_SIZE', 100)  # 每个处理通道的队列上限
+
+# ========== 分片配置 ==========
+SHARD_WORKERS = get_env_int('SHARD_WORKERS', 0)  # 分片工作进程数，0表示单进程运行
+SHARD_QUEUE_SIZE = get_env_int('SHARD_QUEUE_SIZE', 1000)  # 每个工作进程待处理更新的上限
+SHARD_MAX_RESTARTS = get_env_int('SHARD_MAX_RESTARTS', 5)  # 时间窗口内允许的最大重启次数，超过后暂时下线
+SHARD_RESTART_WINDOW = get_env_int('SHARD_RESTART_WINDOW', 300)  # 重启次数统计窗口（秒），也是下线后的恢复等待时间
+SHARD_CHECK_INTERVAL = get_env_int('SHARD_CHECK_INTERVAL', 5)  # 检查工作进程状态的间隔（秒）
 
 # ========== 功能开关 ==========
 ENABLE_POINTS_SYSTEM = get_env_bool('ENABLE_POINTS_SYSTEM', True)  # 是否启用积分系统
@@ -82,5 +128,15 @@ ENABLE_STATISTICS = get_env_bool('ENABLE_STATISTICS', True)  # 是否启用统
 # ========== 高级配置 ==========
 MAX_MESSAGE_LENGTH = get_env_int('MAX_MESSAGE_LENGTH', 4096)  # 最大消息长度
 RATE_LIMIT_ENABLED = get_env_bool('RATE_LIMIT_ENABLED', True)  # 是否启用速率限制
-RATE_LIMIT_PER_USER = get_env_int('RATE_LIMIT_PER_USER', 20)  # 每个用户每分钟最大消息数
+RATE_LIMIT_PER_USER = get_env_int('RATE_LIMIT_PER_USER', 20)  # 每个用户（在每个群组中）每分钟最大消息数，超过的消息被删除
+RATE_LIMIT_PER_CHAT = get_env_int('RATE_LIMIT_PER_CHAT', 600)  # 每个群组每分钟最多审核的消息数，超过时跳过审核，0表示不限制
+RATE_LIMIT_GLOBAL = get_env_int('RATE_LIMIT_GLOBAL', 0)  # 全局每分钟最多审核的消息数，超过时跳过审核，0表示不限制
+RATE_LIMIT_COMMANDS_PER_USER = get_env_int('RATE_LIMIT_COMMANDS_PER_USER', 5)  # 每个用户每分钟最多执行的查询命令数（/top、/stats）
+RATE_LIMIT_COMMANDS_PER_CHAT = get_env_int('RATE_LIMIT_COMMANDS_PER_CHAT', 20)  # 每个群组每分钟最多执行的查询命令数
+RATE_LIMIT_COMMANDS_GLOBAL = get_env_int('RATE_LIMIT_COMMANDS_GLOBAL', 300)  # 全局每分钟最多执行的查询命令数
+RATE_LIMIT_MAX_KEYS = get_env_int('RATE_LIMIT_MAX_KEYS', 100000)  # 每个限制范围最多跟踪的键数
+API_RATE_GLOBAL = get_env_int('API_RATE_GLOBAL', 30)  # 每秒最多发送的 Telegram API 请求数（分片模式下由各工作进程平分），0表示不限制
+API_RATE_PER_CHAT = get_env_int('API_RATE_PER_CHAT', 20)  # 每个群组每分钟最多发送的消息数，0表示不限制
+API_MAX_RETRIES = get_env_int('API_MAX_RETRIES', 3)  # 遇到 429（RetryAfter）时最多自动重试次数
+API_LOW_PRIORITY_MAX_WAIT = get_env_int('API_LOW_PRIORITY_MAX_WAIT', 30)  # 低优先级请求（欢迎消息）最长排队时间（秒），超过后放弃，0表示一直等待
 
@@ -0,0 +1,110 @@
+"""
+积分冷却模块
+在内存中记录用户最后获得积分的时间，冷却期内的消息不访问数据库
+"""
+import time
+import logging
+from collections import OrderedDict
+from typing import Optional, Tuple
+from database import adb
+from points_buffer import points_buffer
+from config import POINTS_COOLDOWN, COOLDOWN_MAX_ENTRIES
+
+logger = logging.getLogger(__name__)
+
+
+class CooldownTracker:
+    """
+    积分冷却跟踪器
+    
+    - 按 (chat_id, user_id) 记录最后获得积分的时间
+    - 未命中时从缓冲或数据库加载一次
+    - 按获得积分的先后顺序存储，超过冷却时间的记录从头部淘汰
+    - 持久化由积分写缓冲定期完成（last_message_time）
+    """
+    
+    def __init__(self, cooldown: int = POINTS_COOLDOWN, max_entries: int = COOLDOWN_MAX_ENTRIES):
+        """
+        初始化冷却跟踪器
+        
+        Args:
+            cooldown: 冷却时间（秒）
+            max_entries: 最多保存的记录数
+        """
+        self.cooldown = cooldown
+        self.max_entries = max(1, max_entries)
+        # 格式: {(chat_id, user_id): 最后获得积分的时间}，按时间先后排列
+        self._last_times: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+        
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    async def _load(self, chat_id: int, user_id: int) -> Optional[int]:
+        """未命中时加载最后获得积分的时间（先查写缓冲，再查数据库）"""
+        last_time = points_buffer.pending_message_time(chat_id, user_id)
+        if last_time is None:
+            last_time = await adb.get_last_message_time(chat_id, user_id)
+        return last_time
+    
+    def _evict(self, now: int):
+        """淘汰已过冷却期的记录，并保证不超过容量上限"""
+        expire_before = now - self.cooldown
+        while self._last_times:
+            key, last_time = next(iter(self._last_times.items()))
+            if last_time > expire_before and len(self._last_times) <= self.max_entries:
+                break
+            self._last_times.popitem(last=False)
+            self.evictions += 1
+    
+    async def try_acquire(self, chat_id: int, user_id: int) -> bool:
+        """
+        检查用户是否已过冷却期，是则记录本次获得积分的时间
+        
+        Returns:
+            bool: 可以获得积分返回True
+        """
+        key = (chat_id, user_id)
+        now = int(time.time())
+        
+        last_time = self._last_times.get(key)
+        if last_time is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            last_time = await self._load(chat_id, user_id)
+            # 加载期间可能已有同一用户的其他消息写入
+            last_time = self._last_times.get(key, last_time)
+        
+        if last_time and (now - last_time) < self.cooldown:
+            if key not in self._last_times:
+                self._last_times[key] = last_time
+                self._evict(now)
+            return False
+        
+        self._last_times[key] = now
+        self._last_times.move_to_end(key)
+        self._evict(now)
+        return True
+    
+    def reset(self, chat_id: Optional[int] = None):
+        """清除冷却记录（chat_id 为 None 时清除全部）"""
+        if chat_id is None:
+            self._last_times.clear()
+            return
+        for key in [key for key in self._last_times if key[0] == chat_id]:
+            del self._last_times[key]
+    
+    def stats(self) -> dict:
+        """获取冷却跟踪器统计信息"""
+        return {
+            'size': len(self._last_times),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+# 全局冷却跟踪器实例
+cooldown_tracker = CooldownTracker()
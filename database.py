@@ -3,24 +3,63 @@
 使用 SQLite 存储用户积分、警告等数据
 """
 import sqlite3
-import os
+import time
+import asyncio
+import functools
+import queue
+import threading
 import logging
-from typing import Optional, List, Tuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Tuple, Callable
+from config import DB_PATH, DB_POOL_SIZE, DB_POOL_TIMEOUT
+from metrics import metrics, db_latency, points_awarded_total
 
 logger = logging.getLogger(__name__)
 
-DB_PATH = "bot_data.db"
 
+# 群组设置的默认值（数据库中没有记录或字段为空时使用）
+DEFAULT_CHAT_SETTINGS = {
+    'welcome_message': None,
+    'rules': None,
+    'auto_delete_ads': 1,
+    'welcome_new_members': 1,
+    'auto_kick_bots': 0,
+    'disabled_stages': None,
+}
 
-class Database:
-    """数据库管理类"""
+
+class ConnectionPool:
+    """
+    SQLite 连接池
+    连接长期复用，PRAGMA 只在创建连接时执行一次
+    """
     
-    def __init__(self, db_path: str = DB_PATH):
+    def __init__(self, db_path: str, size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT):
+        """
+        初始化连接池
+        
+        Args:
+            db_path: 数据库文件路径
+            size: 连接池最大连接数
+            timeout: 等待空闲连接的超时时间（秒）
+        """
         self.db_path = db_path
-        self.init_database()
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=self.size)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+        
+        # 统计信息
+        self.checkouts = 0
+        self.waits = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
     
-    def get_connection(self):
-        """获取数据库连接（优化：使用连接池和超时设置）"""
+    def _create_connection(self) -> sqlite3.Connection:
+        """创建新连接并应用 PRAGMA 设置"""
         conn = sqlite3.connect(
             self.db_path,
             timeout=10.0,  # 10秒超时
@@ -32,302 +71,607 @@ class Database:
         conn.execute("PRAGMA cache_size=10000")  # 增加缓存大小
         return conn
     
+    def _acquire(self) -> sqlite3.Connection:
+        """取出一个连接（优先复用空闲连接，不足时新建，达到上限时等待）"""
+        if self._closed:
+            raise RuntimeError("连接池已关闭")
+        
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._create_connection()
+                except Exception:
+                    self._created -= 1
+                    raise
+        
+        # 连接已用完，等待归还
+        start_time = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"等待数据库连接超时（{self.timeout}秒）")
+        finally:
+            waited = time.perf_counter() - start_time
+            with self._lock:
+                self.waits += 1
+                self.total_wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+        return conn
+    
+    def _release(self, conn: sqlite3.Connection):
+        """归还连接"""
+        if self._closed:
+            conn.close()
+            return
+        self._idle.put_nowait(conn)
+    
+    @contextmanager
+    def connection(self):
+        """
+        借出一个连接，退出上下文时自动归还
+        发生异常时回滚未提交的事务
+        
+        使用示例:
+            with pool.connection() as conn:
+                conn.execute(...)
+                conn.commit()
+        """
+        conn = self._acquire()
+        with self._lock:
+            self.checkouts += 1
+        try:
+            yield conn
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            if conn.in_transaction:
+                # 调用方忘记提交的事务不应泄漏给下一个使用者
+                conn.rollback()
+            self._release(conn)
+    
+    def stats(self) -> dict:
+        """获取连接池统计信息"""
+        with self._lock:
+            idle = self._idle.qsize()
+            return {
+                'size': self.size,
+                'created': self._created,
+                'idle': idle,
+                'in_use': self._created - idle,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'total_wait_time': self.total_wait_time,
+                'avg_wait_time': self.total_wait_time / self.waits if self.waits else 0.0,
+                'max_wait_time': self.max_wait_time,
+            }
+    
+    def close(self):
+        """关闭所有空闲连接（借出中的连接归还时关闭）"""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+        logger.info("数据库连接池已关闭")
+
+
+class Database:
+    """数据库管理类"""
+    
+    def __init__(self, db_path: str = DB_PATH, pool_size: int = DB_POOL_SIZE):
+        self.db_path = db_path
+        self.pool = ConnectionPool(db_path, size=pool_size)
+        # 积分变化监听器，提交后以 [(chat_id, user_id, 当前积分), ...] 调用
+        self.points_listeners: List[Callable[[List[Tuple[int, int, int]]], None]] = []
+        self.init_database()
+    
+    def connection(self):
+        """从连接池借出一个连接（上下文管理器，退出时自动归还）"""
+        return self.pool.connection()
+    
+    def pool_stats(self) -> dict:
+        """获取连接池统计信息"""
+        return self.pool.stats()
+    
+    def close(self):
+        """关闭连接池"""
+        self.pool.close()
+    
+    def _notify_points(self, changes: List[Tuple[int, int, int]]):
+        """通知积分变化监听器"""
+        for listener in self.points_listeners:
+            try:
+                listener(changes)
+            except Exception as e:
+                logger.error(f"积分变化监听器出错: {e}")
+    
+    def _fetch_points(self, cursor, keys) -> List[Tuple[int, int, int]]:
+        """在当前事务中读取一批用户的最新积分（没有监听器时跳过）"""
+        if not self.points_listeners:
+            return []
+        changes = []
+        for chat_id, user_id in keys:
+            cursor.execute("""
+                SELECT points FROM user_points 
+                WHERE chat_id = ? AND user_id = ?
+            """, (chat_id, user_id))
+            changes.append((chat_id, user_id, cursor.fetchone()[0]))
+        return changes
+    
     def init_database(self):
         """初始化数据库表"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # 用户积分表
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS user_points (
-                chat_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                points INTEGER DEFAULT 0,
-                last_message_time INTEGER,
-                PRIMARY KEY (chat_id, user_id)
-            )
-        """)
-        
-        # 警告记录表
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS warnings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                admin_id INTEGER NOT NULL,
-                reason TEXT,
-                timestamp INTEGER NOT NULL
-            )
-        """)
-        
-        # 积分历史记录表（可选，用于记录积分变化）
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS points_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                points_change INTEGER NOT NULL,
-                reason TEXT,
-                timestamp INTEGER NOT NULL
-            )
-        """)
-        
-        # 群组设置表
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS chat_settings (
-                chat_id INTEGER PRIMARY KEY,
-                welcome_message TEXT,
-                rules TEXT,
-                auto_delete_ads INTEGER DEFAULT 1,
-                welcome_new_members INTEGER DEFAULT 1,
-                auto_kick_bots INTEGER DEFAULT 0,
-                created_at INTEGER,
-                updated_at INTEGER
-            )
-        """)
-        
-        # 创建索引以提高查询性能
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_user_points 
-            ON user_points(chat_id, user_id)
-        """)
-        
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_warnings 
-            ON warnings(chat_id, user_id)
-        """)
-        
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # 用户积分表
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS user_points (
+                    chat_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    points INTEGER DEFAULT 0,
+                    last_message_time INTEGER,
+                    PRIMARY KEY (chat_id, user_id)
+                )
+            """)
+            
+            # 警告记录表
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS warnings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    admin_id INTEGER NOT NULL,
+                    reason TEXT,
+                    timestamp INTEGER NOT NULL
+                )
+            """)
+            
+            # 积分历史记录表（可选，用于记录积分变化）
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS points_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    points_change INTEGER NOT NULL,
+                    reason TEXT,
+                    timestamp INTEGER NOT NULL
+                )
+            """)
+            
+            # 群组设置表
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS chat_settings (
+                    chat_id INTEGER PRIMARY KEY,
+                    welcome_message TEXT,
+                    rules TEXT,
+                    auto_delete_ads INTEGER DEFAULT 1,
+                    welcome_new_members INTEGER DEFAULT 1,
+                    auto_kick_bots INTEGER DEFAULT 0,
+                    disabled_stages TEXT,
+                    created_at INTEGER,
+                    updated_at INTEGER
+                )
+            """)
+            
+            # 旧版本数据库升级：补充新增的列
+            cursor.execute("PRAGMA table_info(chat_settings)")
+            columns = {row[1] for row in cursor.fetchall()}
+            if 'disabled_stages' not in columns:
+                cursor.execute("ALTER TABLE chat_settings ADD COLUMN disabled_stages TEXT")
+            
+            # 用户资料表（从收到的更新中被动记录）
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS user_profiles (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT,
+                    last_name TEXT,
+                    updated_at INTEGER NOT NULL
+                )
+            """)
+            
+            # 群组自定义广告规则表
+            # list_type: block（屏蔽）/ allow（放行）；kind: keyword（关键词）/ link（链接正则）
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS ad_filters (
+                    chat_id INTEGER NOT NULL,
+                    list_type TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    PRIMARY KEY (chat_id, list_type, kind, value)
+                )
+            """)
+            
+            # 定时删除的消息（重启后继续删除）
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS scheduled_deletions (
+                    chat_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    due_at REAL NOT NULL,
+                    PRIMARY KEY (chat_id, message_id)
+                )
+            """)
+            
+            # 创建索引以提高查询性能
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_user_points 
+                ON user_points(chat_id, user_id)
+            """)
+            
+            # 排行榜覆盖索引（按群组、积分降序，无需回表）
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_user_points_rank 
+                ON user_points(chat_id, points DESC, user_id)
+            """)
+            
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_warnings 
+                ON warnings(chat_id, user_id)
+            """)
+            
+            conn.commit()
         logger.info("数据库初始化完成")
     
     # ========== 积分相关方法 ==========
     
     def get_user_points(self, chat_id: int, user_id: int) -> int:
         """获取用户积分"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT points FROM user_points 
-            WHERE chat_id = ? AND user_id = ?
-        """, (chat_id, user_id))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT points FROM user_points 
+                WHERE chat_id = ? AND user_id = ?
+            """, (chat_id, user_id))
+            
+            result = cursor.fetchone()
         
         return result[0] if result else 0
     
     def add_points(self, chat_id: int, user_id: int, points: int, reason: str = None) -> int:
-        """增加用户积分"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # 先检查用户是否存在
-        cursor.execute("""
-            SELECT points FROM user_points 
-            WHERE chat_id = ? AND user_id = ?
-        """, (chat_id, user_id))
-        
-        result = cursor.fetchone()
-        
-        if result:
-            # 更新积分
-            new_points = result[0] + points
-            cursor.execute("""
-                UPDATE user_points 
-                SET points = ? 
-                WHERE chat_id = ? AND user_id = ?
-            """, (new_points, chat_id, user_id))
-        else:
-            # 创建新记录
-            new_points = points
+        """增加用户积分（单条 UPSERT 语句，原子操作，需要 SQLite 3.35+ 支持 RETURNING）"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
             cursor.execute("""
                 INSERT INTO user_points (chat_id, user_id, points)
                 VALUES (?, ?, ?)
-            """, (chat_id, user_id, new_points))
-        
-        # 记录积分历史
-        import time
-        cursor.execute("""
-            INSERT INTO points_history (chat_id, user_id, points_change, reason, timestamp)
-            VALUES (?, ?, ?, ?, ?)
-        """, (chat_id, user_id, points, reason or "系统", int(time.time())))
-        
-        conn.commit()
-        conn.close()
-        
+                ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                    points = points + excluded.points
+                RETURNING points
+            """, (chat_id, user_id, points))
+            
+            new_points = cursor.fetchone()[0]
+            
+            # 记录积分历史（同一事务）
+            cursor.execute("""
+                INSERT INTO points_history (chat_id, user_id, points_change, reason, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            """, (chat_id, user_id, points, reason or "系统", int(time.time())))
+            
+            conn.commit()
+        
+        self._notify_points([(chat_id, user_id, new_points)])
+        if points > 0:
+            points_awarded_total.labels('direct').inc(points)
         logger.info(f"用户 {user_id} 在群组 {chat_id} 获得 {points} 积分，当前积分: {new_points}")
         return new_points
     
+    def add_points_bulk(self, entries: List[Tuple[int, int, int, Optional[str]]]) -> int:
+        """
+        批量增加积分（单个事务，executemany）
+        
+        Args:
+            entries: [(chat_id, user_id, 积分变化, 原因), ...]
+        
+        Returns:
+            int: 处理的记录数
+        """
+        if not entries:
+            return 0
+        
+        timestamp = int(time.time())
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.executemany("""
+                INSERT INTO user_points (chat_id, user_id, points)
+                VALUES (?, ?, ?)
+                ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                    points = points + excluded.points
+            """, [(chat_id, user_id, points) for chat_id, user_id, points, _ in entries])
+            
+            cursor.executemany("""
+                INSERT INTO points_history (chat_id, user_id, points_change, reason, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            """, [(chat_id, user_id, points, reason or "系统", timestamp)
+                  for chat_id, user_id, points, reason in entries])
+            
+            changes = self._fetch_points(cursor, {(chat_id, user_id) for chat_id, user_id, _, _ in entries})
+            conn.commit()
+        
+        self._notify_points(changes)
+        logger.info(f"批量更新了 {len(entries)} 条积分记录")
+        return len(entries)
+    
     def subtract_points(self, chat_id: int, user_id: int, points: int, reason: str = None) -> int:
         """减少用户积分"""
         return self.add_points(chat_id, user_id, -points, reason)
     
     def set_points(self, chat_id: int, user_id: int, points: int) -> int:
-        """设置用户积分（覆盖）"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT points FROM user_points 
-            WHERE chat_id = ? AND user_id = ?
-        """, (chat_id, user_id))
-        
-        result = cursor.fetchone()
-        
-        if result:
-            old_points = result[0]
+        """设置用户积分（覆盖，历史记录和 UPSERT 在同一事务中完成）"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # 记录积分变化（先于覆盖执行，以便读取旧积分）
             cursor.execute("""
-                UPDATE user_points 
-                SET points = ? 
-                WHERE chat_id = ? AND user_id = ?
-            """, (points, chat_id, user_id))
-        else:
-            old_points = 0
+                INSERT INTO points_history (chat_id, user_id, points_change, reason, timestamp)
+                SELECT ?, ?, ? - COALESCE(
+                    (SELECT points FROM user_points WHERE chat_id = ? AND user_id = ?), 0
+                ), ?, ?
+            """, (chat_id, user_id, points, chat_id, user_id, "管理员设置", int(time.time())))
+            
             cursor.execute("""
                 INSERT INTO user_points (chat_id, user_id, points)
                 VALUES (?, ?, ?)
+                ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                    points = excluded.points
+                RETURNING points
             """, (chat_id, user_id, points))
+            
+            new_points = cursor.fetchone()[0]
+            
+            conn.commit()
         
-        # 记录积分变化
-        import time
-        points_change = points - old_points
-        cursor.execute("""
-            INSERT INTO points_history (chat_id, user_id, points_change, reason, timestamp)
-            VALUES (?, ?, ?, ?, ?)
-        """, (chat_id, user_id, points_change, "管理员设置", int(time.time())))
-        
-        conn.commit()
-        conn.close()
-        
-        logger.info(f"用户 {user_id} 在群组 {chat_id} 积分设置为 {points}")
-        return points
+        self._notify_points([(chat_id, user_id, new_points)])
+        logger.info(f"用户 {user_id} 在群组 {chat_id} 积分设置为 {new_points}")
+        return new_points
     
     def get_top_users(self, chat_id: int, limit: int = 10) -> List[Tuple[int, int]]:
         """获取积分排行榜（返回 (user_id, points) 列表）"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT user_id, points FROM user_points 
-            WHERE chat_id = ? 
-            ORDER BY points DESC 
-            LIMIT ?
-        """, (chat_id, limit))
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT user_id, points FROM user_points 
+                WHERE chat_id = ? 
+                ORDER BY points DESC 
+                LIMIT ?
+            """, (chat_id, limit))
+            
+            results = cursor.fetchall()
         
-        results = cursor.fetchall()
-        conn.close()
+        return results
+    
+    def get_chat_points(self, chat_id: int) -> List[Tuple[int, int]]:
+        """获取群组内所有用户的积分（返回 (user_id, points) 列表，使用覆盖索引）"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT user_id, points FROM user_points 
+                WHERE chat_id = ?
+            """, (chat_id,))
+            
+            results = cursor.fetchall()
         
         return results
     
     def get_user_rank(self, chat_id: int, user_id: int) -> Optional[int]:
         """获取用户排名（返回排名，1为最高）"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # 获取用户积分
-        user_points = self.get_user_points(chat_id, user_id)
-        
-        # 计算排名（有多少人积分更高）
-        cursor.execute("""
-            SELECT COUNT(*) FROM user_points 
-            WHERE chat_id = ? AND points > ?
-        """, (chat_id, user_points))
-        
-        rank = cursor.fetchone()[0] + 1  # +1 因为排名从1开始
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # 获取用户积分（同一连接内完成，避免嵌套借出连接）
+            cursor.execute("""
+                SELECT points FROM user_points 
+                WHERE chat_id = ? AND user_id = ?
+            """, (chat_id, user_id))
+            
+            result = cursor.fetchone()
+            user_points = result[0] if result else 0
+            
+            # 计算排名（有多少人积分更高）
+            cursor.execute("""
+                SELECT COUNT(*) FROM user_points 
+                WHERE chat_id = ? AND points > ?
+            """, (chat_id, user_points))
+            
+            rank = cursor.fetchone()[0] + 1  # +1 因为排名从1开始
         
         return rank if user_points > 0 else None
     
     def update_last_message_time(self, chat_id: int, user_id: int):
         """更新用户最后发言时间（用于防刷分）"""
-        import time
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            UPDATE user_points 
-            SET last_message_time = ? 
-            WHERE chat_id = ? AND user_id = ?
-        """, (int(time.time()), chat_id, user_id))
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                UPDATE user_points 
+                SET last_message_time = ? 
+                WHERE chat_id = ? AND user_id = ?
+            """, (int(time.time()), chat_id, user_id))
+            
+            conn.commit()
+    
+    def get_last_message_time(self, chat_id: int, user_id: int) -> Optional[int]:
+        """获取用户最后获得积分的时间"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT last_message_time FROM user_points 
+                WHERE chat_id = ? AND user_id = ?
+            """, (chat_id, user_id))
+            
+            result = cursor.fetchone()
         
-        conn.commit()
-        conn.close()
+        return result[0] if result else None
     
     def can_earn_points(self, chat_id: int, user_id: int, cooldown: int = 60) -> bool:
         """检查用户是否可以获得积分（防刷分，冷却时间）"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT last_message_time FROM user_points 
-            WHERE chat_id = ? AND user_id = ?
-        """, (chat_id, user_id))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT last_message_time FROM user_points 
+                WHERE chat_id = ? AND user_id = ?
+            """, (chat_id, user_id))
+            
+            result = cursor.fetchone()
         
         if not result or not result[0]:
             return True
         
-        import time
         last_time = result[0]
         current_time = int(time.time())
         
         return (current_time - last_time) >= cooldown
     
+    def apply_points_batch(self, updates: List[Tuple[int, int, int, Optional[int]]],
+                           history: List[Tuple[int, int, int, str, int]]):
+        """
+        批量写入积分变化（单个事务）
+        
+        Args:
+            updates: [(chat_id, user_id, 积分增量, 最后发言时间或None), ...]
+            history: [(chat_id, user_id, 积分变化, 原因, 时间戳), ...]
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.executemany("""
+                INSERT INTO user_points (chat_id, user_id, points, last_message_time)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                    points = points + excluded.points,
+                    last_message_time = COALESCE(excluded.last_message_time, last_message_time)
+            """, updates)
+            
+            cursor.executemany("""
+                INSERT INTO points_history (chat_id, user_id, points_change, reason, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            """, history)
+            
+            changes = self._fetch_points(cursor, [(chat_id, user_id) for chat_id, user_id, _, _ in updates])
+            conn.commit()
+        
+        self._notify_points(changes)
+    
     # ========== 警告相关方法 ==========
     
     def add_warning(self, chat_id: int, user_id: int, admin_id: int, reason: str = None) -> int:
         """添加警告记录"""
-        import time
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO warnings (chat_id, user_id, admin_id, reason, timestamp)
-            VALUES (?, ?, ?, ?, ?)
-        """, (chat_id, user_id, admin_id, reason, int(time.time())))
-        
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                INSERT INTO warnings (chat_id, user_id, admin_id, reason, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            """, (chat_id, user_id, admin_id, reason, int(time.time())))
+            
+            conn.commit()
         
         # 返回警告总数
         return self.get_warning_count(chat_id, user_id)
     
     def get_warning_count(self, chat_id: int, user_id: int) -> int:
         """获取用户警告次数"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT COUNT(*) FROM warnings 
-            WHERE chat_id = ? AND user_id = ?
-        """, (chat_id, user_id))
-        
-        count = cursor.fetchone()[0]
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT COUNT(*) FROM warnings 
+                WHERE chat_id = ? AND user_id = ?
+            """, (chat_id, user_id))
+            
+            count = cursor.fetchone()[0]
         
         return count
     
+    def get_warned_users_count(self, chat_id: int) -> int:
+        """获取群组中被警告过的用户数"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT COUNT(DISTINCT user_id) FROM warnings WHERE chat_id = ?
+            """, (chat_id,))
+            
+            count = cursor.fetchone()[0]
+        
+        return count or 0
+    
     def clear_warnings(self, chat_id: int, user_id: int) -> int:
         """清除用户所有警告"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            DELETE FROM warnings 
-            WHERE chat_id = ? AND user_id = ?
-        """, (chat_id, user_id))
-        
-        deleted_count = cursor.rowcount
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                DELETE FROM warnings 
+                WHERE chat_id = ? AND user_id = ?
+            """, (chat_id, user_id))
+            
+            deleted_count = cursor.rowcount
+            conn.commit()
         
         logger.info(f"清除了用户 {user_id} 在群组 {chat_id} 的 {deleted_count} 条警告")
         return deleted_count
     
+    # ========== 用户资料相关方法 ==========
+    
+    def get_user_profiles(self, user_ids: List[int]) -> List[Tuple[int, Optional[str], Optional[str], Optional[str], int]]:
+        """批量获取用户资料（返回 (user_id, username, first_name, last_name, updated_at) 列表）"""
+        if not user_ids:
+            return []
+        
+        results = []
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # 分批查询，避免超过 SQLite 参数数量限制
+            for start in range(0, len(user_ids), 500):
+                batch = user_ids[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                cursor.execute(f"""
+                    SELECT user_id, username, first_name, last_name, updated_at 
+                    FROM user_profiles WHERE user_id IN ({placeholders})
+                """, batch)
+                results.extend(cursor.fetchall())
+        
+        return results
+    
+    def upsert_user_profiles(self, rows: List[Tuple[int, Optional[str], Optional[str], Optional[str], int]]):
+        """批量写入用户资料（单个事务）"""
+        if not rows:
+            return
+        
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.executemany("""
+                INSERT INTO user_profiles (user_id, username, first_name, last_name, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name,
+                    updated_at = excluded.updated_at
+            """, rows)
+            
+            conn.commit()
+    
     # ========== 群组设置相关方法 ==========
     
     def get_chat_setting(self, chat_id: int, setting_name: str, default_value=None):
@@ -335,20 +679,19 @@ class Database:
         # 白名单验证，防止 SQL 注入
         ALLOWED_SETTINGS = ['welcome_message', 'rules', 'auto_delete_ads', 
                            'welcome_new_members', 'auto_kick_bots', 
-                           'created_at', 'updated_at']
+                           'disabled_stages', 'created_at', 'updated_at']
         if setting_name not in ALLOWED_SETTINGS:
             raise ValueError(f"Invalid setting name: {setting_name}")
         
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(f"""
-            SELECT {setting_name} FROM chat_settings 
-            WHERE chat_id = ?
-        """, (chat_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(f"""
+                SELECT {setting_name} FROM chat_settings 
+                WHERE chat_id = ?
+            """, (chat_id,))
+            
+            result = cursor.fetchone()
         
         if result and result[0] is not None:
             return result[0]
@@ -358,39 +701,175 @@ class Database:
         """设置群组设置"""
         # 白名单验证，防止 SQL 注入
         ALLOWED_SETTINGS = ['welcome_message', 'rules', 'auto_delete_ads', 
-                           'welcome_new_members', 'auto_kick_bots']
+                           'welcome_new_members', 'auto_kick_bots', 'disabled_stages']
         if setting_name not in ALLOWED_SETTINGS:
             raise ValueError(f"Invalid setting name: {setting_name}")
         
-        import time
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # 检查群组是否存在
-        cursor.execute("""
-            SELECT chat_id FROM chat_settings WHERE chat_id = ?
-        """, (chat_id,))
-        
-        exists = cursor.fetchone()
-        
-        if exists:
-            # 更新
-            cursor.execute(f"""
-                UPDATE chat_settings 
-                SET {setting_name} = ?, updated_at = ?
-                WHERE chat_id = ?
-            """, (value, int(time.time()), chat_id))
-        else:
-            # 创建
-            cursor.execute(f"""
-                INSERT INTO chat_settings (chat_id, {setting_name}, created_at, updated_at)
-                VALUES (?, ?, ?, ?)
-            """, (chat_id, value, int(time.time()), int(time.time())))
-        
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # 检查群组是否存在
+            cursor.execute("""
+                SELECT chat_id FROM chat_settings WHERE chat_id = ?
+            """, (chat_id,))
+            
+            exists = cursor.fetchone()
+            
+            if exists:
+                # 更新
+                cursor.execute(f"""
+                    UPDATE chat_settings 
+                    SET {setting_name} = ?, updated_at = ?
+                    WHERE chat_id = ?
+                """, (value, int(time.time()), chat_id))
+            else:
+                # 创建
+                cursor.execute(f"""
+                    INSERT INTO chat_settings (chat_id, {setting_name}, created_at, updated_at)
+                    VALUES (?, ?, ?, ?)
+                """, (chat_id, value, int(time.time()), int(time.time())))
+            
+            conn.commit()
         logger.info(f"设置群组 {chat_id} 的 {setting_name} = {value}")
     
+    def get_chat_settings(self, chat_id: int) -> dict:
+        """一次查询获取群组的全部设置（未设置的使用默认值）"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT welcome_message, rules, auto_delete_ads, welcome_new_members, 
+                       auto_kick_bots, disabled_stages 
+                FROM chat_settings WHERE chat_id = ?
+            """, (chat_id,))
+            
+            result = cursor.fetchone()
+        
+        settings = dict(DEFAULT_CHAT_SETTINGS)
+        if result:
+            for name, value in zip(settings.keys(), result):
+                if value is not None:
+                    settings[name] = value
+        return settings
+    
+    def get_disabled_stages(self, chat_id: int):
+        """获取群组禁用的审核阶段（逗号分隔）"""
+        return self.get_chat_setting(chat_id, 'disabled_stages', '')
+    
+    def set_disabled_stages(self, chat_id: int, stages: str):
+        """设置群组禁用的审核阶段（逗号分隔）"""
+        self.set_chat_setting(chat_id, 'disabled_stages', stages)
+    
+    def get_ad_filters(self, chat_id: int) -> List[Tuple[str, str, str]]:
+        """获取群组自定义广告规则，返回 [(list_type, kind, value), ...]"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT list_type, kind, value FROM ad_filters
+                WHERE chat_id = ?
+                ORDER BY created_at, value
+            """, (chat_id,))
+            
+            return cursor.fetchall()
+    
+    def count_ad_filters(self, chat_id: int) -> int:
+        """获取群组自定义广告规则数量"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("SELECT COUNT(*) FROM ad_filters WHERE chat_id = ?", (chat_id,))
+            
+            return cursor.fetchone()[0]
+    
+    def add_ad_filters(self, chat_id: int, list_type: str, kind: str, values: List[str]) -> int:
+        """
+        添加群组自定义广告规则（已存在的忽略）
+        
+        Args:
+            chat_id: 群组ID
+            list_type: block 或 allow
+            kind: keyword 或 link
+            values: 规则内容
+        
+        Returns:
+            int: 新增的数量
+        """
+        now = int(time.time())
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.executemany("""
+                INSERT OR IGNORE INTO ad_filters (chat_id, list_type, kind, value, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, [(chat_id, list_type, kind, value, now) for value in values])
+            added = cursor.rowcount
+            
+            conn.commit()
+        return added
+    
+    def remove_ad_filters(self, chat_id: int, values: List[str]) -> int:
+        """
+        删除群组自定义广告规则（同一内容在屏蔽/放行名单中都会删除）
+        
+        Returns:
+            int: 删除的数量
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.executemany("""
+                DELETE FROM ad_filters WHERE chat_id = ? AND value = ?
+            """, [(chat_id, value) for value in values])
+            removed = cursor.rowcount
+            
+            conn.commit()
+        return removed
+    
+    # ========== 定时删除 ==========
+    
+    def save_scheduled_deletions(self, inserts: List[Tuple[int, int, float]], removes: List[Tuple[int, int]]):
+        """
+        保存定时删除的变化（单个事务）
+        
+        Args:
+            inserts: 新增的 (chat_id, message_id, 删除时间)
+            removes: 已删除的 (chat_id, message_id)
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            if inserts:
+                cursor.executemany("""
+                    INSERT OR REPLACE INTO scheduled_deletions (chat_id, message_id, due_at)
+                    VALUES (?, ?, ?)
+                """, inserts)
+            if removes:
+                cursor.executemany("""
+                    DELETE FROM scheduled_deletions WHERE chat_id = ? AND message_id = ?
+                """, removes)
+            
+            conn.commit()
+    
+    def take_scheduled_deletions(self) -> List[Tuple[int, int, float]]:
+        """
+        取出并清空所有定时删除记录（多个进程同时启动时每条记录只会被一个进程取得，
+        取得的进程会在下次保存时重新写入尚未执行的记录）
+        
+        Returns:
+            List[Tuple[int, int, float]]: (chat_id, message_id, 删除时间)
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT chat_id, message_id, due_at FROM scheduled_deletions")
+            rows = cursor.fetchall()
+            cursor.execute("DELETE FROM scheduled_deletions")
+            
+            conn.commit()
+        return rows
+    
     def get_welcome_message(self, chat_id: int):
         """获取欢迎消息"""
         return self.get_chat_setting(chat_id, 'welcome_message', None)
@@ -424,6 +903,75 @@ class Database:
         self.set_chat_setting(chat_id, 'welcome_new_members', 1 if enabled else 0)
 
 
+class AsyncDatabase:
+    """
+    异步数据库访问层
+    在专用线程池中执行 Database 的方法，避免 SQLite I/O 阻塞事件循环
+    
+    使用示例:
+        points = await adb.get_user_points(chat_id, user_id)
+    """
+    
+    def __init__(self, database: Database, max_workers: Optional[int] = None):
+        """
+        初始化异步数据库
+        
+        Args:
+            database: 同步数据库实例
+            max_workers: 工作线程数，默认与连接池大小一致
+        """
+        self.db = database
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or database.pool.size,
+            thread_name_prefix="db"
+        )
+        # 已提交但未完成的任务数（排队中和执行中）
+        self.pending = 0
+    
+    async def run(self, func, *args, **kwargs):
+        """在数据库线程池中执行任意同步函数"""
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(
+                self._executor,
+                functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            self.pending -= 1
+    
+    def __getattr__(self, name: str):
+        """将 Database 的方法包装为可 await 的协程函数"""
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+        
+        latency = db_latency.labels(name)
+        
+        @functools.wraps(attr)
+        async def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return await self.run(attr, *args, **kwargs)
+            finally:
+                latency.observe(time.perf_counter() - start_time)
+        
+        # 缓存包装结果，下次直接命中实例属性
+        setattr(self, name, wrapper)
+        return wrapper
+    
+    def close(self):
+        """等待未完成的查询结束，然后关闭线程池和连接池"""
+        self._executor.shutdown(wait=True)
+        self.db.close()
+
+
 # 全局数据库实例
 db = Database()
+adb = AsyncDatabase(db)
+
+metrics.gauge('db_pool_connections', '数据库连接池连接数', lambda: {
+    ('idle',): db.pool_stats()['idle'], ('in_use',): db.pool_stats()['in_use']
+}, ('state',))
+metrics.gauge('db_executor_queue', '未完成的数据库任务数（排队中和执行中）', lambda: adb.pending)
 
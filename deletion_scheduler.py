@@ -0,0 +1,260 @@
+"""
+定时删除模块
+记录“在某个时间删除某个群组的某条消息”，由后台任务按固定间隔批量执行，处理器不必等待：
+- 同一群组在同一个间隔内到期的消息合并为一次 deleteMessages 批量请求（每次最多 100 条）
+- 尚未执行的记录定期写入数据库，重启后继续删除（执行前就已到期的不写入）
+- /purge 等需要立即删除大量消息时使用 bulk_delete，分批并发执行
+"""
+import time
+import heapq
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+from telegram.error import EndPointNotFound
+from database import adb
+from config import DELETE_SCHEDULER_INTERVAL_MS, PURGE_CONCURRENCY
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# deleteMessages 每次最多删除的消息数
+BULK_DELETE_LIMIT = 100
+
+MessageKey = Tuple[int, int]
+
+
+async def delete_chunk(bot, chat_id: int, message_ids: List[int], bulk: bool = True) -> Tuple[int, bool]:
+    """
+    删除同一群组的消息（最多 BULK_DELETE_LIMIT 条，多条时使用批量接口）
+    
+    Args:
+        bot: 机器人实例
+        chat_id: 群组ID
+        message_ids: 消息ID列表
+        bulk: 是否使用批量接口（已知服务器不支持时传 False）
+    
+    Returns:
+        (逐条删除时失败的消息数, 批量接口是否可用)；批量接口不报告单条消息的结果
+    """
+    if len(message_ids) > 1 and bulk:
+        try:
+            await bot.delete_messages(chat_id, message_ids)
+            return 0, True
+        except EndPointNotFound:
+            # 自建的旧版 Bot API 服务器不支持批量删除，之后逐条删除
+            bulk = False
+            logger.warning("Bot API 不支持 deleteMessages，改为逐条删除")
+    results = await asyncio.gather(
+        *(bot.delete_message(chat_id, message_id) for message_id in message_ids),
+        return_exceptions=True
+    )
+    return sum(1 for result in results if isinstance(result, Exception)), bulk
+
+
+async def bulk_delete(bot, chat_id: int, message_ids: List[int], concurrency: int = PURGE_CONCURRENCY,
+                      progress: Optional[Callable[[int, int], Awaitable[None]]] = None) -> Tuple[int, int]:
+    """
+    立即清理大量消息：每 BULK_DELETE_LIMIT 条一个批量请求，最多 concurrency 个请求同时进行
+    
+    Args:
+        bot: 机器人实例
+        chat_id: 群组ID
+        message_ids: 消息ID列表
+        concurrency: 同时进行的请求数
+        progress: 每完成一批后调用 progress(已处理数, 总数)
+    
+    Returns:
+        (已处理的消息数, 失败的消息数)
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    bulk = True
+    processed = failed = 0
+    
+    async def run(chunk: List[int]):
+        nonlocal bulk, processed, failed
+        async with semaphore:
+            try:
+                chunk_failed, bulk = await delete_chunk(bot, chat_id, chunk, bulk)
+            except Exception as e:
+                chunk_failed = len(chunk)
+                logger.warning(f"清理群组 {chat_id} 的 {len(chunk)} 条消息失败: {e}")
+            processed += len(chunk)
+            failed += chunk_failed
+            if progress is not None:
+                await progress(processed, len(message_ids))
+    
+    await asyncio.gather(*(
+        run(message_ids[start:start + BULK_DELETE_LIMIT])
+        for start in range(0, len(message_ids), BULK_DELETE_LIMIT)
+    ))
+    return processed, failed
+
+
+class DeletionScheduler:
+    """定时删除调度器"""
+    
+    def __init__(self, interval_ms: int = DELETE_SCHEDULER_INTERVAL_MS):
+        """
+        初始化调度器
+        
+        Args:
+            interval_ms: 检查间隔（毫秒），同一间隔内到期的消息一起删除
+        """
+        self.interval = max(interval_ms, 10) / 1000
+        # 按删除时间排序: (删除时间, chat_id, message_id)，重新安排的旧记录在弹出时跳过
+        self._heap: List[Tuple[float, int, int]] = []
+        # 尚未执行的记录: {(chat_id, message_id): 删除时间}
+        self._pending: Dict[MessageKey, float] = {}
+        # 已写入数据库的记录，以及等待写入、等待从数据库删除的记录
+        self._saved: Set[MessageKey] = set()
+        self._unsaved: Set[MessageKey] = set()
+        self._removed: Set[MessageKey] = set()
+        
+        self._bot = None
+        self._bulk_supported = True
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        
+        # 统计信息
+        self.deleted = 0
+        self.failed = 0
+        self.batches = 0
+    
+    def schedule(self, chat_id: int, message_ids: Union[int, Iterable[int]], delay: float = 0):
+        """
+        安排删除消息
+        
+        Args:
+            chat_id: 群组ID
+            message_ids: 消息ID（一个或多个）
+            delay: 延迟（秒），0 表示在下一个间隔删除
+        """
+        if isinstance(message_ids, int):
+            message_ids = (message_ids,)
+        due = time.time() + delay
+        for message_id in message_ids:
+            key = (chat_id, message_id)
+            self._pending[key] = due
+            self._unsaved.add(key)
+            heapq.heappush(self._heap, (due, chat_id, message_id))
+    
+    def _pop_due(self, now: float) -> Dict[int, List[int]]:
+        """取出已到期的记录，按群组分组"""
+        due: Dict[int, List[int]] = {}
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            due_at, chat_id, message_id = heapq.heappop(heap)
+            key = (chat_id, message_id)
+            if self._pending.get(key) != due_at:
+                continue
+            del self._pending[key]
+            self._unsaved.discard(key)
+            if key in self._saved:
+                self._saved.discard(key)
+                self._removed.add(key)
+            due.setdefault(chat_id, []).append(message_id)
+        return due
+    
+    async def _delete(self, chat_id: int, message_ids: List[int]):
+        """删除同一群组的消息（多条时使用批量接口）"""
+        for start in range(0, len(message_ids), BULK_DELETE_LIMIT):
+            chunk = message_ids[start:start + BULK_DELETE_LIMIT]
+            try:
+                failed, self._bulk_supported = await delete_chunk(self._bot, chat_id, chunk, self._bulk_supported)
+                self.failed += failed
+                self.deleted += len(chunk) - failed
+                self.batches += 1
+            except Exception as e:
+                self.failed += len(chunk)
+                logger.warning(f"定时删除群组 {chat_id} 的 {len(chunk)} 条消息失败: {e}")
+    
+    async def run_due(self, now: Optional[float] = None) -> int:
+        """
+        执行已到期的删除，并保存尚未执行的记录
+        
+        Returns:
+            int: 本次删除的消息数
+        """
+        async with self._lock:
+            due = self._pop_due(time.time() if now is None else now)
+            if due and self._bot is not None:
+                await asyncio.gather(*(self._delete(chat_id, ids) for chat_id, ids in due.items()))
+            await self._save()
+            return sum(len(ids) for ids in due.values())
+    
+    async def _save(self):
+        """把新增和已执行的记录写入数据库"""
+        if not self._unsaved and not self._removed:
+            return
+        # 写入期间新安排的记录留到下次保存（执行删除需要持有锁，不会与写入同时进行）
+        unsaved, self._unsaved = self._unsaved, set()
+        inserts = [(chat_id, message_id, self._pending[(chat_id, message_id)])
+                   for chat_id, message_id in unsaved]
+        removes = list(self._removed)
+        try:
+            await adb.save_scheduled_deletions(inserts, removes)
+        except Exception as e:
+            self._unsaved |= unsaved
+            logger.error(f"保存定时删除记录失败，将稍后重试: {e}")
+            return
+        self._saved |= unsaved
+        self._removed.difference_update(removes)
+    
+    async def _load(self):
+        """取出数据库中上次未执行的记录"""
+        try:
+            rows = await adb.take_scheduled_deletions()
+        except Exception as e:
+            logger.error(f"加载定时删除记录失败: {e}")
+            return
+        now = time.time()
+        for chat_id, message_id, due_at in rows:
+            self.schedule(chat_id, message_id, max(0.0, due_at - now))
+        if rows:
+            logger.info(f"已恢复 {len(rows)} 条定时删除记录")
+    
+    async def _run(self):
+        """定时执行循环"""
+        await self._load()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_due()
+            except Exception as e:
+                logger.error(f"执行定时删除出错: {e}")
+    
+    def start(self, bot):
+        """启动定时执行（需要在事件循环中调用）"""
+        self._bot = bot
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            logger.info(f"定时删除调度器已启动: 间隔 {self.interval * 1000:.0f}ms")
+    
+    async def close(self):
+        """停止定时执行，尚未执行的记录写入数据库（机器人已停止，不再调用 API）"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        async with self._lock:
+            await self._save()
+        if self._unsaved:
+            logger.error(f"关闭时仍有 {len(self._unsaved)} 条定时删除记录未能保存")
+    
+    def stats(self) -> dict:
+        """获取调度器统计信息"""
+        return {
+            'pending': len(self._pending),
+            'deleted': self.deleted,
+            'failed': self.failed,
+            'batches': self.batches,
+        }
+
+
+# 全局定时删除调度器
+deletion_scheduler = DeletionScheduler()
+
+metrics.gauge('deletion_scheduler_pending', '等待定时删除的消息数', lambda: len(deletion_scheduler._pending))
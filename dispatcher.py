@@ -0,0 +1,171 @@
+"""
+更新分发模块
+按 chat_id 把更新分配到固定数量的处理通道：同一群组的更新按到达顺序依次处理，
+不同群组的更新并行处理，每个通道的队列有上限并记录积压情况
+"""
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, List, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from config import DISPATCHER_LANES, DISPATCHER_QUEUE_SIZE
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Lane:
+    """处理通道（一个有界队列 + 一个工作协程）"""
+    
+    def __init__(self, index: int, queue_size: int):
+        self.index = index
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        # 入队锁：队列满时等待的更新仍按到达顺序入队
+        self.put_lock = asyncio.Lock()
+        self.worker: Optional[asyncio.Task] = None
+        
+        # 统计信息
+        self.processed = 0
+        self.errors = 0
+        self.blocked = 0
+        self.waiting = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.busy_time = 0.0
+    
+    def stats(self) -> dict:
+        """获取通道统计信息"""
+        return {
+            'depth': self.queue.qsize(),
+            'waiting': self.waiting,
+            'max_depth': self.max_depth,
+            'processed': self.processed,
+            'errors': self.errors,
+            'blocked': self.blocked,
+            'avg_wait': self.total_wait / self.processed if self.processed else 0.0,
+            'max_wait': self.max_wait,
+            'busy_time': self.busy_time,
+        }
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    按群组保序的更新处理器
+    
+    - 更新按 chat_id（没有聊天时按 user_id）分配到 N 个通道
+    - 每个通道由一个工作协程依次处理，保证同一群组内的防刷屏计数和积分冷却不会并发修改
+    - 通道队列满时新的更新在入队处等待（背压），等待次数计入统计
+    
+    注意：处理器在通道中等待 callback 完成，因此消息处理器需要使用 block=True，
+    否则 callback 会被放到独立任务中执行，失去顺序保证
+    """
+    
+    def __init__(self, lanes: int, queue_size: int = 100):
+        """
+        初始化分发器
+        
+        Args:
+            lanes: 通道数量（即最多同时处理的群组数）
+            queue_size: 每个通道的队列上限
+        """
+        self.lane_count = max(1, lanes)
+        self.queue_size = max(1, queue_size)
+        # 每个通道最多 queue_size 条排队 + 1 条处理中，再留同样多的名额给入队等待的更新
+        super().__init__(max_concurrent_updates=self.lane_count * (self.queue_size + 1) * 2)
+        self._lanes: List[Lane] = []
+    
+    @staticmethod
+    def lane_key(update: object) -> int:
+        """获取更新的分组键"""
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return 0
+    
+    def lane_for(self, update: object) -> Lane:
+        """获取更新所属的通道"""
+        return self._lanes[self.lane_key(update) % self.lane_count]
+    
+    async def initialize(self) -> None:
+        """创建通道并启动工作协程"""
+        if self._lanes:
+            return
+        loop = asyncio.get_running_loop()
+        for index in range(self.lane_count):
+            lane = Lane(index, self.queue_size)
+            lane.worker = loop.create_task(self._run_lane(lane))
+            self._lanes.append(lane)
+        logger.info(f"✅ 更新分发器已启动: {self.lane_count} 个通道，每个队列上限 {self.queue_size}")
+    
+    async def shutdown(self) -> None:
+        """停止工作协程（Application.stop 已等待所有更新处理完毕）"""
+        for lane in self._lanes:
+            if lane.worker:
+                lane.worker.cancel()
+        await asyncio.gather(*(lane.worker for lane in self._lanes if lane.worker), return_exceptions=True)
+        self._lanes = []
+    
+    async def do_process_update(self, update: object, coroutine: "Awaitable[Any]") -> None:
+        """把更新放入所属通道并等待处理完成"""
+        lane = self.lane_for(update)
+        future = asyncio.get_running_loop().create_future()
+        
+        lane.waiting += 1
+        try:
+            async with lane.put_lock:
+                if lane.queue.full():
+                    lane.blocked += 1
+                await lane.queue.put((coroutine, future, time.perf_counter()))
+        finally:
+            lane.waiting -= 1
+        lane.max_depth = max(lane.max_depth, lane.queue.qsize())
+        
+        await future
+    
+    async def _run_lane(self, lane: Lane):
+        """通道工作循环：依次处理队列中的更新"""
+        while True:
+            coroutine, future, enqueued_at = await lane.queue.get()
+            started_at = time.perf_counter()
+            wait = started_at - enqueued_at
+            lane.total_wait += wait
+            lane.max_wait = max(lane.max_wait, wait)
+            try:
+                await coroutine
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                lane.errors += 1
+                logger.error(f"通道 {lane.index} 处理更新出错: {e}", exc_info=e)
+            finally:
+                lane.processed += 1
+                lane.busy_time += time.perf_counter() - started_at
+                lane.queue.task_done()
+                if not future.done():
+                    future.set_result(None)
+    
+    def stats(self) -> dict:
+        """获取分发器统计信息"""
+        lanes = [lane.stats() for lane in self._lanes]
+        return {
+            'lanes': self.lane_count,
+            'queue_size': self.queue_size,
+            'depth': sum(lane['depth'] for lane in lanes),
+            'waiting': sum(lane['waiting'] for lane in lanes),
+            'processed': sum(lane['processed'] for lane in lanes),
+            'blocked': sum(lane['blocked'] for lane in lanes),
+            'per_lane': lanes,
+        }
+
+
+# 全局分发器实例（DISPATCHER_LANES 为 0 时不启用，使用 PTB 默认处理方式）
+dispatcher = ChatOrderedUpdateProcessor(DISPATCHER_LANES, DISPATCHER_QUEUE_SIZE) if DISPATCHER_LANES > 0 else None
+
+if dispatcher:
+    metrics.gauge('dispatcher_lane_depth', '分发通道队列中的更新数', lambda: {
+        (str(index),): lane['depth'] + lane['waiting'] for index, lane in enumerate(dispatcher.stats()['per_lane'])
+    }, ('lane',))
@@ -0,0 +1,419 @@
+"""
+消息指纹模块
+为每条消息计算 64 位 SimHash 指纹，按汉明距离识别近似重复的消息（改几个字、加标点也能识别）：
+- 用户窗口：每个用户最近几条消息，逐条比较（窗口很小）
+- 群组索引：每个群组最近一段时间出现过的内容，相近的指纹归为同一内容，按指纹分段建立索引，
+  查询只需几次字典查找；每种内容按时间片统计发送者，多个不同用户发送相同内容时判定为刷群
+用户数、群组数、每个群组的内容数和时间片数都有上限，内存占用有界
+"""
+import re
+import time
+import logging
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+from config import (
+    DUPLICATE_CHECK_COUNT, NEAR_DUPLICATE_USER_DISTANCE, NEAR_DUPLICATE_CHAT_DISTANCE, NEAR_DUPLICATE_MIN_SHINGLES,
+    NEAR_DUPLICATE_MAX_USERS, NEAR_DUPLICATE_MAX_CHATS, RAID_SENDER_THRESHOLD, RAID_WINDOW,
+    RAID_BUCKETS, RAID_MAX_CLUSTERS, RAID_MAX_MESSAGES, RAID_MIN_SHINGLES, RAID_MUTE_MAX_HISTORY
+)
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_BITS = 64
+_MASK = (1 << FINGERPRINT_BITS) - 1
+
+# 计算指纹前去掉空白、标点和符号
+_NOISE = re.compile(r'[\W_]+')
+
+# 分词长度（相邻 2 个字符为一个词，对中文短消息效果较好）
+SHINGLE_SIZE = 2
+
+# 判定原因
+REASON_USER = "重复消息"
+REASON_RAID = "刷群"
+
+
+def shingles(text: str) -> List[str]:
+    """去掉空白、标点后按 SHINGLE_SIZE 个字符分词"""
+    normalized = _NOISE.sub('', text.lower())
+    if len(normalized) <= SHINGLE_SIZE:
+        return [normalized]
+    return [normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)]
+
+
+def simhash(text: str) -> int:
+    """计算文本的 64 位 SimHash 指纹"""
+    return simhash_shingles(shingles(text))
+
+
+def simhash_shingles(shingles: List[str]) -> int:
+    """
+    按分词计算 64 位 SimHash 指纹
+    
+    每个词的哈希按位投票，多数为 1 的位设为 1。计票用按位并行的计数器（每个 int 保存所有位的同一个二进制位），
+    每个词只需几次整数位运算，不必逐位循环 64 次。
+    使用内置 hash()，指纹只在当前进程内可比较（窗口也只保存在内存中）
+    """
+    # counters[i] 的第 b 位 = 第 b 位计票数的第 i 个二进制位
+    counters: List[int] = []
+    for shingle in shingles:
+        carry = hash(shingle) & _MASK
+        for i in range(len(counters)):
+            counters[i], carry = counters[i] ^ carry, counters[i] & carry
+            if not carry:
+                break
+        if carry:
+            counters.append(carry)
+    
+    # 票数 >= 一半以上的位设为 1：逐位（从高到低）与阈值比较
+    threshold = len(shingles) // 2 + 1
+    counters.extend([0] * (threshold.bit_length() - len(counters)))
+    greater, equal = 0, _MASK
+    for i in range(len(counters) - 1, -1, -1):
+        if (threshold >> i) & 1:
+            equal &= counters[i]
+        else:
+            greater |= equal & counters[i]
+            equal &= ~counters[i]
+    return (greater | equal) & _MASK
+
+
+def hamming(a: int, b: int) -> int:
+    """两个指纹的汉明距离"""
+    return (a ^ b).bit_count()
+
+
+class ContentCluster:
+    """
+    群组中的一种内容（指纹相近的消息）
+    
+    发送者按时间片记录，过期的时间片整体丢弃；senders 记录每个用户出现在几个时间片中，
+    因此不同发送者数就是 len(senders)，不必合并各时间片
+    """
+    __slots__ = ('id', 'fingerprint', 'buckets', 'senders', 'last_bucket', 'raided')
+    
+    def __init__(self, cluster_id: int, fingerprint: int):
+        self.id = cluster_id
+        self.fingerprint = fingerprint
+        # 按时间顺序: (时间片编号, {用户ID: [消息ID, ...]})
+        self.buckets: Deque[Tuple[int, Dict[int, List[int]]]] = deque()
+        self.senders: Dict[int, int] = {}
+        self.last_bucket = 0
+        # 已判定为刷群（之后的相同内容直接处理，不再记录发送者）
+        self.raided = False
+    
+    def trim(self, oldest_bucket: int):
+        """丢弃早于 oldest_bucket 的时间片"""
+        buckets = self.buckets
+        senders = self.senders
+        while buckets and buckets[0][0] < oldest_bucket:
+            _, members = buckets.popleft()
+            for user_id in members:
+                remaining = senders[user_id] - 1
+                if remaining:
+                    senders[user_id] = remaining
+                else:
+                    del senders[user_id]
+    
+    def add(self, bucket: int, user_id: int, message_id: Optional[int], max_messages: int):
+        """记录一条消息"""
+        self.last_bucket = bucket
+        if not self.buckets or self.buckets[-1][0] != bucket:
+            self.buckets.append((bucket, {}))
+        members = self.buckets[-1][1]
+        message_ids = members.get(user_id)
+        if message_ids is None:
+            message_ids = members[user_id] = []
+            self.senders[user_id] = self.senders.get(user_id, 0) + 1
+        if message_id is not None and len(message_ids) < max_messages:
+            message_ids.append(message_id)
+    
+    def messages(self) -> Dict[int, List[int]]:
+        """窗口内各发送者的消息ID"""
+        result: Dict[int, List[int]] = {}
+        for _, members in self.buckets:
+            for user_id, message_ids in members.items():
+                result.setdefault(user_id, []).extend(message_ids)
+        return result
+    
+    def clear(self):
+        """判定为刷群后不再需要发送者记录"""
+        self.buckets.clear()
+        self.senders.clear()
+
+
+class ChatIndex:
+    """
+    群组内容索引（按最近活跃时间淘汰）
+    
+    指纹分成 distance + 1 段，距离不超过 distance 的两个指纹至少有一段完全相同（抽屉原理），
+    因此只需查这几段的索引，不必与群组中的每种内容比较
+    """
+    __slots__ = ('distance', 'max_clusters', '_bands', '_clusters', '_index', '_sequence')
+    
+    def __init__(self, distance: int, max_clusters: int):
+        self.distance = distance
+        self.max_clusters = max(1, max_clusters)
+        # 各段的 (起始位, 掩码)
+        band_count = min(max(distance, 0), FINGERPRINT_BITS - 1) + 1
+        width = FINGERPRINT_BITS // band_count
+        self._bands: List[Tuple[int, int]] = []
+        for band in range(band_count):
+            start = band * width
+            bits = FINGERPRINT_BITS - start if band == band_count - 1 else width
+            self._bands.append((start, (1 << bits) - 1))
+        # 按最近活跃排序: {内容ID: 内容}
+        self._clusters: "OrderedDict[int, ContentCluster]" = OrderedDict()
+        # {(段号, 段值): {内容ID: 内容}}
+        self._index: Dict[Tuple[int, int], Dict[int, ContentCluster]] = {}
+        self._sequence = 0
+    
+    def __len__(self) -> int:
+        return len(self._clusters)
+    
+    def _keys(self, fingerprint: int):
+        return [(band, (fingerprint >> start) & mask) for band, (start, mask) in enumerate(self._bands)]
+    
+    def _remove(self, cluster: ContentCluster):
+        del self._clusters[cluster.id]
+        for key in self._keys(cluster.fingerprint):
+            bucket = self._index.get(key)
+            if bucket is not None:
+                bucket.pop(cluster.id, None)
+                if not bucket:
+                    del self._index[key]
+    
+    def expire(self, oldest_bucket: int):
+        """删除整个时间窗口内都没有出现过的内容"""
+        clusters = self._clusters
+        while clusters:
+            cluster = next(iter(clusters.values()))
+            if cluster.last_bucket >= oldest_bucket:
+                break
+            self._remove(cluster)
+    
+    def find(self, fingerprint: int) -> Optional[ContentCluster]:
+        """查找距离不超过 distance 的内容（有多个时取最近的）"""
+        best, best_distance = None, self.distance + 1
+        for key in self._keys(fingerprint):
+            bucket = self._index.get(key)
+            if bucket:
+                for cluster in bucket.values():
+                    distance = hamming(fingerprint, cluster.fingerprint)
+                    if distance < best_distance:
+                        best, best_distance = cluster, distance
+        return best
+    
+    def touch(self, cluster: ContentCluster):
+        """标记为最近活跃"""
+        self._clusters.move_to_end(cluster.id)
+    
+    def create(self, fingerprint: int) -> ContentCluster:
+        """新建内容，超过上限时淘汰最久未活跃的内容"""
+        self._sequence += 1
+        cluster = ContentCluster(self._sequence, fingerprint)
+        self._clusters[cluster.id] = cluster
+        for key in self._keys(fingerprint):
+            self._index.setdefault(key, {})[cluster.id] = cluster
+        while len(self._clusters) > self.max_clusters:
+            self._remove(next(iter(self._clusters.values())))
+        return cluster
+
+
+class UserWindow:
+    """单个用户在群组中的最近指纹和发言数"""
+    __slots__ = ('fingerprints', 'messages')
+    
+    def __init__(self, size: int):
+        self.fingerprints: Deque[int] = deque(maxlen=size)
+        # 检测器记录到的发言数（用于区分新账号和老成员，窗口被淘汰后重新计数）
+        self.messages = 0
+
+
+class DuplicateVerdict:
+    """重复消息判定结果"""
+    __slots__ = ('reason', 'raid', 'senders', 'restrict', 'messages')
+    
+    def __init__(self, reason: str, senders: Optional[List[int]] = None,
+                 messages: Optional[Dict[int, List[int]]] = None, restrict: Optional[List[int]] = None):
+        """
+        Args:
+            reason: 判定原因（REASON_USER / REASON_RAID）
+            senders: 刷群时窗口内的所有发送者（含当前用户）
+            messages: 刷群时需要一并删除的此前消息 {用户ID: [消息ID, ...]}（不含当前消息）
+            restrict: 刷群时可以禁言的发送者（发言记录很少的新账号）
+        """
+        self.reason = reason
+        self.raid = reason == REASON_RAID
+        self.senders = senders or []
+        self.messages = messages or {}
+        self.restrict = restrict or []
+    
+    def __repr__(self) -> str:
+        return (f"DuplicateVerdict(reason={self.reason!r}, senders={self.senders}, "
+                f"restrict={self.restrict}, messages={self.messages})")
+
+
+class DuplicateTracker:
+    """近似重复消息检测（用户窗口 + 群组内容索引，按最近使用淘汰）"""
+    
+    def __init__(self, user_window: int = DUPLICATE_CHECK_COUNT, user_distance: int = NEAR_DUPLICATE_USER_DISTANCE,
+                 chat_distance: int = NEAR_DUPLICATE_CHAT_DISTANCE, raid_threshold: int = RAID_SENDER_THRESHOLD,
+                 raid_window: float = RAID_WINDOW, raid_buckets: int = RAID_BUCKETS,
+                 max_clusters: int = RAID_MAX_CLUSTERS, max_messages: int = RAID_MAX_MESSAGES,
+                 max_users: int = NEAR_DUPLICATE_MAX_USERS, max_chats: int = NEAR_DUPLICATE_MAX_CHATS,
+                 min_shingles: int = NEAR_DUPLICATE_MIN_SHINGLES, raid_min_shingles: int = RAID_MIN_SHINGLES,
+                 mute_max_history: int = RAID_MUTE_MAX_HISTORY):
+        """
+        初始化检测器
+        
+        Args:
+            user_window: 每个用户保留的最近消息数
+            user_distance: 与本人最近消息的距离不超过此值视为重复（0 为完全相同）
+            chat_distance: 群组内距离不超过此值视为相同内容
+            raid_threshold: 时间窗口内多少个不同用户发送相同内容视为刷群，0 表示只检查用户窗口
+            raid_window: 刷群检测时间窗口（秒）
+            raid_buckets: 时间窗口划分的时间片数
+            max_clusters: 每个群组最多跟踪的不同内容数
+            max_messages: 每个用户每种内容最多记录的消息ID数
+            max_users: 最多跟踪的 (群组, 用户) 数
+            max_chats: 最多跟踪的群组数
+            min_shingles: 不同的词少于此数的短消息只检查完全相同（距离 0），不做近似比较
+            raid_min_shingles: 不同的词少于此数的内容不参与刷群检测（“谢谢”“收到”之类的常见回复）
+            mute_max_history: 刷群时只有发言数不超过此值（含刷群消息）的发送者可以禁言
+        """
+        self.user_window = max(1, user_window)
+        self.user_distance = user_distance
+        self.chat_distance = chat_distance
+        self.raid_threshold = raid_threshold
+        self.raid_buckets = max(1, raid_buckets)
+        self.bucket_width = max(raid_window, 1) / self.raid_buckets
+        self.max_clusters = max_clusters
+        self.max_messages = max_messages
+        self.max_users = max(1, max_users)
+        self.max_chats = max(1, max_chats)
+        self.min_shingles = min_shingles
+        self.raid_min_shingles = raid_min_shingles
+        self.mute_max_history = mute_max_history
+        self._users: "OrderedDict[Tuple[int, int], UserWindow]" = OrderedDict()
+        self._chats: "OrderedDict[int, ChatIndex]" = OrderedDict()
+        
+        # 统计信息
+        self.checked = 0
+        self.user_duplicates = 0
+        self.raids = 0
+        self.raid_messages = 0
+    
+    def _user_window(self, chat_id: int, user_id: int) -> UserWindow:
+        key = (chat_id, user_id)
+        window = self._users.get(key)
+        if window is None:
+            window = self._users[key] = UserWindow(self.user_window)
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(key)
+        return window
+    
+    def _chat_index(self, chat_id: int) -> ChatIndex:
+        index = self._chats.get(chat_id)
+        if index is None:
+            index = self._chats[chat_id] = ChatIndex(self.chat_distance, self.max_clusters)
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return index
+    
+    def check(self, chat_id: int, user_id: int, text: str, message_id: Optional[int] = None,
+              now: Optional[float] = None) -> Optional[DuplicateVerdict]:
+        """
+        检查消息是否重复并记录指纹
+        
+        Args:
+            chat_id: 群组ID
+            user_id: 发送者ID
+            text: 消息文本
+            message_id: 消息ID（刷群时用于删除此前的消息）
+            now: 当前时间，默认 time.time()
+        
+        Returns:
+            重复时返回判定结果，否则返回 None
+        """
+        now = time.time() if now is None else now
+        tokens = shingles(text)
+        fingerprint = simhash_shingles(tokens)
+        distinct = len(set(tokens))
+        # 短消息改一两个字指纹就差很多位，与不同内容难以区分，只按完全相同判断
+        user_distance = self.user_distance if distinct >= self.min_shingles else 0
+        raid_check = self.raid_threshold > 0 and distinct >= self.raid_min_shingles
+        self.checked += 1
+        
+        user_window = self._user_window(chat_id, user_id)
+        user_window.messages += 1
+        
+        cluster = None
+        if raid_check:
+            bucket = int(now // self.bucket_width)
+            oldest_bucket = bucket - self.raid_buckets + 1
+            index = self._chat_index(chat_id)
+            index.expire(oldest_bucket)
+            cluster = index.find(fingerprint)
+            if cluster is not None:
+                index.touch(cluster)
+                # 已判定为刷群的内容：之后的相同内容只删除，不处罚发送者
+                if cluster.raided:
+                    cluster.last_bucket = bucket
+                    self.raid_messages += 1
+                    return DuplicateVerdict(REASON_RAID, [user_id])
+        
+        if any(hamming(fingerprint, other) <= user_distance for other in user_window.fingerprints):
+            self.user_duplicates += 1
+            return DuplicateVerdict(REASON_USER)
+        user_window.fingerprints.append(fingerprint)
+        
+        if not raid_check:
+            return None
+        if cluster is None:
+            cluster = index.create(fingerprint)
+        cluster.trim(oldest_bucket)
+        cluster.add(bucket, user_id, message_id, self.max_messages)
+        if len(cluster.senders) < self.raid_threshold:
+            return None
+        
+        # 达到阈值：删除窗口内所有发送者此前发送的相同内容，只有新账号可以禁言
+        messages = cluster.messages()
+        if message_id is not None and message_id in messages.get(user_id, ()):
+            messages[user_id].remove(message_id)
+        restrict = [sender for sender in messages if self._history(chat_id, sender) <= self.mute_max_history]
+        cluster.raided = True
+        cluster.clear()
+        self.raids += 1
+        self.raid_messages += 1
+        return DuplicateVerdict(REASON_RAID, list(messages), messages, restrict)
+    
+    def _history(self, chat_id: int, user_id: int) -> int:
+        """用户在群组中被记录到的发言数（不影响淘汰顺序）"""
+        window = self._users.get((chat_id, user_id))
+        return window.messages if window is not None else 0
+    
+    def stats(self) -> dict:
+        """获取统计信息"""
+        return {
+            'users': len(self._users),
+            'chats': len(self._chats),
+            'clusters': sum(len(index) for index in self._chats.values()),
+            'checked': self.checked,
+            'user_duplicates': self.user_duplicates,
+            'raids': self.raids,
+            'raid_messages': self.raid_messages,
+        }
+
+
+# 全局近似重复检测器
+duplicate_tracker = DuplicateTracker()
+
+metrics.gauge('near_duplicate_windows', '近似重复检测跟踪的窗口数', lambda: {
+    ('user',): len(duplicate_tracker._users), ('chat',): len(duplicate_tracker._chats),
+}, ('kind',))
@@ -0,0 +1,166 @@
+"""
+刷屏状态模块
+按 (chat_id, user_id) 记录最近几条消息的时间，判断是否在时间窗口内发送了过多消息：
+- 每个用户一个定长环形缓冲（array 存储时间戳），不随消息数增长
+- 时间轮定期清理超过时间窗口未发言的用户，内存只与最近活跃的用户数有关
+"""
+import sys
+import time
+import logging
+from array import array
+from typing import Dict, List, Optional, Set, Tuple
+from config import FLOOD_LIMIT, FLOOD_WINDOW
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 时间轮的槽数（每个槽覆盖 window / (WHEEL_SLOTS - 1) 秒）
+WHEEL_SLOTS = 16
+
+
+class FloodEntry:
+    """单个用户的刷屏状态（环形缓冲）"""
+    __slots__ = ('times', 'head', 'count', 'last')
+    
+    def __init__(self, size: int):
+        self.times = array('d', bytes(8 * size))
+        # 下一个写入位置（缓冲已满时也是最早一条的位置）
+        self.head = 0
+        self.count = 0
+        self.last = 0.0
+    
+    def record(self, now: float, window: float) -> bool:
+        """
+        记录一条消息
+        
+        Returns:
+            bool: 包括这条消息在内，最近 size 条消息都在时间窗口内返回True
+        """
+        times = self.times
+        size = len(times)
+        times[self.head] = now
+        self.head = (self.head + 1) % size
+        if self.count < size:
+            self.count += 1
+        self.last = now
+        # head 现在指向缓冲中最早的一条
+        return self.count == size and now - times[self.head] < window
+
+
+class FloodTracker:
+    """
+    刷屏跟踪器
+    
+    时间轮按用户的过期时间（最后发言时间 + 时间窗口）分槽；发言时不移动用户，
+    清理到某个槽时再检查：已过期的删除，仍在发言的按新的过期时间放入后面的槽。
+    清理在记录消息时顺带进行，不需要后台任务
+    """
+    
+    def __init__(self, limit: int = FLOOD_LIMIT, window: float = FLOOD_WINDOW):
+        """
+        初始化跟踪器
+        
+        Args:
+            limit: 时间窗口内最多允许的消息数（达到即视为刷屏）
+            window: 时间窗口（秒）
+        """
+        self.limit = max(1, limit)
+        self.window = max(window, 0.001)
+        self.tick = self.window / (WHEEL_SLOTS - 1)
+        self._entries: Dict[Tuple[int, int], FloodEntry] = {}
+        self._wheel: List[Set[Tuple[int, int]]] = [set() for _ in range(WHEEL_SLOTS)]
+        # 下一个待清理的时间刻度
+        self._cursor: Optional[int] = None
+        
+        # 统计信息
+        self.floods = 0
+        self.evictions = 0
+    
+    def _schedule(self, key: Tuple[int, int], entry: FloodEntry):
+        self._wheel[int((entry.last + self.window) // self.tick) % WHEEL_SLOTS].add(key)
+    
+    def sweep(self, now: float):
+        """清理到当前时间为止到期的槽"""
+        current = int(now // self.tick)
+        if self._cursor is None:
+            self._cursor = current
+            return
+        if current < self._cursor:
+            return
+        # 长时间没有消息时，每个槽只需清理一次
+        start = max(self._cursor, current - WHEEL_SLOTS + 1)
+        for tick in range(start, current + 1):
+            slot = self._wheel[tick % WHEEL_SLOTS]
+            if not slot:
+                continue
+            self._wheel[tick % WHEEL_SLOTS] = set()
+            for key in slot:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry.last + self.window <= now:
+                    del self._entries[key]
+                    self.evictions += 1
+                else:
+                    self._schedule(key, entry)
+        self._cursor = current + 1
+    
+    def record(self, chat_id: int, user_id: int, now: Optional[float] = None) -> bool:
+        """
+        记录一条消息并检查是否刷屏
+        
+        Returns:
+            bool: 时间窗口内的消息数达到上限返回True
+        """
+        now = time.time() if now is None else now
+        self.sweep(now)
+        key = (chat_id, user_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = FloodEntry(self.limit)
+            entry.last = now
+            self._schedule(key, entry)
+        elif entry.last < now - self.window:
+            # 尚未被清理的过期状态，视为重新开始
+            entry.count = 0
+        if entry.record(now, self.window):
+            self.floods += 1
+            return True
+        return False
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def memory_usage(self) -> int:
+        """估算占用的内存（字节）：字典、时间轮，以及每个用户的键、状态对象和缓冲"""
+        entry = FloodEntry(self.limit)
+        per_entry = (sys.getsizeof(entry) + sys.getsizeof(entry.times)
+                     + sys.getsizeof((0, 0)) + 2 * sys.getsizeof(2 ** 40))
+        wheel = sum(sys.getsizeof(slot) for slot in self._wheel)
+        return sys.getsizeof(self._entries) + wheel + per_entry * len(self._entries)
+    
+    def reset(self, chat_id: Optional[int] = None):
+        """清除刷屏记录（chat_id 为 None 时清除全部）"""
+        if chat_id is None:
+            self._entries.clear()
+            for slot in self._wheel:
+                slot.clear()
+            return
+        for key in [key for key in self._entries if key[0] == chat_id]:
+            del self._entries[key]
+    
+    def stats(self) -> dict:
+        """获取统计信息"""
+        return {
+            'size': len(self._entries),
+            'floods': self.floods,
+            'evictions': self.evictions,
+            'memory_bytes': self.memory_usage(),
+        }
+
+
+# 全局刷屏跟踪器实例
+flood_tracker = FloodTracker()
+
+metrics.gauge('flood_tracker_entries', '刷屏跟踪的用户数', lambda: len(flood_tracker))
+metrics.gauge('flood_tracker_bytes', '刷屏跟踪估算占用的内存（字节）', flood_tracker.memory_usage)
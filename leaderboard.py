@@ -0,0 +1,279 @@
+"""
+排行榜模块
+每个群组维护一个按积分排序的可索引跳表，支持 O(log n) 的排名、前 N 名和附近用户查询
+"""
+import random
+import threading
+import logging
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from database import db, adb
+from config import LEADERBOARD_MAX_CHATS
+
+logger = logging.getLogger(__name__)
+
+
+class _Node:
+    """跳表节点"""
+    __slots__ = ('key', 'next', 'width')
+    
+    def __init__(self, key, level: int):
+        self.key = key
+        self.next = [None] * level
+        # width[i] 表示沿第 i 层链接前进时跨过的元素个数
+        self.width = [1] * level
+
+
+class IndexableSkipList:
+    """
+    可索引跳表
+    元素按 key 升序排列，插入、删除、按位置访问和求排名均为 O(log n)
+    """
+    
+    MAX_LEVEL = 24
+    
+    def __init__(self):
+        self._tail = _Node(None, 0)
+        self._head = _Node(None, self.MAX_LEVEL)
+        self._head.next = [self._tail] * self.MAX_LEVEL
+        self._size = 0
+    
+    def __len__(self) -> int:
+        return self._size
+    
+    def _random_level(self) -> int:
+        level = 1
+        while level < self.MAX_LEVEL and random.random() < 0.5:
+            level += 1
+        return level
+    
+    def insert(self, key):
+        """插入元素"""
+        chain = [None] * self.MAX_LEVEL
+        steps_at_level = [0] * self.MAX_LEVEL
+        node = self._head
+        for level in reversed(range(self.MAX_LEVEL)):
+            while node.next[level] is not self._tail and node.next[level].key < key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        
+        new_level = self._random_level()
+        new_node = _Node(key, new_level)
+        steps = 0
+        for level in range(new_level):
+            prev = chain[level]
+            new_node.next[level] = prev.next[level]
+            prev.next[level] = new_node
+            new_node.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(new_level, self.MAX_LEVEL):
+            chain[level].width[level] += 1
+        self._size += 1
+    
+    def remove(self, key):
+        """删除元素，不存在时抛出 KeyError"""
+        chain = [None] * self.MAX_LEVEL
+        node = self._head
+        for level in reversed(range(self.MAX_LEVEL)):
+            while node.next[level] is not self._tail and node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        
+        target = chain[0].next[0]
+        if target is self._tail or target.key != key:
+            raise KeyError(key)
+        
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), self.MAX_LEVEL):
+            chain[level].width[level] -= 1
+        self._size -= 1
+    
+    def bisect_left(self, key) -> int:
+        """返回小于 key 的元素个数"""
+        count = 0
+        node = self._head
+        for level in reversed(range(self.MAX_LEVEL)):
+            while node.next[level] is not self._tail and node.next[level].key < key:
+                count += node.width[level]
+                node = node.next[level]
+        return count
+    
+    def slice(self, start: int, stop: int) -> list:
+        """返回位置 [start, stop) 的元素"""
+        start = max(0, start)
+        stop = min(stop, self._size)
+        if start >= stop:
+            return []
+        
+        # 定位到第 start 个元素（位置从1开始计数）
+        node = self._head
+        remaining = start + 1
+        for level in reversed(range(self.MAX_LEVEL)):
+            while node.next[level] is not self._tail and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        
+        result = []
+        for _ in range(stop - start):
+            result.append(node.key)
+            node = node.next[0]
+        return result
+
+
+class ChatBoard:
+    """单个群组的排行榜"""
+    __slots__ = ('points', 'ranking')
+    
+    def __init__(self, rows: List[Tuple[int, int]]):
+        # 格式: {user_id: points}
+        self.points = {}
+        # 元素格式: (-points, user_id)，升序即积分降序
+        self.ranking = IndexableSkipList()
+        for user_id, points in rows:
+            self.set(user_id, points)
+    
+    def set(self, user_id: int, points: int):
+        """更新用户积分"""
+        old_points = self.points.get(user_id)
+        if old_points == points:
+            return
+        if old_points is not None:
+            self.ranking.remove((-old_points, user_id))
+        self.points[user_id] = points
+        self.ranking.insert((-points, user_id))
+    
+    def rank(self, user_id: int) -> Optional[int]:
+        """获取用户排名（积分相同的用户排名相同，没有积分返回None）"""
+        points = self.points.get(user_id, 0)
+        if points <= 0:
+            return None
+        # 排名 = 积分更高的人数 + 1
+        return self.ranking.bisect_left((-points, float('-inf'))) + 1
+    
+    def top(self, limit: int) -> List[Tuple[int, int]]:
+        """获取前 N 名（返回 (user_id, points) 列表）"""
+        return [(user_id, -neg_points) for neg_points, user_id in self.ranking.slice(0, limit)]
+    
+    def around(self, user_id: int, radius: int) -> List[Tuple[int, int, int]]:
+        """获取用户前后各 radius 名（返回 (位置, user_id, points) 列表，位置从1开始）"""
+        points = self.points.get(user_id)
+        if points is None:
+            return []
+        index = self.ranking.bisect_left((-points, user_id))
+        start = max(0, index - radius)
+        return [
+            (start + offset + 1, uid, -neg_points)
+            for offset, (neg_points, uid) in enumerate(self.ranking.slice(start, index + radius + 1))
+        ]
+
+
+class Leaderboard:
+    """
+    排行榜管理器
+    群组首次查询时从数据库加载，之后随数据库积分变化同步更新
+    """
+    
+    def __init__(self, max_chats: int = LEADERBOARD_MAX_CHATS):
+        """
+        初始化排行榜管理器
+        
+        Args:
+            max_chats: 内存中最多保留的群组排行榜数量（超出时淘汰最久未使用的）
+        """
+        self.max_chats = max(1, max_chats)
+        self._boards: "OrderedDict[int, ChatBoard]" = OrderedDict()
+        # 正在加载的群组: {chat_id: [(user_id, points), ...]}
+        self._loading = {}
+        # 数据库线程和事件循环线程都会访问
+        self._lock = threading.RLock()
+    
+    def load(self, chat_id: int) -> ChatBoard:
+        """加载群组排行榜（已加载时直接返回，在数据库线程中调用）"""
+        with self._lock:
+            board = self._boards.get(chat_id)
+            if board is not None:
+                self._boards.move_to_end(chat_id)
+                return board
+            # 加载期间提交的积分变化先暂存，加载完成后重放
+            self._loading.setdefault(chat_id, [])
+        
+        # 读库和建表不持锁，避免阻塞事件循环上的查询
+        try:
+            board = ChatBoard(db.get_chat_points(chat_id))
+        except Exception:
+            with self._lock:
+                self._loading.pop(chat_id, None)
+            raise
+        
+        with self._lock:
+            existing = self._boards.get(chat_id)
+            if existing is not None:
+                return existing
+            for user_id, points in self._loading.pop(chat_id, []):
+                board.set(user_id, points)
+            self._boards[chat_id] = board
+            while len(self._boards) > self.max_chats:
+                self._boards.popitem(last=False)
+        logger.debug(f"加载群组 {chat_id} 排行榜: {len(board.points)} 名用户")
+        return board
+    
+    def apply(self, changes: List[Tuple[int, int, int]]):
+        """应用积分变化（作为数据库积分监听器调用，只更新已加载的群组）"""
+        with self._lock:
+            for chat_id, user_id, points in changes:
+                board = self._boards.get(chat_id)
+                if board is not None:
+                    board.set(user_id, points)
+                elif chat_id in self._loading:
+                    self._loading[chat_id].append((user_id, points))
+    
+    def invalidate(self, chat_id: Optional[int] = None):
+        """丢弃已加载的排行榜（chat_id 为 None 时丢弃全部）"""
+        with self._lock:
+            if chat_id is None:
+                self._boards.clear()
+            else:
+                self._boards.pop(chat_id, None)
+    
+    async def _board(self, chat_id: int) -> ChatBoard:
+        """获取群组排行榜（未加载时在数据库线程中加载）"""
+        with self._lock:
+            board = self._boards.get(chat_id)
+            if board is not None:
+                self._boards.move_to_end(chat_id)
+                return board
+        return await adb.run(self.load, chat_id)
+    
+    async def get_user_rank(self, chat_id: int, user_id: int) -> Optional[int]:
+        """获取用户排名（1为最高）"""
+        board = await self._board(chat_id)
+        with self._lock:
+            return board.rank(user_id)
+    
+    async def get_top_users(self, chat_id: int, limit: int = 10) -> List[Tuple[int, int]]:
+        """获取积分排行榜（返回 (user_id, points) 列表）"""
+        board = await self._board(chat_id)
+        with self._lock:
+            return board.top(limit)
+    
+    async def get_users_around(self, chat_id: int, user_id: int, radius: int = 2) -> List[Tuple[int, int, int]]:
+        """获取用户附近的排名（返回 (位置, user_id, points) 列表）"""
+        board = await self._board(chat_id)
+        with self._lock:
+            return board.around(user_id, radius)
+    
+    async def get_user_count(self, chat_id: int) -> int:
+        """获取群组中有积分记录的用户数"""
+        board = await self._board(chat_id)
+        with self._lock:
+            return len(board.points)
+
+
+# 全局排行榜实例，随数据库积分变化同步
+leaderboard = Leaderboard()
+db.points_listeners.append(leaderboard.apply)
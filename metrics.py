@@ -0,0 +1,299 @@
+"""
+指标模块
+记录处理器/数据库/API 延迟直方图、更新/删除/积分/API 调用计数，以及缓存大小、队列深度等仪表，
+以 Prometheus 文本格式输出
+"""
+import time
+import bisect
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple, Union
+from telegram import Update
+from telegram.ext import ContextTypes
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# 默认延迟桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    """格式化标签: {a="1",b="2"}"""
+    parts = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{escaped}"')
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """指标基类（按标签值保存子指标）"""
+    
+    type_name = ''
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple, object] = {}
+        self._lock = threading.Lock()
+    
+    def _new_child(self):
+        raise NotImplementedError
+    
+    def labels(self, *values):
+        """获取指定标签值的子指标"""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}")
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+    
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+    
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+    
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+    
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """计数器（只增不减）"""
+    
+    type_name = 'counter'
+    
+    def _new_child(self):
+        return _CounterChild()
+    
+    def inc(self, amount: float = 1):
+        """无标签计数器加一"""
+        self.labels().inc(amount)
+    
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+    
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # 每个桶的非累计计数，最后一个为 +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Histogram(_Metric):
+    """直方图"""
+    
+    type_name = 'histogram'
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+    
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+    
+    def observe(self, value: float):
+        """无标签直方图记录一次"""
+        self.labels().observe(value)
+    
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts = list(child.counts)
+                total, count = child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, values)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, values)} {count}"
+
+
+class GaugeCallback(_Metric):
+    """仪表（抓取时调用函数取值）"""
+    
+    type_name = 'gauge'
+    
+    def __init__(self, name: str, documentation: str, func: Callable[[], Union[float, Dict[Tuple, float]]],
+                 labelnames: Sequence[str] = ()):
+        """
+        Args:
+            func: 无标签时返回数值，有标签时返回 {标签值元组: 数值}
+        """
+        super().__init__(name, documentation, labelnames)
+        self.func = func
+    
+    def _samples(self):
+        try:
+            result = self.func()
+        except Exception as e:
+            logger.error(f"读取指标 {self.name} 失败: {e}")
+            return
+        if not self.labelnames:
+            result = {(): result}
+        for values, value in result.items():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}"
+
+
+class MetricsRegistry:
+    """指标注册表"""
+    
+    def __init__(self, prefix: str = 'bot'):
+        self.prefix = prefix
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+    
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+    
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        """注册计数器（名称自动加前缀和 _total 后缀）"""
+        return self._register(Counter(f"{self.prefix}_{name}_total", documentation, labelnames))
+    
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        """注册直方图"""
+        return self._register(Histogram(f"{self.prefix}_{name}", documentation, labelnames, buckets))
+    
+    def gauge(self, name: str, documentation: str, func: Callable, labelnames: Sequence[str] = ()) -> GaugeCallback:
+        """注册仪表（func 在每次抓取时调用）"""
+        return self._register(GaugeCallback(f"{self.prefix}_{name}", documentation, func, labelnames))
+    
+    def render(self) -> str:
+        """输出 Prometheus 文本格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+def merge_rendered(outputs: Iterable[Tuple[str, str]], label: str) -> str:
+    """
+    合并多个进程输出的 Prometheus 文本（同名指标的样本放在一起，每个样本加上来源标签）
+    
+    Args:
+        outputs: [(来源标签值, render() 输出), ...]
+        label: 来源标签名（如 shard）
+    
+    Returns:
+        str: 合并后的 Prometheus 文本
+    """
+    # 按指标名首次出现的顺序输出，HELP/TYPE 取自首个包含该指标的来源
+    headers: Dict[str, List[str]] = {}
+    samples: Dict[str, List[str]] = {}
+    for source, text in outputs:
+        extra = _format_labels((label,), (source,))[1:-1]
+        owned = set()
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# '):
+                parts = line.split(' ', 3)
+                if len(parts) >= 3 and parts[1] in ('HELP', 'TYPE'):
+                    family = parts[2]
+                    if family not in samples:
+                        headers[family], samples[family] = [], []
+                        owned.add(family)
+                    if family in owned:
+                        headers[family].append(line)
+                continue
+            if not line or family is None:
+                continue
+            # 样本行: 名称{标签} 值 或 名称 值
+            end = min(index for index in (line.find('{'), line.find(' '), len(line)) if index >= 0)
+            if line[end:end + 1] == '{':
+                line = f"{line[:end + 1]}{extra},{line[end + 1:]}"
+            else:
+                line = f"{line[:end]}{{{extra}}}{line[end:]}"
+            samples[family].append(line)
+    return ''.join('\n'.join(headers[family] + samples[family]) + '\n' for family in samples)
+
+
+# 全局指标注册表
+metrics = MetricsRegistry()
+
+# 常用指标
+handler_latency = metrics.histogram('handler_latency_seconds', '处理器执行时间', ('handler',))
+db_latency = metrics.histogram('db_latency_seconds', '数据库方法执行时间（含排队）', ('method',))
+api_latency = metrics.histogram('api_latency_seconds', 'Telegram API 请求时间', ('method',))
+api_queue_wait = metrics.histogram('api_queue_wait_seconds', 'Telegram API 请求排队时间', ('priority',))
+updates_total = metrics.counter('updates', '收到的更新数', ('type',))
+api_calls_total = metrics.counter('api_calls', 'Telegram API 调用数', ('method', 'result'))
+messages_deleted_total = metrics.counter('messages_deleted', '自动删除的消息数', ('reason',))
+raids_total = metrics.counter('raids', '检测到的多账号刷群次数')
+messages_purged_total = metrics.counter('messages_purged', '/purge 清理的消息数', ('mode',))
+rate_limited_total = metrics.counter('rate_limited', '被速率限制丢弃的请求数', ('limiter', 'scope'))
+api_retries_total = metrics.counter('api_retries', '遇到 RetryAfter 后重试的 API 请求数', ('method',))
+api_coalesced_total = metrics.counter('api_coalesced', '与排队中的相同操作合并的 API 请求数', ('method',))
+points_awarded_total = metrics.counter('points_awarded', '发放的积分总数', ('source',))
+
+
+async def track_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """按类型统计收到的更新（在所有处理器之前运行）"""
+    for update_type in Update.ALL_TYPES:
+        if getattr(update, update_type, None) is not None:
+            updates_total.labels(update_type).inc()
+            return
+    updates_total.labels('unknown').inc()
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """记录每次 Telegram API 调用的方法、结果和耗时"""
+    
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        start_time = time.perf_counter()
+        result = 'error'
+        try:
+            response = await super().do_request(url, method, *args, **kwargs)
+            result = str(response[0])
+            return response
+        finally:
+            api_latency.labels(api_method).observe(time.perf_counter() - start_time)
+            api_calls_total.labels(api_method, result).inc()
@@ -0,0 +1,237 @@
+"""
+消息审核流水线
+用一个消息处理器按顺序执行防刷屏、重复消息、广告检测和积分奖励，
+共享聊天类型、机器人、管理员和群组设置等检查，消息被删除后不再执行后续阶段
+"""
+import time
+import logging
+from collections import OrderedDict
+from typing import Optional
+from telegram import Update
+from telegram.ext import ContextTypes
+from database import adb, DEFAULT_CHAT_SETTINGS
+from performance import get_cache
+from utils_common import check_admin_permission
+from anti_spam import flood_stage, duplicate_stage
+from auto_moderation import ad_stage
+from points_system import points_stage
+from rate_limiter import rate_limit_stage
+from config import ENABLE_ANTI_SPAM, ENABLE_POINTS_SYSTEM, RATE_LIMIT_ENABLED
+from metrics import messages_deleted_total
+
+logger = logging.getLogger(__name__)
+
+# 群组设置缓存时间（秒）
+SETTINGS_CACHE_TIMEOUT = 300
+
+# 群组设置缓存（独立命名空间，不与其他缓存互相淘汰）
+settings_cache = get_cache('chat_settings', default_timeout=SETTINGS_CACHE_TIMEOUT)
+
+
+class MessageContext:
+    """单条消息在流水线中的上下文（各阶段共享）"""
+    __slots__ = ('update', 'context', 'chat', 'user', 'message', 'text',
+                 'deleted', 'stopped', 'shedding', 'reason', '_is_admin', '_settings')
+    
+    def __init__(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        self.update = update
+        self.context = context
+        self.chat = update.effective_chat
+        self.user = update.effective_user
+        self.message = update.message
+        self.text = self.message.text or self.message.caption or ""
+        self.deleted = False
+        self.stopped = False
+        self.shedding = False
+        self.reason = None
+        self._is_admin = None
+        self._settings = None
+    
+    @classmethod
+    def from_update(cls, update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional["MessageContext"]:
+        """创建上下文，不需要审核的消息（私聊、频道、机器人）返回None"""
+        if not update.message or not update.effective_chat or not update.effective_user:
+            return None
+        chat = update.effective_chat
+        # 只处理群组消息（不包括频道和私聊）
+        if chat.type == 'private' or chat.type == 'channel':
+            return None
+        # 忽略机器人
+        if update.effective_user.is_bot:
+            return None
+        return cls(update, context)
+    
+    async def is_admin(self) -> bool:
+        """发送者是否为管理员（只查询一次）"""
+        if self._is_admin is None:
+            self._is_admin = await check_admin_permission(self.update, self.context)
+        return self._is_admin
+    
+    async def settings(self) -> dict:
+        """群组设置（只查询一次；负载过高时只使用缓存，未缓存时使用默认设置）"""
+        if self._settings is None:
+            self._settings = await get_chat_settings(self.chat.id, cached_only=self.shedding)
+        return self._settings
+    
+    async def disabled_stages(self, cached_only: bool = False) -> frozenset:
+        """本群禁用的阶段（cached_only 为 True 时不查询数据库，未缓存时视为没有禁用）"""
+        settings = self._settings
+        if settings is None and cached_only:
+            settings = settings_cache.get(self.chat.id)
+            if settings is None:
+                return frozenset()
+        elif settings is None:
+            settings = await self.settings()
+        return settings.get('disabled_stages') or frozenset()
+    
+    async def delete(self, reason: str) -> bool:
+        """删除当前消息，后续阶段不再执行"""
+        self.reason = reason
+        try:
+            await self.message.delete()
+        except Exception as e:
+            logger.error(f"删除消息失败 ({reason}): {e}")
+            return False
+        self.deleted = True
+        messages_deleted_total.labels(reason).inc()
+        return True
+    
+    def stop(self):
+        """保留当前消息，后续阶段不再执行"""
+        self.stopped = True
+    
+    def shed(self):
+        """负载过高：审核阶段继续执行，跳过访问数据库的工作（积分阶段、未缓存的群组设置、扣分）"""
+        self.shedding = True
+
+
+async def get_chat_settings(chat_id: int, cached_only: bool = False) -> dict:
+    """
+    获取群组设置（带缓存，设置修改后需调用 invalidate_chat_settings）
+    
+    Args:
+        chat_id: 群组ID
+        cached_only: 未缓存时返回默认设置，不查询数据库（也不写入缓存）
+    """
+    settings = settings_cache.get(chat_id)
+    if settings is None and cached_only:
+        return {**DEFAULT_CHAT_SETTINGS, 'disabled_stages': frozenset()}
+    if settings is None:
+        settings = await adb.get_chat_settings(chat_id)
+        settings['disabled_stages'] = parse_stage_list(settings.get('disabled_stages'))
+        settings_cache.set(chat_id, settings)
+    return settings
+
+
+def parse_stage_list(value: Optional[str]) -> frozenset:
+    """解析逗号分隔的阶段名称"""
+    if not value:
+        return frozenset()
+    return frozenset(name.strip() for name in value.split(',') if name.strip())
+
+
+def invalidate_chat_settings(chat_id: int):
+    """群组设置修改后清除缓存"""
+    settings_cache.delete(chat_id)
+
+
+class Stage:
+    """流水线阶段"""
+    __slots__ = ('name', 'title', 'func', 'enabled', 'db_bound', 'cached_settings', 'calls', 'deletes', 'errors',
+                 'total_time', 'max_time')
+    
+    def __init__(self, name: str, title: str, func, enabled: bool = True, db_bound: bool = False,
+                 cached_settings: bool = False):
+        """
+        Args:
+            name: 阶段名称（用于配置）
+            title: 显示名称
+            func: async func(MessageContext) -> None，需要删除消息时调用 ctx.delete()
+            enabled: 全局是否启用
+            db_bound: 主要工作是访问数据库（负载过高时跳过）
+            cached_settings: 判断本群是否禁用时只看缓存的设置，保证在访问数据库之前执行
+        """
+        self.name = name
+        self.title = title
+        self.func = func
+        self.enabled = enabled
+        self.db_bound = db_bound
+        self.cached_settings = cached_settings
+        self.calls = 0
+        self.deletes = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+
+class ModerationPipeline:
+    """消息审核流水线"""
+    
+    def __init__(self):
+        self.stages: "OrderedDict[str, Stage]" = OrderedDict()
+    
+    def add_stage(self, name: str, title: str, func, enabled: bool = True, db_bound: bool = False,
+                  cached_settings: bool = False):
+        """按顺序添加阶段"""
+        self.stages[name] = Stage(name, title, func, enabled, db_bound, cached_settings)
+    
+    async def run(self, ctx: MessageContext):
+        """按顺序执行所有启用的阶段，消息被删除或阶段要求停止后停止；负载过高时跳过访问数据库的阶段"""
+        for stage in self.stages.values():
+            if not stage.enabled or (ctx.shedding and stage.db_bound):
+                continue
+            if stage.name in await ctx.disabled_stages(cached_only=stage.cached_settings):
+                continue
+            
+            start_time = time.perf_counter()
+            try:
+                await stage.func(ctx)
+            except Exception as e:
+                stage.errors += 1
+                logger.error(f"审核阶段 {stage.name} 出错: {e}", exc_info=e)
+            finally:
+                elapsed = time.perf_counter() - start_time
+                stage.calls += 1
+                stage.total_time += elapsed
+                stage.max_time = max(stage.max_time, elapsed)
+            
+            if ctx.deleted:
+                stage.deletes += 1
+                break
+            if ctx.stopped:
+                break
+    
+    async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """消息处理器入口"""
+        ctx = MessageContext.from_update(update, context)
+        if ctx is None:
+            return
+        await self.run(ctx)
+    
+    def stats(self) -> dict:
+        """获取各阶段统计信息"""
+        return {
+            stage.name: {
+                'calls': stage.calls,
+                'deletes': stage.deletes,
+                'errors': stage.errors,
+                'avg_time': stage.total_time / stage.calls if stage.calls else 0.0,
+                'max_time': stage.max_time,
+            }
+            for stage in self.stages.values()
+        }
+
+
+def build_pipeline() -> ModerationPipeline:
+    """创建默认流水线：速率限制 -> 防刷屏 -> 重复消息 -> 广告 -> 积分"""
+    pipeline = ModerationPipeline()
+    pipeline.add_stage('ratelimit', '速率限制', rate_limit_stage, RATE_LIMIT_ENABLED, cached_settings=True)
+    pipeline.add_stage('flood', '防刷屏', flood_stage, ENABLE_ANTI_SPAM)
+    pipeline.add_stage('duplicate', '重复消息', duplicate_stage, ENABLE_ANTI_SPAM)
+    pipeline.add_stage('ads', '广告检测', ad_stage)
+    pipeline.add_stage('points', '积分奖励', points_stage, ENABLE_POINTS_SYSTEM, db_bound=True)
+    return pipeline
+
+
+# 全局流水线实例
+pipeline = build_pipeline()
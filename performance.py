@@ -3,139 +3,385 @@
 包含缓存、连接池等性能优化功能
 """
 import time
+import heapq
+import asyncio
+import inspect
+import threading
 import functools
-from typing import Any, Callable, Optional
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
 import logging
+from config import CACHE_MAX_SIZE
+from metrics import metrics, handler_latency
 
 logger = logging.getLogger(__name__)
 
 
 class Cache:
-    """简单的内存缓存实现"""
+    """
+    LRU + TTL 内存缓存（线程安全）
+    
+    - 超过容量（条目数或总权重）时淘汰最久未使用的条目
+    - 每个条目有独立的过期时间，写入时顺带清理少量已过期条目，不需要手动调用 cleanup()
+    - 记录命中、未命中、淘汰和过期次数
+    """
+    
+    # 每次写入时最多顺带清理的过期条目数
+    EXPIRE_STEPS = 16
     
-    def __init__(self, default_timeout: int = 300):
+    def __init__(self, default_timeout: Optional[int] = 300, max_size: int = CACHE_MAX_SIZE,
+                 weigher: Optional[Callable[[Any, Any], int]] = None, max_weight: Optional[int] = None,
+                 name: str = 'default'):
         """
         初始化缓存
         
         Args:
-            default_timeout: 默认超时时间（秒）
+            default_timeout: 默认超时时间（秒），None 表示不过期（只按容量淘汰），0 表示不缓存
+            max_size: 最多保存的条目数
+            weigher: 计算条目权重的函数 weigher(key, value)，用于按内存大小限制
+            max_weight: 总权重上限（需要同时指定 weigher）
+            name: 缓存名称（用于统计）
         """
-        self._cache = {}
+        self.name = name
         self.default_timeout = default_timeout
+        self.max_size = max(1, max_size)
+        self.weigher = weigher
+        self.max_weight = max_weight
+        # 格式: {key: (value, 过期时间或None, 权重)}，按最近使用顺序排列
+        self._cache: "OrderedDict[Any, Tuple[Any, Optional[float], int]]" = OrderedDict()
+        # 过期时间小顶堆: (过期时间, 序号, key)，条目被覆盖或删除后留下的旧记录在弹出时跳过
+        self._expiry: List[Tuple[float, int, Any]] = []
+        self._sequence = 0
+        self._weight = 0
+        self._lock = threading.RLock()
+        
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def __len__(self) -> int:
+        return len(self._cache)
+    
+    def __contains__(self, key) -> bool:
+        """是否存在未过期的条目（不影响 LRU 顺序和统计）"""
+        with self._lock:
+            entry = self._cache.get(key)
+            return entry is not None and (entry[1] is None or time.time() <= entry[1])
+    
+    def _remove(self, key):
+        """删除条目并扣除权重"""
+        entry = self._cache.pop(key)
+        self._weight -= entry[2]
+        return entry
     
-    def get(self, key: str) -> Optional[Any]:
+    def _expire(self, now: float, steps: int):
+        """从过期堆顶清理最多 steps 个已过期的条目"""
+        while self._expiry and steps > 0 and self._expiry[0][0] <= now:
+            expire_time, _, key = heapq.heappop(self._expiry)
+            entry = self._cache.get(key)
+            if entry is not None and entry[1] == expire_time:
+                self._remove(key)
+                self.expirations += 1
+            steps -= 1
+        
+        # 堆中失效的旧记录过多时重建
+        if len(self._expiry) > 2 * len(self._cache) + 64:
+            self._expiry = []
+            for key, (_, expire_time, _) in self._cache.items():
+                if expire_time is not None:
+                    self._sequence += 1
+                    self._expiry.append((expire_time, self._sequence, key))
+            heapq.heapify(self._expiry)
+    
+    def _evict(self):
+        """超过容量时淘汰最久未使用的条目"""
+        while self._cache and (
+            len(self._cache) > self.max_size
+            or (self.max_weight is not None and self._weight > self.max_weight)
+        ):
+            key = next(iter(self._cache))
+            self._remove(key)
+            self.evictions += 1
+    
+    def get(self, key, default: Any = None) -> Optional[Any]:
         """
         获取缓存值
         
         Args:
             key: 缓存键
+            default: 不存在或已过期时的返回值
         
         Returns:
-            缓存值，如果不存在或已过期返回None
+            缓存值，如果不存在或已过期返回 default
         """
-        if key not in self._cache:
-            return None
-        
-        value, expire_time = self._cache[key]
-        
-        if time.time() > expire_time:
-            # 已过期，删除
-            del self._cache[key]
-            return None
-        
-        return value
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            
+            if entry[1] is not None and time.time() > entry[1]:
+                # 已过期，删除
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return entry[0]
     
-    def set(self, key: str, value: Any, timeout: Optional[int] = None):
+    def set(self, key, value: Any, timeout: Optional[int] = None):
         """
         设置缓存值
         
         Args:
             key: 缓存键
             value: 缓存值
-            timeout: 超时时间（秒），None使用默认值
+            timeout: 超时时间（秒），None使用默认值，0 表示立即过期（不缓存）
         """
-        timeout = timeout or self.default_timeout
-        expire_time = time.time() + timeout
-        self._cache[key] = (value, expire_time)
+        timeout = self.default_timeout if timeout is None else timeout
+        weight = self.weigher(key, value) if self.weigher else 1
+        
+        with self._lock:
+            now = time.time()
+            expire_time = None if timeout is None else now + timeout
+            if key in self._cache:
+                self._remove(key)
+            self._cache[key] = (value, expire_time, weight)
+            self._weight += weight
+            if expire_time is not None:
+                self._sequence += 1
+                heapq.heappush(self._expiry, (expire_time, self._sequence, key))
+            
+            self._expire(now, self.EXPIRE_STEPS)
+            self._evict()
+    
+    def update(self, key, value: Any) -> bool:
+        """
+        替换已有条目的值，保留原过期时间
+        
+        Returns:
+            bool: 条目不存在或已过期时返回False
+        """
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None or (entry[1] is not None and time.time() > entry[1]):
+                return False
+            weight = self.weigher(key, value) if self.weigher else 1
+            self._cache[key] = (value, entry[1], weight)
+            self._weight += weight - entry[2]
+            self._evict()
+            return True
     
-    def delete(self, key: str):
+    def delete(self, key):
         """删除缓存"""
-        if key in self._cache:
-            del self._cache[key]
+        with self._lock:
+            if key in self._cache:
+                self._remove(key)
     
     def clear(self):
         """清空所有缓存"""
-        self._cache.clear()
+        with self._lock:
+            self._cache.clear()
+            self._expiry.clear()
+            self._weight = 0
+    
+    def cleanup(self) -> int:
+        """清理所有过期缓存，返回清理的条目数"""
+        with self._lock:
+            before = self.expirations
+            self._expire(time.time(), len(self._expiry))
+            return self.expirations - before
     
-    def cleanup(self):
-        """清理过期缓存"""
-        current_time = time.time()
-        keys_to_delete = [
-            key for key, (_, expire_time) in self._cache.items()
-            if current_time > expire_time
-        ]
-        for key in keys_to_delete:
-            del self._cache[key]
+    def stats(self) -> dict:
+        """获取缓存统计信息"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._cache),
+                'max_size': self.max_size,
+                'weight': self._weight,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+# 命名空间缓存实例: {名称: Cache}，不同用途的数据互不淘汰
+_caches: Dict[str, Cache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(namespace: str, **kwargs) -> Cache:
+    """
+    获取命名空间缓存（不存在时用 kwargs 创建，参数同 Cache）
+    
+    使用示例:
+        settings_cache = get_cache('chat_settings', default_timeout=300, max_size=5000)
+    """
+    with _caches_lock:
+        instance = _caches.get(namespace)
+        if instance is None:
+            instance = Cache(name=namespace, **kwargs)
+            _caches[namespace] = instance
+        return instance
+
+
+def cache_stats() -> Dict[str, dict]:
+    """获取所有命名空间缓存的统计信息"""
+    with _caches_lock:
+        return {namespace: instance.stats() for namespace, instance in _caches.items()}
 
 
 # 全局缓存实例
-cache = Cache(default_timeout=300)
+cache = get_cache('default', default_timeout=300)
+
 
+# 缓存中不存在时的标记（区分缓存的 None）
+_MISSING = object()
 
-def cached(timeout: int = 300):
+
+def cached(timeout: int = 300, key: Optional[Callable[..., Hashable]] = None,
+           key_args: Optional[Sequence[str]] = None, namespace: str = 'default',
+           stale: int = 0, cache_none: bool = True, none_timeout: Optional[int] = None):
     """
-    缓存装饰器
+    缓存装饰器（用于协程）
+    
+    - 缓存键默认由函数名和全部参数组成（参数需可哈希），可用 key 或 key_args 指定
+    - 同一个键的并发未命中只执行一次函数，其余调用等待同一个结果
+    - stale > 0 时，过期后 stale 秒内先返回旧值并在后台刷新
+    - 返回 None 也会缓存（none_timeout 可单独设置时间），异常不缓存
     
     Args:
         timeout: 缓存超时时间（秒）
+        key: 根据调用参数生成缓存键的函数，签名与被装饰函数相同
+        key_args: 参与生成缓存键的参数名
+        namespace: 使用的命名空间缓存
+        stale: 过期后仍可返回旧值的时间（秒）
+        cache_none: 是否缓存 None
+        none_timeout: None 的缓存时间（秒），None 时与 timeout 相同
     
     使用示例:
-        @cached(timeout=60)
-        async def expensive_function(arg1, arg2):
+        @cached(timeout=300, key=lambda bot, chat_id: chat_id, namespace='chat_info')
+        async def get_chat_info(bot, chat_id):
             ...
+    
+    被装饰函数附带 invalidate(*args, **kwargs) 用于删除对应的缓存
     """
     def decorator(func: Callable) -> Callable:
+        store = get_cache(namespace, default_timeout=timeout)
+        signature = inspect.signature(func)
+        # 正在执行的加载: {缓存键: Task}
+        inflight: Dict[Hashable, asyncio.Task] = {}
+        
+        def make_key(args, kwargs) -> Hashable:
+            if key is not None:
+                return (func.__qualname__, key(*args, **kwargs))
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            if key_args is not None:
+                return (func.__qualname__,) + tuple(bound.arguments[name] for name in key_args)
+            return (func.__qualname__,) + tuple(bound.arguments.items())
+        
+        async def load(cache_key, args, kwargs):
+            try:
+                result = await func(*args, **kwargs)
+                if result is not None or cache_none:
+                    ttl = none_timeout if result is None and none_timeout is not None else timeout
+                    # 条目在 ttl + stale 后才从缓存中删除，期间视为旧值
+                    store.set(cache_key, (result, time.time() + ttl), ttl + stale)
+                return result
+            finally:
+                inflight.pop(cache_key, None)
+        
+        def start_load(cache_key, args, kwargs) -> asyncio.Task:
+            task = inflight.get(cache_key)
+            if task is None:
+                task = asyncio.ensure_future(load(cache_key, args, kwargs))
+                inflight[cache_key] = task
+            return task
+        
+        def log_refresh_error(task: asyncio.Task):
+            if not task.cancelled() and task.exception() is not None:
+                logger.error(f"后台刷新缓存 {func.__name__} 失败: {task.exception()}")
+        
         @functools.wraps(func)
         async def wrapper(*args, **kwargs):
-            # 生成缓存键
-            cache_key = f"{func.__name__}:{str(args)}:{str(kwargs)}"
+            cache_key = make_key(args, kwargs)
             
-            # 尝试从缓存获取
-            cached_value = cache.get(cache_key)
-            if cached_value is not None:
-                return cached_value
+            entry = store.get(cache_key, _MISSING)
+            if entry is not _MISSING:
+                value, fresh_until = entry
+                if time.time() >= fresh_until and cache_key not in inflight:
+                    # 旧值仍可用，后台刷新
+                    start_load(cache_key, args, kwargs).add_done_callback(log_refresh_error)
+                return value
             
-            # 执行函数
-            result = await func(*args, **kwargs)
-            
-            # 存入缓存
-            cache.set(cache_key, result, timeout)
-            
-            return result
+            # 调用方被取消时不影响其他等待同一结果的调用
+            return await asyncio.shield(start_load(cache_key, args, kwargs))
+        
+        def invalidate(*args, **kwargs):
+            store.delete(make_key(args, kwargs))
         
+        wrapper.invalidate = invalidate
+        wrapper.cache = store
         return wrapper
     return decorator
 
 
-def measure_time(func: Callable) -> Callable:
+def measure_time(func: Optional[Callable] = None, *, name: Optional[str] = None,
+                 slow_threshold: float = 1.0) -> Callable:
     """
-    测量函数执行时间的装饰器
+    测量协程执行时间的装饰器
+    执行时间记录到处理器延迟直方图（bot_handler_latency_seconds），超过 slow_threshold 秒时记录警告
+    
+    Args:
+        name: 直方图中的名称，默认使用函数名
+        slow_threshold: 记录警告的阈值（秒）
     
     使用示例:
         @measure_time
         async def my_function():
             ...
     """
-    @functools.wraps(func)
-    async def wrapper(*args, **kwargs):
-        start_time = time.time()
-        try:
-            result = await func(*args, **kwargs)
-            return result
-        finally:
-            elapsed_time = time.time() - start_time
-            if elapsed_time > 1.0:  # 只记录超过1秒的操作
-                logger.warning(f"函数 {func.__name__} 执行时间: {elapsed_time:.2f}秒")
-    
-    return wrapper
+    def decorator(func: Callable) -> Callable:
+        label = name or func.__name__
+        histogram = handler_latency.labels(label)
+        
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                elapsed_time = time.perf_counter() - start_time
+                histogram.observe(elapsed_time)
+                if elapsed_time > slow_threshold:
+                    logger.warning(f"函数 {label} 执行时间: {elapsed_time:.2f}秒")
+        
+        wrapper.measured = True
+        return wrapper
+    
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def instrument_handlers(application):
+    """为已注册的所有处理器加上 measure_time（在注册完处理器后调用）"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if not getattr(handler.callback, 'measured', False):
+                handler.callback = measure_time(handler.callback)
+
+
+def _cache_sizes() -> Dict[Tuple[str], int]:
+    return {(namespace,): stats['size'] for namespace, stats in cache_stats().items()}
+
 
+metrics.gauge('cache_entries', '内存缓存条目数', _cache_sizes, ('namespace',))
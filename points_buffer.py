@@ -0,0 +1,231 @@
+"""
+积分写缓冲模块
+将每条消息的积分奖励和最后发言时间先记录在内存中，
+按时间间隔或事件数量批量写入数据库（单个事务）
+"""
+import time
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+from database import adb
+from leaderboard import leaderboard
+from config import POINTS_FLUSH_INTERVAL_MS, POINTS_FLUSH_MAX_EVENTS
+from metrics import metrics, points_awarded_total
+
+logger = logging.getLogger(__name__)
+
+
+class PointsBuffer:
+    """积分写缓冲（write-behind）"""
+    
+    def __init__(self, interval_ms: int = POINTS_FLUSH_INTERVAL_MS, max_events: int = POINTS_FLUSH_MAX_EVENTS):
+        """
+        初始化写缓冲
+        
+        Args:
+            interval_ms: 定时刷新间隔（毫秒）
+            max_events: 累计多少个事件后立即刷新
+        """
+        self.interval = interval_ms / 1000
+        self.max_events = max(1, max_events)
+        
+        # 格式: {(chat_id, user_id): [积分增量, 最后发言时间]}
+        self._pending: Dict[Tuple[int, int], list] = {}
+        # 格式: {(chat_id, user_id, reason): [积分增量, 时间戳]}
+        self._pending_history: Dict[Tuple[int, int, str], list] = {}
+        self._pending_events = 0
+        
+        # 正在写入数据库的批次（写入完成前读路径仍需合并）
+        self._flushing: Dict[Tuple[int, int], list] = {}
+        
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        
+        # 统计信息
+        self.flushes = 0
+        self.flushed_events = 0
+    
+    def add(self, chat_id: int, user_id: int, points: int, reason: str = None, timestamp: Optional[int] = None):
+        """
+        记录一次积分变化（不立即写库）
+        
+        Args:
+            chat_id: 群组ID
+            user_id: 用户ID
+            points: 积分增量
+            reason: 原因
+            timestamp: 最后发言时间，None表示不更新
+        """
+        key = (chat_id, user_id)
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = [0, None]
+        entry[0] += points
+        if timestamp is not None:
+            entry[1] = timestamp
+        
+        history_key = (chat_id, user_id, reason or "系统")
+        history = self._pending_history.get(history_key)
+        if history is None:
+            history = self._pending_history[history_key] = [0, 0]
+        history[0] += points
+        history[1] = int(time.time())
+        
+        if points > 0:
+            points_awarded_total.labels('buffered').inc(points)
+        
+        self._pending_events += 1
+        if self._pending_events >= self.max_events:
+            self._schedule_flush()
+    
+    def pending_points(self, chat_id: int, user_id: int) -> int:
+        """获取尚未写入数据库的积分增量"""
+        key = (chat_id, user_id)
+        total = 0
+        for batch in (self._flushing, self._pending):
+            entry = batch.get(key)
+            if entry:
+                total += entry[0]
+        return total
+    
+    def pending_message_time(self, chat_id: int, user_id: int) -> Optional[int]:
+        """获取尚未写入数据库的最后发言时间"""
+        key = (chat_id, user_id)
+        for batch in (self._pending, self._flushing):
+            entry = batch.get(key)
+            if entry and entry[1] is not None:
+                return entry[1]
+        return None
+    
+    # ========== 读路径（合并未写入的增量） ==========
+    
+    async def get_user_points(self, chat_id: int, user_id: int) -> int:
+        """获取用户积分（包含缓冲中的增量）"""
+        points = await adb.get_user_points(chat_id, user_id)
+        return points + self.pending_points(chat_id, user_id)
+    
+    async def get_user_rank(self, chat_id: int, user_id: int) -> Optional[int]:
+        """获取用户排名（排名依赖其他用户积分，先刷新缓冲）"""
+        await self.flush()
+        return await leaderboard.get_user_rank(chat_id, user_id)
+    
+    async def get_top_users(self, chat_id: int, limit: int = 10):
+        """获取积分排行榜（先刷新缓冲）"""
+        await self.flush()
+        return await leaderboard.get_top_users(chat_id, limit)
+    
+    # ========== 刷新 ==========
+    
+    def _schedule_flush(self):
+        """在后台触发一次刷新（已有刷新任务时不重复创建）"""
+        if self._flush_task and not self._flush_task.done():
+            return
+        try:
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+        except RuntimeError:
+            # 没有运行中的事件循环，等待定时刷新或关闭时刷新
+            pass
+    
+    async def flush(self) -> int:
+        """
+        将缓冲中的所有变化写入数据库（单个事务）
+        
+        Returns:
+            int: 写入的事件数
+        """
+        async with self._lock:
+            if not self._pending:
+                return 0
+            
+            batch, self._pending = self._pending, {}
+            history, self._pending_history = self._pending_history, {}
+            events, self._pending_events = self._pending_events, 0
+            self._flushing = batch
+            
+            updates = [
+                (chat_id, user_id, delta, last_time)
+                for (chat_id, user_id), (delta, last_time) in batch.items()
+            ]
+            history_rows = [
+                (chat_id, user_id, delta, reason, timestamp)
+                for (chat_id, user_id, reason), (delta, timestamp) in history.items()
+                if delta
+            ]
+            
+            try:
+                await adb.apply_points_batch(updates, history_rows)
+            except Exception as e:
+                # 写入失败，放回缓冲等待下次重试
+                self._restore(batch, history, events)
+                logger.error(f"批量写入积分失败，将稍后重试: {e}")
+                return 0
+            finally:
+                self._flushing = {}
+            
+            self.flushes += 1
+            self.flushed_events += events
+            logger.debug(f"批量写入积分: {len(updates)} 个用户, {events} 个事件")
+            return events
+    
+    def _restore(self, batch: dict, history: dict, events: int):
+        """将写入失败的批次合并回缓冲"""
+        for key, (delta, last_time) in batch.items():
+            entry = self._pending.setdefault(key, [0, None])
+            entry[0] += delta
+            if entry[1] is None:
+                entry[1] = last_time
+        for key, (delta, timestamp) in history.items():
+            entry = self._pending_history.setdefault(key, [0, timestamp])
+            entry[0] += delta
+        self._pending_events += events
+    
+    async def flush_user(self, chat_id: int, user_id: int):
+        """如果该用户有未写入的变化则立即刷新（覆盖积分之前调用，避免旧增量叠加到新值上）"""
+        if (chat_id, user_id) in self._pending:
+            await self.flush()
+    
+    async def _run(self):
+        """定时刷新循环"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"定时刷新积分缓冲出错: {e}")
+    
+    def start(self):
+        """启动定时刷新（需要在事件循环中调用）"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            logger.info(f"积分写缓冲已启动: 间隔 {self.interval * 1000:.0f}ms, 批量 {self.max_events} 条")
+    
+    async def close(self):
+        """停止定时刷新并写入剩余数据"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._flush_task:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.flush()
+        if self._pending:
+            logger.error(f"关闭时仍有 {len(self._pending)} 个用户的积分未能写入")
+    
+    def stats(self) -> dict:
+        """获取缓冲统计信息"""
+        return {
+            'pending_users': len(self._pending),
+            'pending_events': self._pending_events,
+            'flushes': self.flushes,
+            'flushed_events': self.flushed_events,
+        }
+
+
+# 全局积分写缓冲实例
+points_buffer = PointsBuffer()
+
+metrics.gauge('points_buffer_pending', '积分写缓冲中等待写入的事件数', lambda: points_buffer.stats()['pending_events'])
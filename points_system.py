@@ -2,45 +2,44 @@
 积分系统模块
 处理积分相关的命令和自动积分奖励
 """
+import time
 from telegram import Update
 from telegram.ext import ContextTypes
 import logging
-from database import db
-from config import POINTS_PER_MESSAGE, POINTS_COOLDOWN, NEW_MEMBER_BONUS
+from database import adb
+from points_buffer import points_buffer
+from cooldown import cooldown_tracker
+from profiles import profiles
+from config import POINTS_PER_MESSAGE, NEW_MEMBER_BONUS
 from utils_common import check_admin_permission, require_admin, require_group
 from error_handler import safe_execute
+from rate_limiter import rate_limited
 
 logger = logging.getLogger(__name__)
 
 
-async def handle_message_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """处理消息积分奖励（自动调用）"""
-    if not update.message or not update.effective_chat:
-        return
-    
-    chat = update.effective_chat
-    user = update.effective_user
-    
-    # 只处理群组消息（不包括频道和私聊）
-    if chat.type == 'private' or chat.type == 'channel':
-        return
-    
-    # 忽略机器人消息
-    if user.is_bot:
-        return
+async def points_stage(ctx):
+    """积分奖励阶段 - 发言获得积分"""
+    chat = ctx.chat
+    user = ctx.user
     
-    # 检查冷却时间（防止刷分）
-    if not db.can_earn_points(chat.id, user.id, cooldown=POINTS_COOLDOWN):
+    # 检查冷却时间（防止刷分，冷却期内的消息不访问数据库）
+    if not await cooldown_tracker.try_acquire(chat.id, user.id):
         return
     
-    # 奖励积分
-    new_points = db.add_points(chat.id, user.id, POINTS_PER_MESSAGE, "发送消息")
-    
-    # 更新最后发言时间
-    db.update_last_message_time(chat.id, user.id)
+    # 奖励积分并更新最后发言时间（写入缓冲，批量落库）
+    points_buffer.add(chat.id, user.id, POINTS_PER_MESSAGE, "发送消息", timestamp=int(time.time()))
     
     # 记录日志（不发送消息，避免刷屏）
-    logger.debug(f"用户 {user.id} 在群组 {chat.id} 获得 {POINTS_PER_MESSAGE} 积分，当前积分: {new_points}")
+    logger.debug(f"用户 {user.id} 在群组 {chat.id} 获得 {POINTS_PER_MESSAGE} 积分")
+
+
+async def handle_message_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理消息积分奖励（单独注册时使用，默认由审核流水线调用 points_stage）"""
+    from moderation_pipeline import MessageContext
+    ctx = MessageContext.from_update(update, context)
+    if ctx:
+        await points_stage(ctx)
 
 
 async def my_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -60,8 +59,8 @@ async def my_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.reply_to_message:
         if await check_admin_permission(update, context):
             target_user = update.message.reply_to_message.from_user
-            points = db.get_user_points(chat.id, target_user.id)
-            rank = db.get_user_rank(chat.id, target_user.id)
+            points = await points_buffer.get_user_points(chat.id, target_user.id)
+            rank = await points_buffer.get_user_rank(chat.id, target_user.id)
             
             rank_text = f"🏆 排名: 第 {rank} 名" if rank else "📊 排名: 暂无排名"
             
@@ -80,8 +79,8 @@ async def my_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
     
     # 查看自己的积分
-    points = db.get_user_points(chat.id, user.id)
-    rank = db.get_user_rank(chat.id, user.id)
+    points = await points_buffer.get_user_points(chat.id, user.id)
+    rank = await points_buffer.get_user_rank(chat.id, user.id)
     
     rank_text = f"🏆 排名: 第 {rank} 名" if rank else "📊 排名: 暂无排名"
     
@@ -97,6 +96,7 @@ async def my_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text, parse_mode='HTML')
 
 
+@rate_limited
 async def points_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查看积分排行榜"""
     chat = update.effective_chat
@@ -110,7 +110,7 @@ async def points_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     
     # 获取前10名
-    top_users = db.get_top_users(chat.id, limit=10)
+    top_users = await points_buffer.get_top_users(chat.id, limit=10)
     
     if not top_users:
         await update.message.reply_text("📊 排行榜为空，还没有人获得积分！")
@@ -120,25 +120,14 @@ async def points_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     medals = ["🥇", "🥈", "🥉"]
     
+    # 显示名优先来自用户资料缓存，缺失或过期的才并发调用 API
+    names = await profiles.resolve_names(context.bot, chat.id, [user_id for user_id, _ in top_users])
+    
     for index, (user_id, points) in enumerate(top_users, 1):
-        try:
-            # 获取用户信息
-            member = await context.bot.get_chat_member(chat.id, user_id)
-            user = member.user
-            
-            # 显示用户名或昵称
-            if user.username:
-                name = f"@{user.username}"
-            else:
-                name = user.first_name or f"用户{user_id}"
-            
-            # 添加奖牌
-            medal = medals[index - 1] if index <= 3 else f"{index}."
-            
-            text += f"{medal} {name}: <b>{points}</b> 分\n"
-        except Exception as e:
-            logger.error(f"获取用户 {user_id} 信息失败: {e}")
-            text += f"{index}. 用户{user_id}: <b>{points}</b> 分\n"
+        # 添加奖牌
+        medal = medals[index - 1] if index <= 3 else f"{index}."
+        
+        text += f"{medal} {names[user_id]}: <b>{points}</b> 分\n"
     
     await update.message.reply_text(text, parse_mode='HTML')
 
@@ -183,7 +172,8 @@ async def add_points_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         target_user = message.reply_to_message.from_user
         reason = " ".join(context.args[1:]) if len(context.args) > 1 else "管理员奖励"
         
-        new_points = db.add_points(chat.id, target_user.id, points, reason)
+        await points_buffer.flush_user(chat.id, target_user.id)
+        new_points = await adb.add_points(chat.id, target_user.id, points, reason)
         
         await message.reply_text(
             f"✅ 已给 {target_user.mention_html()} 添加 <b>{points}</b> 积分\n"
@@ -238,11 +228,12 @@ async def remove_points_command(update: Update, context: ContextTypes.DEFAULT_TY
         target_user = message.reply_to_message.from_user
         reason = " ".join(context.args[1:]) if len(context.args) > 1 else "管理员扣除"
         
-        new_points = db.subtract_points(chat.id, target_user.id, points, reason)
+        await points_buffer.flush_user(chat.id, target_user.id)
+        new_points = await adb.subtract_points(chat.id, target_user.id, points, reason)
         
         # 确保积分不为负
         if new_points < 0:
-            db.set_points(chat.id, target_user.id, 0)
+            await adb.set_points(chat.id, target_user.id, 0)
             new_points = 0
         
         await message.reply_text(
@@ -296,7 +287,8 @@ async def set_points_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return
         
         target_user = message.reply_to_message.from_user
-        new_points = db.set_points(chat.id, target_user.id, points)
+        await points_buffer.flush_user(chat.id, target_user.id)
+        new_points = await adb.set_points(chat.id, target_user.id, points)
         
         await message.reply_text(
             f"✅ 已将 {target_user.mention_html()} 的积分设置为 <b>{new_points}</b>",
@@ -0,0 +1,214 @@
+"""
+用户资料模块
+从收到的每个更新中被动记录用户名和昵称，排行榜等列表直接从这里取显示名，
+只有未命中或过期时才并发调用 Telegram API
+"""
+import time
+import asyncio
+import logging
+from typing import Dict, Iterable, List, Optional
+from telegram import Update, User
+from telegram.ext import ContextTypes
+from database import adb
+from performance import get_cache
+from config import PROFILE_TTL, PROFILE_CACHE_SIZE, PROFILE_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class Profile:
+    """用户资料"""
+    __slots__ = ('user_id', 'username', 'first_name', 'last_name', 'updated_at')
+    
+    def __init__(self, user_id: int, username: Optional[str], first_name: Optional[str],
+                 last_name: Optional[str], updated_at: int):
+        self.user_id = user_id
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+        self.updated_at = updated_at
+    
+    @property
+    def display_name(self) -> str:
+        """显示名（优先用户名，其次昵称）"""
+        if self.username:
+            return f"@{self.username}"
+        return self.first_name or f"用户{self.user_id}"
+    
+    def same_as(self, user: User) -> bool:
+        """资料是否与 Telegram 用户对象一致"""
+        return (self.username == user.username and self.first_name == user.first_name
+                and self.last_name == user.last_name)
+
+
+class ProfileStore:
+    """用户资料存储（内存 LRU + 数据库，定期批量写入）"""
+    
+    def __init__(self, ttl: int = PROFILE_TTL, max_size: int = PROFILE_CACHE_SIZE,
+                 flush_interval: int = PROFILE_FLUSH_INTERVAL):
+        """
+        初始化资料存储
+        
+        Args:
+            ttl: 资料有效期（秒），过期后显示时会通过 API 刷新
+            max_size: 内存中最多保存的资料数
+            flush_interval: 写入数据库的间隔（秒）
+        """
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        self.flush_interval = flush_interval
+        # 资料按容量淘汰，不按时间过期（过期资料仍可作为显示名的后备）
+        self._profiles = get_cache('profiles', default_timeout=None, max_size=self.max_size)
+        self._dirty: Dict[int, Profile] = {}
+        self._task: Optional[asyncio.Task] = None
+        
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.api_lookups = 0
+    
+    def _put(self, profile: Profile):
+        """放入内存缓存"""
+        self._profiles.set(profile.user_id, profile)
+    
+    def observe(self, user: Optional[User]):
+        """记录用户资料（资料未变化且未过半个有效期时不产生写入）"""
+        if user is None:
+            return
+        now = int(time.time())
+        profile = self._profiles.get(user.id)
+        if profile is not None and profile.same_as(user) and now - profile.updated_at < self.ttl // 2:
+            return
+        profile = Profile(user.id, user.username, user.first_name, user.last_name, now)
+        self._put(profile)
+        self._dirty[user.id] = profile
+    
+    def observe_update(self, update: Update):
+        """从更新中记录所有出现的用户"""
+        message = update.effective_message
+        self.observe(update.effective_user)
+        if message:
+            if message.reply_to_message:
+                self.observe(message.reply_to_message.from_user)
+            for member in message.new_chat_members or ():
+                self.observe(member)
+        if update.chat_member:
+            self.observe(update.chat_member.new_chat_member.user)
+    
+    async def get_profiles(self, user_ids: Iterable[int]) -> Dict[int, Profile]:
+        """获取资料（先查内存，未命中的批量查库；可能包含过期资料）"""
+        found = {}
+        missing = []
+        for user_id in user_ids:
+            profile = self._profiles.get(user_id)
+            if profile is not None:
+                self.hits += 1
+                found[user_id] = profile
+            else:
+                missing.append(user_id)
+        
+        if missing:
+            self.misses += len(missing)
+            rows = await adb.get_user_profiles(missing)
+            for user_id, username, first_name, last_name, updated_at in rows:
+                profile = Profile(user_id, username, first_name, last_name, updated_at)
+                # 查库期间可能已收到更新的资料
+                if user_id not in self._profiles:
+                    self._put(profile)
+                found[user_id] = self._profiles.get(user_id, profile)
+        return found
+    
+    async def resolve_names(self, bot, chat_id: int, user_ids: List[int]) -> Dict[int, str]:
+        """
+        获取一批用户的显示名
+        缺失或过期的资料通过 get_chat_member 并发刷新，失败时使用已有资料或默认名
+        
+        Returns:
+            dict: {user_id: 显示名}
+        """
+        profiles = await self.get_profiles(user_ids)
+        now = int(time.time())
+        stale = [
+            user_id for user_id in user_ids
+            if user_id not in profiles or now - profiles[user_id].updated_at >= self.ttl
+        ]
+        
+        if stale:
+            self.api_lookups += len(stale)
+            results = await asyncio.gather(
+                *(bot.get_chat_member(chat_id, user_id) for user_id in stale),
+                return_exceptions=True
+            )
+            for user_id, result in zip(stale, results):
+                if isinstance(result, Exception):
+                    logger.error(f"获取用户 {user_id} 信息失败: {result}")
+                    continue
+                self.observe(result.user)
+                profiles[user_id] = self._profiles.get(user_id) or Profile(
+                    user_id, result.user.username, result.user.first_name, result.user.last_name, now
+                )
+        
+        return {
+            user_id: profiles[user_id].display_name if user_id in profiles else f"用户{user_id}"
+            for user_id in user_ids
+        }
+    
+    async def flush(self) -> int:
+        """将变化的资料写入数据库"""
+        if not self._dirty:
+            return 0
+        dirty, self._dirty = self._dirty, {}
+        rows = [
+            (p.user_id, p.username, p.first_name, p.last_name, p.updated_at)
+            for p in dirty.values()
+        ]
+        try:
+            await adb.upsert_user_profiles(rows)
+        except Exception as e:
+            # 写入失败，放回等待下次重试（保留期间更新的较新资料）
+            for user_id, profile in dirty.items():
+                self._dirty.setdefault(user_id, profile)
+            logger.error(f"写入用户资料失败: {e}")
+            return 0
+        return len(rows)
+    
+    async def _run(self):
+        """定时写入循环"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+    
+    def start(self):
+        """启动定时写入（需要在事件循环中调用）"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+    
+    async def close(self):
+        """停止定时写入并写入剩余资料"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+    
+    def stats(self) -> dict:
+        """获取资料存储统计信息"""
+        return {
+            'size': len(self._profiles),
+            'dirty': len(self._dirty),
+            'hits': self.hits,
+            'misses': self.misses,
+            'api_lookups': self.api_lookups,
+        }
+
+
+# 全局用户资料实例
+profiles = ProfileStore()
+
+
+async def track_profiles(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """记录每个更新中出现的用户资料（在所有处理器之前运行）"""
+    profiles.observe_update(update)
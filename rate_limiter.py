@@ -0,0 +1,198 @@
+"""
+速率限制模块
+使用 GCRA（通用信元速率算法，等价于令牌桶）按用户、群组和全局三个范围限制请求频率：
+- 每个键只保存一个时间戳（理论到达时间），在请求时按当前时间计算，不需要为每个键设置定时器
+- 理论到达时间已过去的键与不存在等价，按更新顺序从头部淘汰，内存有上限
+- 消息由审核流水线的 ratelimit 阶段限制：用户超限时删除消息，群组或全局超限时审核照常进行、跳过数据库操作；
+  开销较大的命令（/top、/stats）使用 @rate_limited 装饰器，被限制的命令在访问数据库之前就被丢弃
+"""
+import time
+import logging
+from collections import OrderedDict
+from functools import wraps
+from typing import Hashable, Optional, Tuple
+from telegram import Update
+from telegram.ext import ContextTypes
+from config import (
+    RATE_LIMIT_ENABLED, RATE_LIMIT_PER_USER, RATE_LIMIT_PER_CHAT, RATE_LIMIT_GLOBAL,
+    RATE_LIMIT_COMMANDS_PER_USER, RATE_LIMIT_COMMANDS_PER_CHAT, RATE_LIMIT_COMMANDS_GLOBAL,
+    RATE_LIMIT_MAX_KEYS
+)
+from metrics import metrics, rate_limited_total
+
+logger = logging.getLogger(__name__)
+
+# 限制范围
+SCOPE_USER = 'user'
+SCOPE_CHAT = 'chat'
+SCOPE_GLOBAL = 'global'
+
+
+class GCRALimiter:
+    """
+    单个范围的 GCRA 限流器
+    
+    每 period 秒允许 limit 次，最多可连续 burst 次；
+    每次请求把键的理论到达时间（TAT）推后 period / limit 秒，TAT 超前当前时间太多时拒绝
+    """
+    
+    def __init__(self, limit: int, period: float = 60, burst: Optional[int] = None,
+                 max_keys: int = RATE_LIMIT_MAX_KEYS):
+        """
+        初始化限流器
+        
+        Args:
+            limit: 每个周期允许的次数，0 表示不限制
+            period: 周期（秒）
+            burst: 最多连续允许的次数，默认等于 limit
+            max_keys: 最多保存的键数（超过时淘汰最早更新的键）
+        """
+        self.limit = max(0, limit)
+        self.interval = period / self.limit if self.limit else 0.0
+        self.burst = max(1, burst if burst is not None else self.limit)
+        # 允许 TAT 超前当前时间的最大值
+        self.tolerance = self.interval * (self.burst - 1)
+        self.max_keys = max(1, max_keys)
+        # 格式: {键: 理论到达时间}，按更新先后排列
+        self._tat: "OrderedDict[Hashable, float]" = OrderedDict()
+    
+    def retry_after(self, key: Hashable, now: float) -> float:
+        """不消耗配额，返回需要等待的秒数（0 表示允许）"""
+        if not self.limit:
+            return 0.0
+        tat = self._tat.get(key, now)
+        return max(0.0, tat - now - self.tolerance)
+    
+    def consume(self, key: Hashable, now: float):
+        """消耗一次配额（调用前应先用 retry_after 检查）"""
+        if not self.limit:
+            return
+        tat = self._tat.get(key, now)
+        self._tat[key] = max(tat, now) + self.interval
+        self._tat.move_to_end(key)
+        self._evict(now)
+    
+    def _evict(self, now: float):
+        """淘汰理论到达时间已过去的键，并保证不超过容量上限"""
+        tat = self._tat
+        while tat:
+            key, value = next(iter(tat.items()))
+            if value > now and len(tat) <= self.max_keys:
+                break
+            tat.popitem(last=False)
+    
+    def __len__(self) -> int:
+        return len(self._tat)
+
+
+class RateLimiter:
+    """按用户、群组和全局三个范围限制请求频率（三个范围都允许时才消耗配额）"""
+    
+    def __init__(self, name: str, per_user: int, per_chat: int, global_limit: int, period: float = 60,
+                 enabled: bool = RATE_LIMIT_ENABLED):
+        """
+        初始化速率限制器
+        
+        Args:
+            name: 名称（用于指标和日志）
+            per_user: 每个用户每个周期允许的次数，0 表示不限制
+            per_chat: 每个群组每个周期允许的次数，0 表示不限制
+            global_limit: 全局每个周期允许的次数，0 表示不限制
+            period: 周期（秒）
+            enabled: 是否启用
+        """
+        self.name = name
+        self.enabled = enabled
+        self.scopes: Tuple[Tuple[str, GCRALimiter], ...] = (
+            (SCOPE_GLOBAL, GCRALimiter(global_limit, period)),
+            (SCOPE_CHAT, GCRALimiter(per_chat, period)),
+            (SCOPE_USER, GCRALimiter(per_user, period)),
+        )
+        # 被限制时每个用户每个周期最多提示一次
+        self._notices = GCRALimiter(1, period)
+    
+    def check(self, chat_id: int, user_id: int, now: Optional[float] = None) -> Optional[Tuple[str, float]]:
+        """
+        检查并消耗一次配额
+        
+        Returns:
+            被限制时返回 (范围, 需要等待的秒数)，否则返回 None
+        """
+        if not self.enabled:
+            return None
+        now = time.monotonic() if now is None else now
+        keys = {SCOPE_GLOBAL: None, SCOPE_CHAT: chat_id, SCOPE_USER: (chat_id, user_id)}
+        for scope, limiter in self.scopes:
+            wait = limiter.retry_after(keys[scope], now)
+            if wait > 0:
+                rate_limited_total.labels(self.name, scope).inc()
+                return scope, wait
+        for scope, limiter in self.scopes:
+            limiter.consume(keys[scope], now)
+        return None
+    
+    def should_notify(self, user_id: int, now: Optional[float] = None) -> bool:
+        """被限制的用户是否需要提示（每个周期最多一次）"""
+        now = time.monotonic() if now is None else now
+        if self._notices.retry_after(user_id, now) > 0:
+            return False
+        self._notices.consume(user_id, now)
+        return True
+    
+    def stats(self) -> dict:
+        """获取各范围跟踪的键数"""
+        return {scope: len(limiter) for scope, limiter in self.scopes}
+
+
+# 普通消息（审核流水线）和开销较大的命令分别限制
+message_limiter = RateLimiter('message', RATE_LIMIT_PER_USER, RATE_LIMIT_PER_CHAT, RATE_LIMIT_GLOBAL)
+command_limiter = RateLimiter('command', RATE_LIMIT_COMMANDS_PER_USER, RATE_LIMIT_COMMANDS_PER_CHAT,
+                              RATE_LIMIT_COMMANDS_GLOBAL)
+
+metrics.gauge('rate_limiter_keys', '速率限制跟踪的键数', lambda: {
+    (limiter.name, scope): count
+    for limiter in (message_limiter, command_limiter)
+    for scope, count in limiter.stats().items()
+}, ('limiter', 'scope'))
+
+
+def rate_limited(func):
+    """
+    装饰器：按 command_limiter 限制命令频率，超过限制时直接返回（不访问数据库）
+    使用示例:
+        @rate_limited
+        async def my_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            ...
+    """
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        chat = update.effective_chat
+        user = update.effective_user
+        if chat and user:
+            limited = command_limiter.check(chat.id, user.id)
+            if limited:
+                scope, wait = limited
+                # 全局超限说明机器人负载过高，不再额外发送提示
+                if scope != SCOPE_GLOBAL and update.message and command_limiter.should_notify(user.id):
+                    await update.message.reply_text(f"⏳ 操作太频繁，请 {int(wait) + 1} 秒后再试")
+                return
+        return await func(update, context, *args, **kwargs)
+    return wrapper
+
+
+async def rate_limit_stage(ctx):
+    """
+    速率限制阶段 - 放在流水线最前面
+    
+    用户超过限制时删除消息（管理员除外）；群组或全局超过限制时说明负载过高，
+    防刷屏、重复消息、广告等内存中的审核继续执行，只跳过访问数据库的工作（积分、群组设置查询、扣分）
+    """
+    limited = message_limiter.check(ctx.chat.id, ctx.user.id)
+    if not limited:
+        return
+    scope, _ = limited
+    if scope == SCOPE_USER:
+        if not await ctx.is_admin():
+            await ctx.delete("发言过快")
+        return
+    ctx.shed()
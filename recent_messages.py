@@ -0,0 +1,82 @@
+"""
+最近消息索引模块
+按 (chat_id, user_id) 记录每个用户最近发送的消息ID，/purge 按用户清理时直接从这里取：
+- 每个用户一个定长队列，只保留最近 RECENT_MESSAGES_PER_USER 条
+- 用户数按 LRU 限制，长时间不发言的用户最先淘汰
+"""
+import logging
+from collections import deque
+from typing import Iterable, List
+from telegram import Update
+from telegram.ext import ContextTypes
+from performance import get_cache
+from config import RECENT_MESSAGES_PER_USER, RECENT_MESSAGES_MAX_USERS
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RecentMessages:
+    """最近消息索引（内存）"""
+    
+    def __init__(self, per_user: int = RECENT_MESSAGES_PER_USER, max_users: int = RECENT_MESSAGES_MAX_USERS):
+        """
+        初始化索引
+        
+        Args:
+            per_user: 每个用户在每个群组中保留的消息数
+            max_users: 最多记录的 (群组, 用户) 数
+        """
+        self.per_user = max(1, per_user)
+        self._index = get_cache('recent_messages', default_timeout=None, max_size=max_users)
+    
+    def record(self, chat_id: int, user_id: int, message_id: int):
+        """记录一条消息"""
+        key = (chat_id, user_id)
+        ids = self._index.get(key)
+        if ids is None:
+            ids = deque(maxlen=self.per_user)
+            self._index.set(key, ids)
+        ids.append(message_id)
+    
+    def recent(self, chat_id: int, user_id: int, limit: int) -> List[int]:
+        """
+        获取用户最近的消息ID
+        
+        Returns:
+            List[int]: 最多 limit 个消息ID（从旧到新）
+        """
+        ids = self._index.get((chat_id, user_id))
+        if not ids or limit <= 0:
+            return []
+        return list(ids)[-limit:]
+    
+    def discard(self, chat_id: int, user_id: int, message_ids: Iterable[int]):
+        """移除已删除的消息"""
+        key = (chat_id, user_id)
+        ids = self._index.get(key)
+        if not ids:
+            return
+        removed = set(message_ids)
+        remaining = [message_id for message_id in ids if message_id not in removed]
+        ids.clear()
+        ids.extend(remaining)
+    
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+# 全局最近消息索引
+recent_messages = RecentMessages()
+
+metrics.gauge('recent_messages_users', '最近消息索引记录的用户数', lambda: len(recent_messages))
+
+
+async def track_recent_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """记录群组中每条用户消息的ID（在所有处理器之前运行）"""
+    message = update.message
+    if message is None or message.from_user is None:
+        return
+    if message.chat.type not in ('group', 'supergroup'):
+        return
+    recent_messages.record(message.chat_id, message.from_user.id, message.message_id)
@@ -0,0 +1,422 @@
+"""
+多进程分片模块
+前端进程通过 Polling 或 Webhook 接收更新，按 chat_id % N 转发给 N 个工作进程，
+每个工作进程运行完整的处理器和各自的缓存；协调器负责重启崩溃的工作进程，
+多次崩溃的进程暂时下线，其分片转交给其他进程，恢复后再还原
+"""
+import json
+import time
+import queue
+import signal
+import asyncio
+import logging
+import importlib
+import multiprocessing
+from typing import List, Optional
+from telegram import Bot, Update
+from telegram.ext import Updater
+from web_server import WebServer, add_webhook_route
+from metrics import metrics, merge_rendered
+from config import (
+    BOT_TOKEN, SHARD_WORKERS, SHARD_QUEUE_SIZE, SHARD_MAX_RESTARTS,
+    SHARD_RESTART_WINDOW, SHARD_CHECK_INTERVAL, METRICS_HOST
+)
+from dispatcher import ChatOrderedUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# 使用 spawn 启动工作进程，避免继承父进程的数据库连接和事件循环
+_mp = multiprocessing.get_context('spawn')
+
+# 前端读取工作进程指标的超时时间（秒）
+METRICS_FETCH_TIMEOUT = 5
+
+
+def _worker_main(index: int, inbox, factory: str):
+    """工作进程入口（Ctrl+C 由前端进程统一处理，工作进程收到结束标记后退出）"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve_worker(index, inbox, factory))
+
+
+async def _serve_worker(index: int, inbox, factory: str):
+    """
+    工作进程主循环：从收件箱读取更新交给 Application 处理
+    
+    Args:
+        index: 工作进程编号
+        inbox: 收件箱（内容为更新 JSON，None 表示结束）
+        factory: 创建 Application 的函数，格式 "模块:函数"
+    """
+    module_name, func_name = factory.split(':')
+    module = importlib.import_module(module_name)
+    # 各工作进程的指标服务只监听 METRICS_HOST，使用不同端口（前端端口 + 编号 + 1），由前端进程汇总输出
+    web_server = getattr(module, 'web_server', None)
+    if web_server is not None:
+        web_server.host = METRICS_HOST
+        web_server.port += index + 1
+    application = getattr(module, func_name)(with_updater=False)
+    loop = asyncio.get_running_loop()
+    
+    # 启动失败时也要执行 post_shutdown，写入缓冲中的积分和定时删除记录
+    try:
+        async with application:
+            if application.post_init:
+                await application.post_init(application)
+            await application.start()
+            logger.info(f"✅ 工作进程 {index} 已启动")
+            
+            try:
+                while True:
+                    data = await loop.run_in_executor(None, inbox.get)
+                    if data is None:
+                        break
+                    try:
+                        update = Update.de_json(json.loads(data), application.bot)
+                    except Exception as e:
+                        logger.error(f"工作进程 {index} 解析更新失败: {e}")
+                        continue
+                    await application.update_queue.put(update)
+            finally:
+                # 等待已接收的更新处理完毕
+                await application.stop()
+    finally:
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+    logger.info(f"工作进程 {index} 已退出")
+
+
+class WorkerSlot:
+    """工作进程槽位（收件箱在重启后保留，未处理的更新不会丢失）"""
+    
+    def __init__(self, index: int, queue_size: int):
+        self.index = index
+        self.inbox = _mp.Queue(maxsize=queue_size)
+        self.process: Optional[multiprocessing.Process] = None
+        # 最近的重启时间，用于判断是否频繁崩溃
+        self.restart_times: List[float] = []
+        # 下线时间（频繁崩溃后暂停重启），None 表示在线
+        self.offline_since: Optional[float] = None
+        
+        # 统计信息
+        self.routed = 0
+        self.restarts = 0
+        self.blocked = 0
+    
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+    
+    def stats(self) -> dict:
+        """获取槽位统计信息"""
+        try:
+            depth = self.inbox.qsize()
+        except NotImplementedError:
+            depth = -1
+        return {
+            'pid': self.process.pid if self.process else None,
+            'alive': self.alive,
+            'online': self.offline_since is None,
+            'depth': depth,
+            'routed': self.routed,
+            'restarts': self.restarts,
+            'blocked': self.blocked,
+        }
+
+
+class ShardCoordinator:
+    """
+    分片协调器（运行在前端进程）
+    
+    - 分片 i 默认由工作进程 i 处理，同一群组的更新始终进入同一进程，进程内缓存保持一致
+    - 工作进程崩溃后用同一个收件箱重启
+    - 在 restart_window 秒内重启超过 max_restarts 次的进程下线，
+      其分片和积压的更新转交给其他在线进程；下线满 restart_window 秒后再尝试恢复
+    """
+    
+    def __init__(self, factory: str, workers: int = SHARD_WORKERS, queue_size: int = SHARD_QUEUE_SIZE,
+                 max_restarts: int = SHARD_MAX_RESTARTS, restart_window: int = SHARD_RESTART_WINDOW):
+        """
+        初始化协调器
+        
+        Args:
+            factory: 创建 Application 的函数，格式 "模块:函数"
+            workers: 工作进程数（即分片数）
+            queue_size: 每个工作进程收件箱的上限
+            max_restarts: 时间窗口内允许的最大重启次数
+            restart_window: 重启次数统计窗口（秒）
+        """
+        self.factory = factory
+        self.shard_count = max(1, workers)
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.slots = [WorkerSlot(index, queue_size) for index in range(self.shard_count)]
+        # 路由表: 分片 -> 工作进程编号
+        self.routes = list(range(self.shard_count))
+    
+    def _spawn(self, slot: WorkerSlot):
+        """启动工作进程"""
+        slot.process = _mp.Process(
+            target=_worker_main,
+            args=(slot.index, slot.inbox, self.factory),
+            name=f"bot-shard-{slot.index}",
+            daemon=False
+        )
+        slot.process.start()
+        logger.info(f"启动工作进程 {slot.index} (pid={slot.process.pid})")
+    
+    def start(self):
+        """启动所有工作进程"""
+        for slot in self.slots:
+            self._spawn(slot)
+    
+    def route(self, update: Update) -> WorkerSlot:
+        """获取更新所属的工作进程"""
+        shard = ChatOrderedUpdateProcessor.lane_key(update) % self.shard_count
+        return self.slots[self.routes[shard]]
+    
+    async def dispatch(self, update: Update):
+        """把更新转发给所属的工作进程（收件箱满时等待）"""
+        slot = self.route(update)
+        data = update.to_json()
+        try:
+            slot.inbox.put_nowait(data)
+        except queue.Full:
+            slot.blocked += 1
+            await asyncio.get_running_loop().run_in_executor(None, slot.inbox.put, data)
+        slot.routed += 1
+    
+    def _online_slots(self) -> List[WorkerSlot]:
+        return [slot for slot in self.slots if slot.offline_since is None]
+    
+    async def _take_offline(self, slot: WorkerSlot):
+        """下线频繁崩溃的工作进程，把它的分片和积压更新转交给其他进程（目标收件箱满时等待，不阻塞事件循环）"""
+        online = [other for other in self._online_slots() if other is not slot]
+        if not online:
+            # 没有其他可用进程，只能继续重启
+            return False
+        
+        slot.offline_since = time.monotonic()
+        moved_shards = [shard for shard, target in enumerate(self.routes) if target == slot.index]
+        for offset, shard in enumerate(moved_shards):
+            self.routes[shard] = online[offset % len(online)].index
+        
+        # 积压的更新按顺序转交（同一群组仍进入同一个新进程）
+        moved = 0
+        while True:
+            try:
+                data = slot.inbox.get_nowait()
+            except queue.Empty:
+                break
+            target = self.slots[self.routes[_json_update_key(data) % self.shard_count]]
+            try:
+                target.inbox.put_nowait(data)
+            except queue.Full:
+                target.blocked += 1
+                await asyncio.get_running_loop().run_in_executor(None, target.inbox.put, data)
+            moved += 1
+        
+        logger.error(
+            f"工作进程 {slot.index} 频繁崩溃，暂时下线: "
+            f"分片 {moved_shards} 转交给其他进程，转移积压更新 {moved} 条"
+        )
+        return True
+    
+    def _restore(self, slot: WorkerSlot):
+        """恢复下线的工作进程并还原它的分片"""
+        slot.offline_since = None
+        slot.restart_times.clear()
+        self._spawn(slot)
+        self.routes[slot.index] = slot.index
+        logger.info(f"工作进程 {slot.index} 已恢复，分片 {slot.index} 还原")
+    
+    async def check_workers(self):
+        """检查工作进程状态，重启崩溃的进程（由监控循环定期调用）"""
+        now = time.monotonic()
+        for slot in self.slots:
+            if slot.offline_since is not None:
+                if now - slot.offline_since >= self.restart_window:
+                    self._restore(slot)
+                continue
+            
+            if slot.alive:
+                continue
+            
+            exitcode = slot.process.exitcode if slot.process else None
+            logger.error(f"工作进程 {slot.index} 已退出 (exitcode={exitcode})")
+            
+            slot.restart_times = [t for t in slot.restart_times if now - t < self.restart_window]
+            if len(slot.restart_times) >= self.max_restarts and await self._take_offline(slot):
+                continue
+            
+            slot.restart_times.append(now)
+            slot.restarts += 1
+            self._spawn(slot)
+    
+    async def monitor(self, interval: int = SHARD_CHECK_INTERVAL):
+        """监控循环"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.check_workers()
+            except Exception as e:
+                logger.error(f"检查工作进程状态时出错: {e}")
+    
+    def stop(self, timeout: float = 30):
+        """通知所有工作进程处理完剩余更新后退出"""
+        for slot in self.slots:
+            if slot.alive:
+                slot.inbox.put(None)
+        deadline = time.monotonic() + timeout
+        for slot in self.slots:
+            if slot.process is None:
+                continue
+            slot.process.join(max(0.0, deadline - time.monotonic()))
+            if slot.process.is_alive():
+                logger.warning(f"工作进程 {slot.index} 未能按时退出，强制结束")
+                slot.process.terminate()
+                slot.process.join()
+    
+    def stats(self) -> dict:
+        """获取协调器统计信息"""
+        return {
+            'shards': self.shard_count,
+            'routes': list(self.routes),
+            'workers': [slot.stats() for slot in self.slots],
+        }
+
+
+def _json_update_key(data: str) -> int:
+    """从更新 JSON 中取分组键（与 ChatOrderedUpdateProcessor.lane_key 一致）"""
+    return ChatOrderedUpdateProcessor.lane_key(Update.de_json(json.loads(data), None))
+
+
+async def _fetch_worker_metrics(port: int) -> Optional[str]:
+    """读取工作进程的 /metrics，无法连接或超时返回 None"""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(METRICS_HOST, port), METRICS_FETCH_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    try:
+        writer.write(f"GET /metrics HTTP/1.1\r\nHost: {METRICS_HOST}\r\nConnection: close\r\n\r\n".encode('latin-1'))
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), METRICS_FETCH_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    finally:
+        writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    if not head.startswith(b'HTTP/1.1 200'):
+        return None
+    return body.decode('utf-8')
+
+
+def _add_metrics_route(web_server: WebServer, coordinator: ShardCoordinator, base_port: int):
+    """前端的 /metrics 汇总各工作进程的指标（样本加 shard 标签，另输出 shard_up 表示能否读取）"""
+    up_name = f"{metrics.prefix}_shard_up"
+    
+    async def handle_metrics(headers, body):
+        outputs = await asyncio.gather(*(
+            _fetch_worker_metrics(base_port + slot.index + 1) for slot in coordinator.slots
+        ))
+        rendered = []
+        for slot, text in zip(coordinator.slots, outputs):
+            rendered.append((str(slot.index), (
+                f"# HELP {up_name} 能否读取工作进程的指标\n# TYPE {up_name} gauge\n"
+                f"{up_name} {0 if text is None else 1}\n"
+            )))
+            if text is not None:
+                rendered.append((str(slot.index), text))
+        return 200, 'text/plain; version=0.0.4; charset=utf-8', merge_rendered(rendered, 'shard').encode('utf-8')
+    
+    web_server.add_route('GET', '/metrics', handle_metrics)
+
+
+async def _serve_front(coordinator: ShardCoordinator, webhook_url: Optional[str], port: int, url_path: str,
+                       secret_token: Optional[str], metrics_port: int = 0):
+    """前端进程：接收更新并转发给工作进程，/metrics 汇总各工作进程的指标"""
+    bot = Bot(BOT_TOKEN)
+    update_queue: asyncio.Queue = asyncio.Queue()
+    updater = Updater(bot, update_queue)
+    web_server = None
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Windows 不支持，使用默认的 KeyboardInterrupt
+            pass
+    
+    coordinator.start()
+    monitor_task = loop.create_task(coordinator.monitor())
+    
+    async def forward():
+        while True:
+            update = await update_queue.get()
+            try:
+                await coordinator.dispatch(update)
+            except Exception as e:
+                logger.error(f"转发更新失败: {e}")
+    
+    forward_task = loop.create_task(forward())
+    
+    try:
+        async with updater:
+            try:
+                if webhook_url:
+                    logger.info(f"分片模式（Webhook）: {webhook_url}，监听端口: {port}")
+                    web_server = WebServer("0.0.0.0", port)
+                    add_webhook_route(web_server, bot, update_queue, url_path, secret_token)
+                    _add_metrics_route(web_server, coordinator, port)
+                    await web_server.start()
+                    await bot.set_webhook(webhook_url, allowed_updates=Update.ALL_TYPES, secret_token=secret_token)
+                else:
+                    logger.info("分片模式（Polling）")
+                    if metrics_port > 0:
+                        web_server = WebServer(METRICS_HOST, metrics_port)
+                        _add_metrics_route(web_server, coordinator, metrics_port)
+                        await web_server.start()
+                    await updater.start_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+                logger.info(f"✅ 前端进程已启动，{coordinator.shard_count} 个工作进程")
+                
+                await stop_event.wait()
+            finally:
+                # 启动失败时也要停止接收，Updater 才能正常关闭
+                if web_server:
+                    await web_server.close()
+                if updater.running:
+                    await updater.stop()
+            
+            # 转发剩余的更新
+            while not update_queue.empty():
+                await coordinator.dispatch(update_queue.get_nowait())
+    finally:
+        forward_task.cancel()
+        monitor_task.cancel()
+        await asyncio.gather(forward_task, monitor_task, return_exceptions=True)
+        logger.info("正在停止工作进程...")
+        await loop.run_in_executor(None, coordinator.stop)
+
+
+def run_sharded(factory: str, webhook_url: Optional[str] = None, port: int = 8000, url_path: str = '/webhook',
+                secret_token: Optional[str] = None, metrics_port: int = 0):
+    """
+    以分片模式运行机器人
+    
+    前端的 /metrics（Webhook 模式在 port，Polling 模式在 metrics_port）汇总各工作进程的指标；
+    工作进程 i 的指标服务监听 METRICS_HOST:该端口 + i + 1，只供前端读取
+    
+    Args:
+        factory: 创建 Application 的函数，格式 "模块:函数"，函数需要接受 with_updater 参数
+        webhook_url: Webhook 地址，为空时使用 Polling
+        port: Webhook 监听端口
+        url_path: Webhook 路径
+        secret_token: Webhook 校验令牌
+        metrics_port: Polling 模式下前端指标服务的端口（与工作进程的 METRICS_PORT 一致），0 表示不启用
+    """
+    coordinator = ShardCoordinator(factory)
+    try:
+        asyncio.run(_serve_front(coordinator, webhook_url, port, url_path, secret_token, metrics_port))
+    except KeyboardInterrupt:
+        pass
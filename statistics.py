@@ -4,29 +4,17 @@
 """
 from telegram import Update
 from telegram.ext import ContextTypes
-from telegram.constants import ChatMemberStatus
 import logging
-from database import db
+from database import adb
+from utils_common import check_admin_permission, get_chat_info
+from points_buffer import points_buffer
+from leaderboard import leaderboard
+from rate_limiter import rate_limited
 
 logger = logging.getLogger(__name__)
 
 
-async def check_admin_permission(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """检查用户是否有管理员权限"""
-    user = update.effective_user
-    chat = update.effective_chat
-    
-    if not chat or chat.type == 'private':
-        return False
-    
-    try:
-        member = await context.bot.get_chat_member(chat.id, user.id)
-        return member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]
-    except Exception as e:
-        logger.error(f"检查管理员权限时出错: {e}")
-        return False
-
-
+@rate_limited
 async def group_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查看群组/频道统计"""
     chat = update.effective_chat
@@ -37,7 +25,7 @@ async def group_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         # 获取群组/频道信息
-        chat_info = await context.bot.get_chat(chat.id)
+        chat_info = await get_chat_info(context.bot, chat.id)
         member_count = chat_info.members_count or 0
         
         chat_type_name = "频道" if chat.type == 'channel' else "群组"
@@ -57,17 +45,11 @@ async def group_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             # 群组统计（完整版）
             # 获取积分统计
-            top_users = db.get_top_users(chat.id, limit=1)
-            total_users_with_points = len(db.get_top_users(chat.id, limit=1000))
+            await points_buffer.flush()
+            total_users_with_points = await leaderboard.get_user_count(chat.id)
             
             # 获取警告统计
-            conn = db.get_connection()
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT COUNT(DISTINCT user_id) FROM warnings WHERE chat_id = ?
-            """, (chat.id,))
-            warned_users = cursor.fetchone()[0] or 0
-            conn.close()
+            warned_users = await adb.get_warned_users_count(chat.id)
             
             stats_text = f"""
 📊 群组统计
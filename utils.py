@@ -5,6 +5,8 @@
 from telegram import Update
 from telegram.ext import ContextTypes
 import logging
+from profiles import profiles
+from utils_common import admin_roster, get_chat_info
 
 logger = logging.getLogger(__name__)
 
@@ -47,7 +49,7 @@ async def group_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        chat_info = await context.bot.get_chat(chat.id)
+        chat_info = await get_chat_info(context.bot, chat.id)
         
         chat_type_name = "频道" if chat.type == 'channel' else "群组"
         
@@ -82,7 +84,9 @@ async def admins_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        administrators = await context.bot.get_chat_administrators(chat.id)
+        administrators = await admin_roster.get_administrators(context.bot, chat.id)
+        for admin in administrators:
+            profiles.observe(admin.user)
         
         chat_type_name = "频道" if chat.type == 'channel' else "群组"
         
@@ -2,29 +2,127 @@
 公共工具模块
 统一管理所有模块共用的函数，避免代码重复
 """
+import time
+import asyncio
 import logging
 from telegram import Update
 from telegram.ext import ContextTypes
 from telegram.constants import ChatMemberStatus
 from functools import wraps
 from typing import Optional
+from config import ADMIN_CACHE_TIMEOUT, CHAT_INFO_CACHE_TIMEOUT
+from performance import get_cache, cached
 
 logger = logging.getLogger(__name__)
 
-# 缓存管理员状态（减少API调用）
-_admin_cache = {}
-_cache_timeout = 300  # 缓存5分钟
+ADMIN_STATUSES = (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+
+
+class AdminRoster:
+    """
+    群组管理员名单缓存
+    每个群组通过 get_chat_administrators 加载一次完整名单，
+    之后由 ChatMemberUpdated 更新增量维护，判断是否管理员为 O(1)
+    """
+    
+    def __init__(self, timeout: int = ADMIN_CACHE_TIMEOUT):
+        """
+        初始化管理员名单缓存
+        
+        Args:
+            timeout: 名单有效期（秒），过期后重新加载
+        """
+        self.timeout = timeout
+        # 格式: {chat_id: (管理员ID集合, 管理员列表, 加载时间)}，过期和容量由缓存管理
+        self._rosters = get_cache('admin_rosters', default_timeout=timeout)
+        # 正在加载的群组，避免并发重复请求: {chat_id: Future}
+        self._loading = {}
+        
+        # 统计信息
+        self.loads = 0
+        self.hits = 0
+    
+    async def _load(self, bot, chat_id: int):
+        """加载管理员名单（同一群组的并发请求共享一次 API 调用）"""
+        future = self._loading.get(chat_id)
+        if future is not None:
+            return await asyncio.shield(future)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._loading[chat_id] = future
+        try:
+            administrators = await bot.get_chat_administrators(chat_id)
+            roster = ({admin.user.id for admin in administrators}, list(administrators), time.time())
+            self._rosters.set(chat_id, roster)
+            self.loads += 1
+            future.set_result(roster)
+            return roster
+        except Exception as e:
+            future.set_exception(e)
+            # 避免没有等待者时出现 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            self._loading.pop(chat_id, None)
+    
+    async def get_roster(self, bot, chat_id: int, refresh: bool = False):
+        """获取 (管理员ID集合, 管理员列表, 加载时间)"""
+        roster = None if refresh else self._rosters.get(chat_id)
+        if roster is not None:
+            self.hits += 1
+            return roster
+        return await self._load(bot, chat_id)
+    
+    async def get_administrators(self, bot, chat_id: int, refresh: bool = False) -> list:
+        """获取管理员列表（ChatMember 对象）"""
+        return (await self.get_roster(bot, chat_id, refresh))[1]
+    
+    async def is_admin(self, bot, chat_id: int, user_id: int, refresh: bool = False) -> bool:
+        """判断用户是否为管理员"""
+        return user_id in (await self.get_roster(bot, chat_id, refresh))[0]
+    
+    def update_member(self, chat_id: int, member):
+        """根据 ChatMemberUpdated 中的新状态增量更新名单"""
+        roster = self._rosters.get(chat_id)
+        if roster is None:
+            return
+        admin_ids, administrators, loaded_at = roster
+        user_id = member.user.id
+        administrators = [admin for admin in administrators if admin.user.id != user_id]
+        if member.status in ADMIN_STATUSES:
+            administrators.append(member)
+            admin_ids = admin_ids | {user_id}
+        else:
+            admin_ids = admin_ids - {user_id}
+        # 保留原过期时间，到期后仍从 API 重新加载完整名单
+        self._rosters.update(chat_id, (admin_ids, administrators, loaded_at))
+    
+    def invalidate(self, chat_id: Optional[int] = None):
+        """丢弃缓存的名单（chat_id 为 None 时丢弃全部）"""
+        if chat_id is None:
+            self._rosters.clear()
+        else:
+            self._rosters.delete(chat_id)
+    
+    def stats(self) -> dict:
+        """获取统计信息"""
+        return {'chats': len(self._rosters), 'loads': self.loads, 'hits': self.hits}
+
+
+# 全局管理员名单缓存
+admin_roster = AdminRoster()
 
 
 async def check_admin_permission(update: Update, context: ContextTypes.DEFAULT_TYPE, use_cache: bool = True, allow_channel: bool = True) -> bool:
     """
     检查用户是否有管理员权限（统一函数，避免重复代码）
     支持群组和频道
+    同一个更新内的重复检查直接返回第一次的结果
     
     Args:
         update: Telegram Update 对象
         context: Context 对象
-        use_cache: 是否使用缓存（默认True）
+        use_cache: 是否使用缓存（默认True，False时重新加载管理员名单）
         allow_channel: 是否允许频道（默认True）
     
     Returns:
@@ -37,41 +135,54 @@ async def check_admin_permission(update: Update, context: ContextTypes.DEFAULT_T
         return False
     
     # 频道支持
-    if chat.type == 'channel':
-        if not allow_channel:
-            return False
-        # 频道需要检查是否是管理员
-        try:
-            member = await context.bot.get_chat_member(chat.id, user.id)
-            return member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]
-        except Exception as e:
-            logger.error(f"检查频道管理员权限时出错: {e}")
-            return False
+    if chat.type == 'channel' and not allow_channel:
+        return False
     
     if not user:
         return False
     
-    # 检查缓存
-    cache_key = (chat.id, user.id)
-    if use_cache and cache_key in _admin_cache:
-        cached_result, cached_time = _admin_cache[cache_key]
-        import time
-        if time.time() - cached_time < _cache_timeout:
-            return cached_result
+    # 同一更新内的结果（context 在同一更新的所有处理器之间共享）
+    memo = getattr(context, '_admin_memo', None)
+    if memo is None:
+        memo = {}
+        context._admin_memo = memo
+    memo_key = (chat.id, user.id)
+    if use_cache and memo_key in memo:
+        return memo[memo_key]
     
     try:
-        member = await context.bot.get_chat_member(chat.id, user.id)
-        is_admin = member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]
-        
-        # 更新缓存
-        if use_cache:
-            import time
-            _admin_cache[cache_key] = (is_admin, time.time())
-        
-        return is_admin
+        is_admin = await admin_roster.is_admin(context.bot, chat.id, user.id, refresh=not use_cache)
     except Exception as e:
-        logger.error(f"检查管理员权限时出错: {e}")
-        return False
+        logger.warning(f"获取管理员名单失败，改为单独查询: {e}")
+        try:
+            member = await context.bot.get_chat_member(chat.id, user.id)
+            is_admin = member.status in ADMIN_STATUSES
+        except Exception as e:
+            logger.error(f"检查管理员权限时出错: {e}")
+            return False
+    
+    memo[memo_key] = is_admin
+    return is_admin
+
+
+@cached(timeout=CHAT_INFO_CACHE_TIMEOUT, key=lambda bot, chat_id: chat_id,
+        namespace='chat_info', stale=CHAT_INFO_CACHE_TIMEOUT)
+async def get_chat_info(bot, chat_id: int):
+    """获取群组/频道详细信息（带缓存，并发请求只调用一次 get_chat）"""
+    return await bot.get_chat(chat_id)
+
+
+async def track_admin_changes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """根据成员状态变化（ChatMemberUpdated）更新管理员名单缓存"""
+    member_update = update.chat_member or update.my_chat_member
+    if not member_update:
+        return
+    
+    old_status = member_update.old_chat_member.status
+    new_status = member_update.new_chat_member.status
+    if old_status in ADMIN_STATUSES or new_status in ADMIN_STATUSES:
+        admin_roster.update_member(member_update.chat.id, member_update.new_chat_member)
+        logger.debug(f"群组 {member_update.chat.id} 管理员名单已更新: 用户 {member_update.new_chat_member.user.id} {old_status} -> {new_status}")
 
 
 def require_admin(func):
@@ -156,24 +267,9 @@ def clear_admin_cache(chat_id: Optional[int] = None, user_id: Optional[int] = No
     
     Args:
         chat_id: 群组ID，如果提供则只清除该群组的缓存
-        user_id: 用户ID，如果提供则只清除该用户的缓存
+        user_id: 用户ID（名单按群组缓存，提供时同样清除所在群组或全部群组）
     """
-    global _admin_cache
-    
-    if chat_id is None and user_id is None:
-        # 清除所有缓存
-        _admin_cache.clear()
-    else:
-        # 清除特定缓存
-        keys_to_remove = []
-        for key in _admin_cache.keys():
-            cid, uid = key
-            if (chat_id is None or cid == chat_id) and (user_id is None or uid == user_id):
-                keys_to_remove.append(key)
-        
-        for key in keys_to_remove:
-            del _admin_cache[key]
-    
+    admin_roster.invalidate(chat_id)
     logger.debug(f"已清除管理员缓存: chat_id={chat_id}, user_id={user_id}")
 
 
@@ -0,0 +1,193 @@
+"""
+HTTP 服务模块
+基于 asyncio 的轻量 HTTP/1.1 服务，提供 /metrics 指标接口；
+Webhook 模式下同一端口同时接收 Telegram 推送的更新
+"""
+import json
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from telegram import Update
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 请求处理函数: async handler(headers, body) -> (状态码, Content-Type, 响应内容)
+RouteHandler = Callable[[Dict[str, str], bytes], Awaitable[Tuple[int, str, bytes]]]
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+            405: 'Method Not Allowed', 411: 'Length Required', 413: 'Payload Too Large',
+            431: 'Request Header Fields Too Large', 500: 'Internal Server Error'}
+
+
+class _BadRequest(Exception):
+    """请求格式错误，回复指定状态码后关闭连接"""
+    
+    def __init__(self, status: int):
+        super().__init__(_REASONS[status])
+        self.status = status
+
+
+class WebServer:
+    """轻量 HTTP 服务（支持 keep-alive，只处理带 Content-Length 的请求体，不支持分块传输）"""
+    
+    # 请求体大小上限（字节）
+    MAX_BODY_SIZE = 1024 * 1024
+    # 请求头行数上限和总大小上限（字节，包括请求行）
+    MAX_HEADERS = 100
+    MAX_HEADER_SIZE = 16 * 1024
+    # 空闲连接超时（秒）
+    IDLE_TIMEOUT = 60
+    
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        # 路由表: {(方法, 路径): 处理函数}
+        self._routes: Dict[Tuple[str, str], RouteHandler] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.add_route('GET', '/metrics', self._metrics)
+    
+    def add_route(self, method: str, path: str, handler: RouteHandler):
+        """注册路由"""
+        self._routes[(method.upper(), path)] = handler
+    
+    async def _metrics(self, headers: Dict[str, str], body: bytes) -> Tuple[int, str, bytes]:
+        return 200, 'text/plain; version=0.0.4; charset=utf-8', metrics.render().encode('utf-8')
+    
+    async def start(self):
+        """开始监听"""
+        if self._server is not None:
+            return
+        # 单行超过 limit 时 readline 抛出 ValueError（按请求头过大处理）
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                  limit=self.MAX_HEADER_SIZE)
+        logger.info(f"✅ HTTP 服务已启动: http://{self.host}:{self.port}/metrics")
+    
+    async def close(self):
+        """停止监听"""
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+    
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                keep_alive = await asyncio.wait_for(self._handle_request(reader, writer), self.IDLE_TIMEOUT)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"处理 HTTP 请求时出错: {e}")
+        finally:
+            writer.close()
+    
+    async def _read_head(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, str, Dict[str, str]]]:
+        """读取请求行和请求头，连接已关闭时返回 None，格式错误时抛出 _BadRequest"""
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return None
+            size = len(request_line)
+            try:
+                method, target, version = request_line.decode('latin-1').split()
+            except ValueError:
+                raise _BadRequest(400) from None
+            
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                size += len(line)
+                if size > self.MAX_HEADER_SIZE or len(headers) >= self.MAX_HEADERS:
+                    raise _BadRequest(431)
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+        except ValueError:
+            # 单行超过 StreamReader 的 limit
+            raise _BadRequest(431) from None
+        return method, target, version, headers
+    
+    def _content_length(self, headers: Dict[str, str]) -> int:
+        """解析请求体长度：不支持分块传输（411），Content-Length 必须是非负整数（400）"""
+        if 'transfer-encoding' in headers:
+            raise _BadRequest(411)
+        value = headers.get('content-length')
+        if value is None:
+            return 0
+        if not (value.isascii() and value.isdigit()):
+            raise _BadRequest(400)
+        length = int(value)
+        if length > self.MAX_BODY_SIZE:
+            raise _BadRequest(413)
+        return length
+    
+    async def _handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        """处理一个请求，返回是否保持连接"""
+        try:
+            head = await self._read_head(reader)
+            if head is None:
+                return False
+            method, target, version, headers = head
+            length = self._content_length(headers)
+        except _BadRequest as e:
+            await self._respond(writer, e.status, 'text/plain', _REASONS[e.status].encode(), False)
+            return False
+        
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        body = await reader.readexactly(length) if length else b''
+        
+        path = target.split('?', 1)[0]
+        handler = self._routes.get((method.upper(), path))
+        if handler is None:
+            status = 405 if any(route_path == path for _, route_path in self._routes) else 404
+            await self._respond(writer, status, 'text/plain', _REASONS[status].encode(), keep_alive)
+            return keep_alive
+        
+        try:
+            status, content_type, content = await handler(headers, body)
+        except Exception as e:
+            logger.error(f"处理 {method} {path} 时出错: {e}")
+            status, content_type, content = 500, 'text/plain', b'internal error'
+        await self._respond(writer, status, content_type, content, keep_alive)
+        return keep_alive
+    
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, content_type: str,
+                       content: bytes, keep_alive: bool):
+        head = (
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(content)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + content)
+        await writer.drain()
+
+
+def add_webhook_route(server: WebServer, bot, update_queue: asyncio.Queue, path: str,
+                      secret_token: Optional[str] = None):
+    """
+    注册 Telegram Webhook 路由，收到的更新放入 update_queue
+    
+    Args:
+        server: HTTP 服务
+        bot: 用于解析更新的 Bot
+        update_queue: 更新队列（通常为 application.update_queue）
+        path: Webhook 路径（如 /webhook）
+        secret_token: 设置 Webhook 时使用的 secret_token，为空时不校验
+    """
+    async def handle_update(headers: Dict[str, str], body: bytes) -> Tuple[int, str, bytes]:
+        if secret_token and headers.get('x-telegram-bot-api-secret-token') != secret_token:
+            return 403, 'text/plain', b'forbidden'
+        try:
+            update = Update.de_json(json.loads(body), bot)
+        except Exception as e:
+            logger.error(f"解析 Webhook 更新失败: {e}")
+            return 400, 'text/plain', b'bad update'
+        await update_queue.put(update)
+        return 200, 'text/plain', b'ok'
+    
+    server.add_route('POST', path, handle_update)